@@ -7,7 +7,10 @@ from uagents_core.contrib.protocols.chat import (
     TextContent,
     chat_protocol_spec,
 )
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Tuple
+import asyncio
+import threading
+from concurrent.futures import Future
 import numpy as np
 import json
 from datetime import datetime
@@ -19,10 +22,20 @@ import requests
 from dotenv import load_dotenv
 from uniswap_universal_router import Uniswap
 from uniswap_universal_router import ERC20_ABI
+from uniswap_async import AsyncUniswap
+from twap import TwapScheduler
+from execution_journal import FAILED, SKIPPED, ExecutionJournal, call_fingerprint
+from fee_scheduler import BaseFeeScheduler
+from prestaging import TransactionStager
+from netting import FundDelta, FundFill, NettingEngine
+from wallet_pool import WalletPool
+from web3_rpc import make_provider
 
 load_dotenv()
 
-web3 = Web3(Web3.HTTPProvider(os.environ.get('WEB3_PROVIDER_URL')))
+# Calls made concurrently by the agent, the router client and the codec share batched round trips.
+# WEB3_PROVIDER_URL may list several endpoints separated by commas, reads are then hedged across them.
+web3 = Web3(make_provider(os.environ.get('WEB3_PROVIDER_URL')))
 
 @dataclass
 class TalentProfile:
@@ -77,13 +90,69 @@ class BuilderTokensIndexFundAgent:
         self.private_key = os.environ.get('PRIVATE_KEY')
         self.provider = os.environ.get('WEB3_PROVIDER_URL')
         self.web3 = web3
-        self.uniswap = Uniswap(
+        # The clients below open files, connections and threads: they are created on first use, not here
+        self._lazy_lock = threading.RLock()
+        self._uniswap: Optional[Uniswap] = None
+        self._journal: Optional[ExecutionJournal] = None
+        self._wallet_pool: Optional[WalletPool] = None
+        self._fee_scheduler: Optional[BaseFeeScheduler] = None
+        self._stager: Optional[TransactionStager] = None
+        self.async_uniswap = AsyncUniswap(
             wallet_address=self.wallet_address,
             private_key=self.private_key,
-            provider=self.provider,
-            web3=self.web3
+            provider=self.provider
         )
         
+    @property
+    def uniswap(self) -> Uniswap:
+        """The router client, loading the pool registry file"""
+        with self._lazy_lock:
+            if self._uniswap is None:
+                self._uniswap = Uniswap(
+                    wallet_address=self.wallet_address,
+                    private_key=self.private_key,
+                    provider=self.provider,
+                    web3=self.web3,
+                    pool_registry_path=os.environ.get('POOL_REGISTRY_PATH', 'pool_registry.json')
+                )
+                # The swaps in flight at a crash are settled by the journal, the client must not cancel them
+                self._uniswap.journaled_nonces = \
+                    lambda address: self.journal.in_flight_nonces(address, self.wallet_address)
+            return self._uniswap
+
+    @property
+    def journal(self) -> ExecutionJournal:
+        with self._lazy_lock:
+            if self._journal is None:
+                self._journal = ExecutionJournal(os.environ.get('EXECUTION_JOURNAL_PATH', 'execution_journal.db'))
+            return self._journal
+
+    @property
+    def wallet_pool(self) -> WalletPool:
+        """Extra hot wallets, comma-separated private keys: sharded purchases spread the legs over all of them"""
+        with self._lazy_lock:
+            if self._wallet_pool is None:
+                hot_wallet_keys = os.environ.get('HOT_WALLET_PRIVATE_KEYS', '')
+                self._wallet_pool = WalletPool.from_private_keys(
+                    self.uniswap, [key.strip() for key in hot_wallet_keys.split(',') if key.strip()])
+            return self._wallet_pool
+
+    @property
+    def fee_scheduler(self) -> BaseFeeScheduler:
+        """Non-urgent baskets wait for a base fee below the lowest quartile of the last blocks, or their deadline"""
+        with self._lazy_lock:
+            if self._fee_scheduler is None:
+                self._fee_scheduler = BaseFeeScheduler(self.web3)
+            return self._fee_scheduler
+
+    @property
+    def stager(self) -> TransactionStager:
+        """The next basket can be kept built and signed in the background, ready to broadcast on a trigger"""
+        with self._lazy_lock:
+            if self._stager is None:
+                self._stager = TransactionStager(self.uniswap, fee=2000, slippage=0.5)
+            return self._stager
+
     def _fetch_token_deployments(self, page: int = 1, limit: int = 100) -> List[Dict[str, Any]]:
         """Fetch token deployments from the API"""
         try:
@@ -203,6 +272,10 @@ class BuilderTokensIndexFundAgent:
                 all_deployments.extend(deployments)
             
             print(f"Fetched {len(all_deployments)} token deployments")
+
+            # The deployment records carry the pool of each token, register them for the swaps
+            new_pools = self.uniswap.pool_registry.add_deployments(all_deployments)
+            print(f"Registered {new_pools} new pools ({len(self.uniswap.pool_registry)} known)")
             
             # Convert to talent profiles
             self.talent_profiles = self._convert_to_talent_profiles(all_deployments)
@@ -324,23 +397,23 @@ class BuilderTokensIndexFundAgent:
             generated_at=datetime.now().isoformat()
         )
 
-    def execute_fund_purchases(self, allocations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Execute token purchases using Uniswap V4"""
-        if not self.uniswap:
-            raise Exception("Uniswap not initialized")
-            
-        # Get the agent's wallet address
-        wallet_address = self.uniswap.wallet_address
-        print(f"Wallet address: {wallet_address}")
+    def _allocation_legs(self, allocations: List[Dict[str, Any]], balance: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        Convert allocation percentages of the $TALENT balance into (token_address, amount_in_wei) legs.
+        The balance is the one of the agent's wallet unless given, ex: the total of the wallet pool
+        """
+        if balance is None:
+            # Get the agent's wallet address
+            wallet_address = self.uniswap.wallet_address
+            print(f"Wallet address: {wallet_address}")
 
-        # Get the agent's balance for $TALENT token
-        token = self.uniswap.w3.eth.contract(address=self.talent_token_address, abi=ERC20_ABI)
-        balance = token.functions.balanceOf(wallet_address).call()
+            # Get the agent's balance for $TALENT token
+            token = self.uniswap.w3.eth.contract(address=self.talent_token_address, abi=ERC20_ABI)
+            balance = token.functions.balanceOf(wallet_address).call()
         print(f"Balance: {balance}")
 
+        legs = []
         for allocation in allocations:
-            token_address = allocation["token_address"]
-            
             allocation_amount = allocation["allocation_percentage"] * balance / 100
             print(f"Allocation amount: {allocation_amount}")
 
@@ -349,19 +422,380 @@ class BuilderTokensIndexFundAgent:
 
             amount_in_wei = self.web3.to_wei(rounded_allocation_amount, "ether")
             print(f"Amount in wei: {amount_in_wei}")
+            legs.append((allocation["token_address"], amount_in_wei))
+        return legs
+
+    def execute_fund_purchases(self, allocations: List[Dict[str, Any]], max_workers: int = 1) -> List[Dict[str, Any]]:
+        """Execute token purchases using Uniswap V4, building and sending max_workers legs at the same time"""
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        legs = self._allocation_legs(allocations)
+
+        # Journal the intent of every leg first, so a restart can tell which ones were bought
+        basket_id = self.journal.start_basket(self.talent_token_address, legs)
+        results = self._execute_journaled_legs(basket_id, list(range(len(legs))), legs, max_workers)
+        self.journal.close_basket(basket_id)
+        return results
+
+    def execute_fund_purchases_deferred(self, allocations: List[Dict[str, Any]], priority: int = 0,
+                                        deadline: float = 3600.0, max_base_fee: Optional[int] = None,
+                                        max_workers: int = 1) -> Future:
+        """
+        Queue the purchases until the base fee eases, at most deadline seconds.
+        The legs are computed from the balance at release time.
+
+        :return: a future of the results of execute_fund_purchases
+        """
+        return self.fee_scheduler.submit(
+            f"purchases of {len(allocations)} tokens",
+            lambda: self.execute_fund_purchases(allocations, max_workers),
+            priority=priority,
+            deadline=deadline,
+            max_base_fee=max_base_fee,
+        )
+
+    def stage_fund_purchases(self, allocations: List[Dict[str, Any]]) -> None:
+        """
+        Keep the purchases of these allocations built and signed in the background, so fire_fund_purchases
+        only has to broadcast them. Call it again whenever the allocations change
+        """
+        legs = self._allocation_legs(allocations)
+        self.stager.update_targets(self.talent_token_address, legs)
+        self.stager.start()
+
+    def fire_fund_purchases(self, refresh_fees: bool = False) -> List[Dict[str, Any]]:
+        """
+        Broadcast the staged purchases at once, the fees are only refreshed if refresh_fees is True.
+        The basket is journaled like execute_fund_purchases. The minimum outputs come from the quotes of the
+        staging, up to stager.max_age seconds old; the balance is checked again before broadcasting.
+        """
+        targets = self.stager.targets
+        if targets is None:
+            raise Exception("No purchases staged")
+        from_token, legs, _pool_versions = targets
+        basket_id = self.journal.start_basket(from_token, list(legs))
+        signed: Dict[int, Tuple[Any, int]] = {}
+
+        def on_signed(index: int, tx_hash: Any, nonce: int, trx_params: Dict[str, Any]) -> None:
+            self.journal.record_signed(basket_id, index, tx_hash, nonce, self.uniswap.address,
+                                       call_fingerprint(trx_params))
+            signed[index] = (tx_hash, nonce)
+
+        try:
+            tx_hashes = self.stager.fire(refresh_fees=refresh_fees, on_signed=on_signed, targets=targets)
+        except Exception as e:
+            # the basket must not stay open: a restart would resume it and buy legs the caller saw fail
+            for index in range(len(legs)):
+                signed_hash, nonce = signed.get(index, (None, None))
+                self.journal.record(basket_id, index, SKIPPED, tx_hash=signed_hash, nonce=nonce,
+                                    sender=self.uniswap.address if signed_hash else None, error=f"fire failed: {e}")
+            self.journal.close_basket(basket_id)
+            raise
+        results = []
+        for index, ((token_address, _amount), tx_hash) in enumerate(zip(legs, tx_hashes)):
+            if tx_hash is None and index in signed:
+                signed_hash, nonce = signed[index]
+                self.journal.record(basket_id, index, FAILED, tx_hash=signed_hash, nonce=nonce,
+                                    sender=self.uniswap.address)
+            elif tx_hash is None:
+                self.journal.record(basket_id, index, SKIPPED, error="not staged")
+            results.append({"token_address": token_address, "tx_hash": tx_hash, "status": None})
+
+        sent = [(index, result) for index, result in enumerate(results) if result["tx_hash"]]
+        receipts = self.uniswap.receipt_watcher.wait_all([result["tx_hash"] for _index, result in sent], timeout=120)
+        for (index, result), receipt in zip(sent, receipts):
+            result["status"] = receipt["status"] if receipt else None
+            if receipt:
+                self.journal.record_receipt(basket_id, index, receipt)
+        if not any(leg.in_flight for leg in self.journal.legs(basket_id)):
+            self.journal.close_basket(basket_id)
+        return results
+
+    def execute_netted_rebalance(self, fund_deltas: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+        """
+        Rebalance several funds sharing this wallet at once: the buys and sells of the same token by different
+        funds cancel out, only the net trades are sent and their fills are attributed back to every fund.
+
+        :param fund_deltas: fund id -> token address -> value to trade in $TALENT wei, positive to buy, negative to sell
+        :return: the net trade of each token and the fills of every fund
+        """
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        engine = NettingEngine(self.uniswap, self.talent_token_address, fee=2000, slippage=0.5)
+        plan = engine.plan([
+            FundDelta(fund_id, token_address, value)
+            for fund_id, deltas in fund_deltas.items()
+            for token_address, value in deltas.items()
+        ])
+
+        def send_buys(legs: List[Tuple[str, int]]) -> List[Any]:
+            # The net buys are a basket like any other, journaled and resumable
+            basket_id = self.journal.start_basket(self.talent_token_address, legs)
+            results = self._execute_journaled_legs(basket_id, list(range(len(legs))), legs)
+            self.journal.close_basket(basket_id)
+            return [result["tx_hash"] for result in results]
+
+        tx_hashes, fills = engine.execute(plan, send_buys=send_buys)
+        fills_by_fund: Dict[str, List[FundFill]] = {}
+        for fill in fills:
+            fills_by_fund.setdefault(fill.fund_id, []).append(fill)
+        for fund_id, fund_fills in fills_by_fund.items():
+            crossed = sum(fill.crossed_value for fill in fund_fills)
+            print(f"Fund {fund_id}: {len(fund_fills)} tokens filled, {crossed} crossed internally")
+        return {
+            "net_trades": dict(tx_hashes),
+            "crossed_value": plan.crossed_value,
+            "gross_value": plan.gross_value,
+            "fills": {
+                fund_id: [
+                    {"token_address": fill.token, "talent_delta": fill.base_delta, "token_delta": fill.token_delta,
+                     "crossed_value": fill.crossed_value}
+                    for fill in fund_fills
+                ]
+                for fund_id, fund_fills in fills_by_fund.items()
+            },
+        }
+
+    def execute_fund_purchases_sharded(self, allocations: List[Dict[str, Any]],
+                                       max_workers: int = 1) -> List[Dict[str, Any]]:
+        """
+        Execute token purchases from every wallet of the pool at the same time, each wallet with its own nonces,
+        so the number of swaps in flight is not capped by a single nonce sequence.
+        The allocations are computed on the $TALENT held by the whole pool
+        """
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        balances = self.wallet_pool.balances(self.talent_token_address)
+        legs = self._allocation_legs(allocations, balance=sum(balances))
+        basket_id = self.journal.start_basket(self.talent_token_address, legs)
+        results = self._execute_sharded_legs(basket_id, list(range(len(legs))), legs, max_workers, balances)
+        self.journal.close_basket(basket_id)
+
+        # One report for the fund, whatever wallet bought each token
+        for address in self.wallet_pool.addresses:
+            wallet_results = [result for result in results if result.get("wallet") == address]
+            confirmed = sum(1 for result in wallet_results if result.get("status") == 1)
+            print(f"Wallet {address}: {confirmed}/{len(wallet_results)} swaps confirmed")
+        return results
+
+    def _execute_sharded_legs(self, basket_id: str, leg_indices: List[int], legs: List[Tuple[str, int]],
+                              max_workers: int = 1, balances: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """Spread the given legs of a journaled basket over the wallet pool and send the share of every wallet"""
+        results = self.wallet_pool.run(
+            self.talent_token_address,
+            legs,
+            lambda client, indices: self._execute_journaled_legs(
+                basket_id, [leg_indices[index] for index in indices], [legs[index] for index in indices],
+                max_workers, client),
+            balances,
+        )
+        for leg_index, result in zip(leg_indices, results):
+            if result.get("wallet") is None:
+                self.journal.record(basket_id, leg_index, SKIPPED, error=result["error"])
+        return results
+
+    def _execute_journaled_legs(self, basket_id: str, leg_indices: List[int], legs: List[Tuple[str, int]],
+                                max_workers: int = 1, uniswap: Optional[Uniswap] = None) -> List[Dict[str, Any]]:
+        """
+        Quote, simulate and send the given legs of a journaled basket, recording each step of every leg.
+        The legs are sent from the agent's wallet unless another client of the wallet pool is given
+        """
+        uniswap = uniswap or self.uniswap
+        # Quote the whole basket in one batched call
+        fee = 2000
+        slippage = 0.5
+        min_amounts_out = uniswap.quote_min_amounts_out(self.talent_token_address, legs, fee, slippage)
+
+        # Legs without a quotable direct pool are routed through the pool graph instead
+        pool_versions = ["v4" if min_amount_out is not None else "auto" for min_amount_out in min_amounts_out]
+
+        # Simulate the exact transactions of the whole basket before sending any of them
+        simulations = uniswap.simulate_basket(
+            self.talent_token_address, legs, fee, slippage,
+            pool_versions=pool_versions, min_amounts_out=min_amounts_out,
+        )
 
+        results = []
+        ready = []
+        for index, ((token_address, amount_in_wei), min_amount_out, simulation) in enumerate(
+                zip(legs, min_amounts_out, simulations)):
+            if simulation is None or not simulation.success:
+                print(f"Skipping {token_address}, the swap would fail: {simulation if simulation else 'no route'}")
+                error = simulation.error if simulation else "no route"
+                self.journal.record(basket_id, leg_indices[index], SKIPPED, error=error)
+                results.append({"token_address": token_address, "tx_hash": None, "status": None, "error": error})
+                continue
+            if min_amount_out is None:
+                print(f"No direct pool quote for {token_address}, searching for a route")
+            results.append({"token_address": token_address, "tx_hash": None})
+            ready.append(index)
+
+        # Each transaction is journaled once signed, before it is broadcast
+        signed: Dict[int, Tuple[Any, int]] = {}
+
+        def on_signed(index: int, tx_hash: Any, nonce: int, trx_params: Dict[str, Any]) -> None:
+            self.journal.record_signed(basket_id, leg_indices[index], tx_hash, nonce, uniswap.address,
+                                       call_fingerprint(trx_params))
+            signed[index] = (tx_hash, nonce)
+
+        if max_workers > 1:
+            tx_hashes = uniswap.make_trades(
+                self.talent_token_address,
+                [legs[index] for index in ready],
+                fee,
+                slippage,
+                pool_versions=[pool_versions[index] for index in ready],
+                min_amounts_out=[min_amounts_out[index] for index in ready],
+                max_workers=max_workers,
+                on_signed=lambda position, tx_hash, nonce, trx_params: on_signed(
+                    ready[position], tx_hash, nonce, trx_params),
+            )
+        else:
+            tx_hashes = []
+            for index in ready:
+                token_address, amount_in_wei = legs[index]
+                try:
+                    tx_hashes.append(uniswap.make_trade(
+                        from_token=self.talent_token_address,
+                        to_token=token_address,
+                        amount=amount_in_wei,
+                        fee=fee,          # e.g., 3000 for a 0.3% Uniswap V3 pool
+                        slippage=slippage,  # 0.5% slippage tolerance applied to the quoted output
+                        pool_version=pool_versions[index],  # can be "v3", "v4" or "auto"
+                        min_amount_out=min_amounts_out[index],
+                        on_signed=lambda tx_hash, nonce, trx_params, index=index: on_signed(
+                            index, tx_hash, nonce, trx_params),
+                    ))
+                except Exception as e:
+                    print(f"Swap failed: {e}")
+                    tx_hashes.append(None)
+
+        for index, tx_hash in zip(ready, tx_hashes):
+            if tx_hash:
+                print(f"Swap transaction sent! Tx hash: {tx_hash.hex()}")
+            else:
+                # keep the signed hash, if any: the node may have received it anyway
+                signed_hash, nonce = signed.get(index, (None, None))
+                self.journal.record(basket_id, leg_indices[index], FAILED, tx_hash=signed_hash, nonce=nonce,
+                                    sender=uniswap.address)
+            results[index]["tx_hash"] = tx_hash
+
+        # All the swaps are in flight, wait for them together instead of one by one
+        sent = [(index, result) for index, result in enumerate(results) if result["tx_hash"]]
+        receipts = uniswap.receipt_watcher.wait_all([result["tx_hash"] for _index, result in sent], timeout=120)
+        for (index, result), receipt in zip(sent, receipts):
+            result["status"] = receipt["status"] if receipt else None
+            if receipt:
+                self.journal.record_receipt(basket_id, leg_indices[index], receipt)
+        return results
+
+    def resume_fund_purchases(self, max_workers: int = 1) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Finish the baskets left open by an interrupted run: their legs are reconciled with the chain,
+        the swaps still in flight are waited for, and only the legs that were not bought are sent again
+        """
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        resumed = {}
+        for basket_id in self.journal.open_baskets():
+            journal_legs = self.journal.reconcile(self.web3, self.wallet_address, basket_id)
+            in_flight = [leg for leg in journal_legs if leg.in_flight]
+            if in_flight:
+                print(f"Basket {basket_id}: waiting for {len(in_flight)} swaps sent before the restart")
+                receipts = self.uniswap.receipt_watcher.wait_all([leg.tx_hash for leg in in_flight], timeout=120)
+                for leg, receipt in zip(in_flight, receipts):
+                    if receipt:
+                        self.journal.record_receipt(basket_id, leg.leg_index, receipt)
+                journal_legs = self.journal.legs(basket_id)
+
+            remaining = [leg for leg in journal_legs if not leg.done and not leg.in_flight]
+            print(f"Basket {basket_id}: {len(journal_legs) - len(remaining)} legs done or in flight, "
+                  f"{len(remaining)} to send")
+            # with several hot wallets, the remaining legs are spread again over the pool
+            execute = self._execute_sharded_legs if len(self.wallet_pool) > 1 else self._execute_journaled_legs
+            resumed[basket_id] = execute(
+                basket_id,
+                [leg.leg_index for leg in remaining],
+                [(leg.to_token, leg.amount) for leg in remaining],
+                max_workers,
+            ) if remaining else []
+            if not any(leg.in_flight for leg in self.journal.legs(basket_id)):
+                self.journal.close_basket(basket_id)
+        return resumed
+
+    def execute_fund_purchases_twap(self, allocations: List[Dict[str, Any]], horizon: float = 600.0,
+                                    slices: int = 10) -> List[Dict[str, Any]]:
+        """Execute token purchases as child orders spread over horizon seconds, to bound the price impact on thin pools"""
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        legs = self._allocation_legs(allocations)
+        scheduler = TwapScheduler(self.uniswap, horizon=horizon, slices=slices, fee=2000, slippage=0.5)
+        leg_results = scheduler.run(self.talent_token_address, legs)
+
+        tx_hashes = [tx_hash for leg_result in leg_results for tx_hash in leg_result.tx_hashes if tx_hash]
+        receipts = iter(self.uniswap.receipt_watcher.wait_all(tx_hashes, timeout=120))
+        results = []
+        for leg_result in leg_results:
+            statuses = []
+            for tx_hash in leg_result.tx_hashes:
+                receipt = next(receipts) if tx_hash else None
+                statuses.append(receipt["status"] if receipt else None)
+            results.append({
+                "token_address": leg_result.to_token,
+                "tx_hashes": leg_result.tx_hashes,
+                "statuses": statuses,
+            })
+        return results
+
+    def execute_redemption(self, fraction: float, to_token: Optional[str] = None) -> Dict[str, Any]:
+        """Sell the same fraction of every fund holding back to $TALENT, or to to_token"""
+        if not self.uniswap:
+            raise Exception("Uniswap not initialized")
+
+        tokens = [allocation["token_address"] for allocation in self.fund_allocations]
+        tx_hashes, skipped = self.uniswap.redeem(
+            fraction=fraction,
+            tokens=tokens,
+            to_token=to_token or self.talent_token_address,
+            slippage=0.5,
+        )
+        receipts = self.uniswap.receipt_watcher.wait_all(tx_hashes, timeout=120)
+        return {
+            "transactions": [
+                {"tx_hash": tx_hash, "status": receipt["status"] if receipt else None}
+                for tx_hash, receipt in zip(tx_hashes, receipts)
+            ],
+            "skipped_tokens": skipped,
+        }
+
+    async def execute_fund_purchases_async(self, allocations: List[Dict[str, Any]]) -> List[Any]:
+        """Execute token purchases using Uniswap V4 without blocking the agent event loop"""
+        balance = await self.async_uniswap.get_token_balance(self.talent_token_address)
+        print(f"Balance: {balance}")
+
+        tx_hashes = []
+        for allocation in allocations:
+            amount_in_wei = int(allocation["allocation_percentage"] * balance / 100)
             try:
-                tx_hash = self.uniswap.make_trade(
+                tx_hash = await self.async_uniswap.make_trade(
                     from_token=self.talent_token_address,
-                    to_token=token_address,
+                    to_token=allocation["token_address"],
                     amount=amount_in_wei,
-                    fee=2000,         # e.g., 3000 for a 0.3% Uniswap V3 pool
-                    slippage=0.5,     # non-functional right now. 0.5% slippage tolerance
-                    pool_version="v4"  # can be "v3" or "v4"
+                    fee=2000,
+                    slippage=0.5
                 )
-                print(f"Swap transaction sent! Tx hash: {tx_hash.hex()}")
+                if tx_hash:
+                    print(f"Swap transaction sent! Tx hash: {tx_hash.hex()}")
+                tx_hashes.append(tx_hash)
             except Exception as e:
                 print(f"Swap failed: {e}")
+                tx_hashes.append(None)
+        return tx_hashes
 
     def execute_save_strategy_to_api(self, allocations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Save the strategy to the API"""
@@ -392,17 +826,62 @@ agent = Agent(
     endpoint=["http://127.0.0.1:8000/submit"],
 )
 
-# Fund the agent if needed
-fund_agent_if_low(agent.wallet.address())
-
 # Create the fund management protocol
 fund_protocol = Protocol("Builder Tokens Index Fund")
 
 # Create the chat protocol
 chat_protocol = Protocol(spec=chat_protocol_spec)
 
-# Initialize the fund agent
-fund_agent = BuilderTokensIndexFundAgent()
+# The fund agent is created on first use, so importing this module sends no RPC
+_fund_agent: Optional[BuilderTokensIndexFundAgent] = None
+# the tasks started at startup, referenced until they are done
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def get_fund_agent() -> BuilderTokensIndexFundAgent:
+    global _fund_agent
+    if _fund_agent is None:
+        _fund_agent = BuilderTokensIndexFundAgent()
+    return _fund_agent
+
+
+@agent.on_event("startup")
+async def startup(ctx: Context):
+    """Run the network setup in the background once the agent is started"""
+    # Fund the agent if needed
+    await asyncio.to_thread(fund_agent_if_low, agent.wallet.address())
+    # Finish the purchases interrupted by a crash or a restart, before the stuck nonces are cancelled,
+    # so the swaps still in flight are settled from the chain instead of cancelled
+    try:
+        resumed = await asyncio.to_thread(get_fund_agent().resume_fund_purchases)
+        if resumed:
+            ctx.logger.info(f"Resumed {len(resumed)} interrupted baskets")
+    except Exception as e:
+        ctx.logger.error(f"Could not resume the interrupted baskets: {e}")
+    try:
+        await asyncio.to_thread(get_fund_agent().uniswap.ensure_ready)
+    except Exception as e:
+        ctx.logger.error(f"Uniswap client not ready: {e}")
+        return
+    # Release the deferred baskets once the fees ease
+    get_fund_agent().fee_scheduler.start()
+    # Register every pool paired with $TALENT, including the ones not created by a deployment. The first sync
+    # scans the PoolManager logs since its deployment, it runs in the background and the fund requests don't wait
+    task = asyncio.create_task(sync_talent_pools(ctx))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def sync_talent_pools(ctx: Context):
+    """Sync the pool registry with the pools of $TALENT created since the last sync"""
+    fund_agent = get_fund_agent()
+    try:
+        new_pools = await asyncio.to_thread(
+            fund_agent.uniswap.sync_pool_registry, tokens=[fund_agent.talent_token_address])
+        ctx.logger.info(f"Registered {new_pools} new pools from the PoolManager logs")
+    except Exception as e:
+        ctx.logger.error(f"Could not sync the pools from the PoolManager logs: {e}")
+
 
 @agent.on_message(model=FundRequest, replies=FundResponse)
 async def handle_fund_request(ctx: Context, sender: str, msg: FundRequest):
@@ -412,7 +891,7 @@ async def handle_fund_request(ctx: Context, sender: str, msg: FundRequest):
     
     try:
         # Create the index fund
-        fund_response = fund_agent.create_index_fund(msg)
+        fund_response = get_fund_agent().create_index_fund(msg)
         
         # Log the results
         ctx.logger.info(f"Created fund with {fund_response.total_tokens} tokens")
@@ -467,6 +946,7 @@ async def handle_chat_message(ctx: Context, sender: str, msg: ChatMessage):
             text += item.text
  
     ctx.logger.info(f"Received chat message: {text}")
+    fund_agent = get_fund_agent()
     
     # Process the message and generate response
     try:
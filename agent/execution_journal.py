@@ -0,0 +1,317 @@
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+from hexbytes import HexBytes
+from web3 import Web3
+from web3_rpc import batch_request
+
+# leg states: the intent is recorded first, the signed hash and nonce before the transaction is broadcast
+INTENT = "intent"
+SKIPPED = "skipped"
+SIGNED = "signed"
+FAILED = "failed"
+CONFIRMED = "confirmed"
+REVERTED = "reverted"
+DROPPED = "dropped"
+# the nonce was mined by another transaction that could not be identified: the leg is not sent again
+REPLACED = "replaced"
+
+# the legs in these states are done, the others are sent again when a basket is resumed
+_done_states = (CONFIRMED, REPLACED)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    basket_id TEXT NOT NULL,
+    leg_index INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    from_token TEXT,
+    to_token TEXT,
+    amount TEXT,
+    tx_hash TEXT,
+    sender TEXT,
+    nonce INTEGER,
+    status INTEGER,
+    error TEXT,
+    call_hash TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_basket ON events (basket_id, leg_index, id);
+"""
+
+# the basket itself is closed with an event on this leg index
+_basket_leg = -1
+
+# how far back reconcile() looks for the block that mined the nonce of a leg
+_nonce_search_blocks = 100_000
+
+
+def call_fingerprint(tx: Dict[str, Any]) -> str:
+    """:return: the hash of the destination and calldata of a transaction, the same for all its fee bumps"""
+    to = HexBytes(tx["to"]) if tx.get("to") else b""
+    data = HexBytes(tx.get("data", tx.get("input")) or b"")
+    return Web3.to_hex(Web3.keccak(bytes(to) + bytes(data)))
+
+
+@dataclass
+class JournalLeg:
+    """The last known state of one leg of a basket, with the transaction of its last attempt if it was signed"""
+    basket_id: str
+    leg_index: int
+    from_token: str
+    to_token: str
+    amount: int
+    state: str
+    tx_hash: Optional[HexBytes] = None
+    sender: Optional[str] = None
+    nonce: Optional[int] = None
+    status: Optional[int] = None
+    error: Optional[str] = None
+    call_hash: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in _done_states
+
+    @property
+    def in_flight(self) -> bool:
+        return self.state == SIGNED
+
+
+def mined_transaction(
+        w3: Web3,
+        sender: str,
+        nonce: int,
+        search_blocks: int = _nonce_search_blocks) -> Optional[Dict[str, Any]]:
+    """
+    Find the transaction of sender mined with this nonce, by a binary search of the first block where
+    the nonce of sender is above it.
+
+    :return: the transaction, None if it was not mined in the last search_blocks blocks or the node
+    has no state old enough to tell
+    """
+    sender = Web3.to_checksum_address(sender)
+    try:
+        high = w3.eth.block_number
+        low = max(0, high - search_blocks)
+        if w3.eth.get_transaction_count(sender, low) > nonce:
+            return None
+        while low < high:
+            middle = (low + high) // 2
+            if w3.eth.get_transaction_count(sender, middle) > nonce:
+                high = middle
+            else:
+                low = middle + 1
+        block = w3.eth.get_block(low, full_transactions=True)
+    except Exception as e:
+        print(f"Could not find the transaction of {sender} with nonce {nonce}: {e}")
+        return None
+    for transaction in block["transactions"]:
+        if Web3.to_checksum_address(transaction["from"]) == sender and int(transaction["nonce"]) == nonce:
+            return transaction
+    return None
+
+
+class ExecutionJournal:
+    """
+    Append-only journal of basket executions, in a SQLite database in WAL mode, synced on every commit.
+    The intent of every leg is recorded before anything is sent, then the hash and nonce of each transaction
+    right after it is signed and before it is broadcast, then its receipt status.
+    After a crash, reconcile() checks the legs left in flight against the chain, so a resumed basket only sends
+    the legs that were not bought.
+    """
+    def __init__(self, path: str = "execution_journal.db") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.executescript(_schema)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(events)")}
+        if "call_hash" not in columns:
+            # journals created before the calls were fingerprinted
+            self._connection.execute("ALTER TABLE events ADD COLUMN call_hash TEXT")
+
+    def _append(self, rows: Sequence[Tuple]) -> None:
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN IMMEDIATE")
+                self._connection.executemany(
+                    "INSERT INTO events (basket_id, leg_index, state, from_token, to_token, amount, tx_hash, sender, "
+                    "nonce, status, error, call_hash, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row + (now,) for row in rows],
+                )
+
+    def start_basket(self, from_token: str, legs: Sequence[Tuple[str, int]], basket_id: Optional[str] = None) -> str:
+        """
+        Record the intent of every leg of a new basket.
+
+        :param legs: the (to_token, amount in wei) of each leg
+        :return: the basket id
+        """
+        basket_id = basket_id or str(uuid.uuid4())
+        self._append([
+            (basket_id, index, INTENT, from_token, to_token, str(amount), None, None, None, None, None, None)
+            for index, (to_token, amount) in enumerate(legs)
+        ])
+        return basket_id
+
+    def record(
+            self,
+            basket_id: str,
+            leg_index: int,
+            state: str,
+            tx_hash: Optional[Union[HexBytes, str]] = None,
+            nonce: Optional[int] = None,
+            status: Optional[int] = None,
+            error: Optional[str] = None,
+            sender: Optional[str] = None,
+            call_hash: Optional[str] = None) -> None:
+        tx_hash = Web3.to_hex(HexBytes(tx_hash)) if tx_hash is not None else None
+        self._append([(basket_id, leg_index, state, None, None, None, tx_hash, sender, nonce, status, error,
+                       call_hash)])
+
+    def record_signed(
+            self,
+            basket_id: str,
+            leg_index: int,
+            tx_hash: Union[HexBytes, str],
+            nonce: int,
+            sender: Optional[str] = None,
+            call_hash: Optional[str] = None) -> None:
+        """
+        :param sender: the wallet that signed the transaction, if not the default one of reconcile()
+        :param call_hash: the call_fingerprint of the transaction, to recognize its fee bumps
+        """
+        self.record(basket_id, leg_index, SIGNED, tx_hash=tx_hash, nonce=nonce, sender=sender, call_hash=call_hash)
+
+    def record_receipt(self, basket_id: str, leg_index: int, receipt: Dict) -> None:
+        if receipt.get("cancelled"):
+            # the nonce was mined by a cancellation of the swap: the leg is sent again on resume
+            self.record(basket_id, leg_index, DROPPED, error="cancelled")
+            return
+        status = int(receipt["status"])
+        self.record(basket_id, leg_index, CONFIRMED if status == 1 else REVERTED,
+                    tx_hash=receipt["transactionHash"], status=status)
+
+    def close_basket(self, basket_id: str) -> None:
+        """Mark the basket as finished, whatever the state of its legs: it is not resumed anymore"""
+        self.record(basket_id, _basket_leg, "closed")
+
+    def open_baskets(self) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT basket_id FROM events WHERE basket_id NOT IN "
+                "(SELECT basket_id FROM events WHERE leg_index = ?) ORDER BY id", (_basket_leg,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def legs(self, basket_id: str) -> List[JournalLeg]:
+        """:return: the last known state of every leg of the basket, by leg index"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT leg_index, state, from_token, to_token, amount, tx_hash, sender, nonce, status, error, "
+                "call_hash FROM events WHERE basket_id = ? AND leg_index >= 0 ORDER BY id", (basket_id,)
+            ).fetchall()
+        legs: Dict[int, JournalLeg] = {}
+        # the fingerprint is only recorded when signed, the later events of the same transaction keep it
+        call_hashes: Dict[str, str] = {}
+        for leg_index, state, from_token, to_token, amount, tx_hash, sender, nonce, status, error, call_hash in rows:
+            if tx_hash is not None and call_hash is not None:
+                call_hashes[tx_hash] = call_hash
+            if state == INTENT:
+                legs[leg_index] = JournalLeg(basket_id, leg_index, from_token, to_token, int(amount), state)
+                continue
+            leg = legs[leg_index]
+            # every attempt starts over: only the transaction of the last event counts
+            leg.state, leg.status, leg.error = state, status, error
+            leg.tx_hash = HexBytes(tx_hash) if tx_hash is not None else None
+            leg.sender, leg.nonce = sender, nonce
+            leg.call_hash = call_hashes.get(tx_hash) if tx_hash is not None else None
+        return [legs[index] for index in sorted(legs)]
+
+    def reconcile(self, w3: Web3, address: str, basket_id: str) -> List[JournalLeg]:
+        """
+        Settle the legs of a basket that have a signed transaction but no recorded outcome, from the chain:
+        their receipts and the nonces of their senders are fetched in one batch request.
+        A transaction without receipt is still in flight if the node knows it, dropped otherwise.
+        If its nonce was mined by another transaction, that transaction is looked up: a fee bump of the same
+        call settles the leg with its own receipt, anything else (a cancellation, another swap) drops the leg
+        so it is sent again. A leg whose nonce was mined by a transaction that can't be found is marked replaced
+        and not sent again, rather than risk buying twice.
+
+        :param address: the account that signed the legs recorded without sender
+        :return: the legs of the basket after reconciliation
+        """
+        unsettled = [leg for leg in self.legs(basket_id) if leg.tx_hash and leg.state in (SIGNED, FAILED)]
+        if unsettled:
+            senders = sorted({Web3.to_checksum_address(leg.sender or address) for leg in unsettled})
+            results = batch_request(w3, [
+                (method, [Web3.to_hex(leg.tx_hash)])
+                for method in ("eth_getTransactionReceipt", "eth_getTransactionByHash")
+                for leg in unsettled
+            ] + [("eth_getTransactionCount", [sender, "latest"]) for sender in senders])
+            receipts, transactions = results[:len(unsettled)], results[len(unsettled):2 * len(unsettled)]
+            mined_nonces = {
+                sender: int(nonce, 16) if nonce else 0
+                for sender, nonce in zip(senders, results[2 * len(unsettled):])
+            }
+            for leg, receipt, transaction in zip(unsettled, receipts, transactions):
+                sender = Web3.to_checksum_address(leg.sender or address)
+                if receipt:
+                    status = int(receipt["status"], 16)
+                    self.record(basket_id, leg.leg_index, CONFIRMED if status == 1 else REVERTED,
+                                tx_hash=leg.tx_hash, nonce=leg.nonce, status=status, sender=leg.sender)
+                elif leg.nonce is not None and leg.nonce < mined_nonces[sender]:
+                    self._settle_mined_nonce(w3, basket_id, leg, sender)
+                elif transaction:
+                    if leg.state == FAILED:
+                        # the send reported an error, but the transaction reached the node
+                        self.record_signed(basket_id, leg.leg_index, leg.tx_hash, leg.nonce, leg.sender,
+                                           leg.call_hash)
+                else:
+                    self.record(basket_id, leg.leg_index, DROPPED)
+        return self.legs(basket_id)
+
+    def _settle_mined_nonce(self, w3: Web3, basket_id: str, leg: JournalLeg, sender: str) -> None:
+        """Settle a leg whose nonce was mined by another transaction than the one it recorded"""
+        mined = mined_transaction(w3, sender, leg.nonce) if leg.call_hash else None
+        if mined is None:
+            print(f"Leg {leg.leg_index} of basket {basket_id}: nonce {leg.nonce} was mined by an unknown "
+                  f"transaction, not sending it again")
+            self.record(basket_id, leg.leg_index, REPLACED, tx_hash=leg.tx_hash, nonce=leg.nonce, sender=leg.sender)
+        elif call_fingerprint(mined) == leg.call_hash:
+            # a fee bump of the same swap: the leg has the outcome of the bump
+            receipt = w3.eth.get_transaction_receipt(mined["hash"])
+            status = int(receipt["status"])
+            print(f"Leg {leg.leg_index} of basket {basket_id}: nonce {leg.nonce} was mined by the fee bump "
+                  f"{Web3.to_hex(mined['hash'])}")
+            self.record(basket_id, leg.leg_index, CONFIRMED if status == 1 else REVERTED, tx_hash=mined["hash"],
+                        nonce=leg.nonce, status=status, sender=leg.sender, call_hash=leg.call_hash)
+        else:
+            print(f"Leg {leg.leg_index} of basket {basket_id}: nonce {leg.nonce} was mined by another call "
+                  f"{Web3.to_hex(mined['hash'])}, the leg will be sent again")
+            self.record(basket_id, leg.leg_index, DROPPED)
+
+    def in_flight_nonces(self, sender: str, default_sender: Optional[str] = None) -> Set[int]:
+        """
+        :param default_sender: the account of the legs recorded without sender
+        :return: the nonces of sender signed for the open baskets and not settled yet
+        """
+        sender = Web3.to_checksum_address(sender)
+        nonces = set()
+        for basket_id in self.open_baskets():
+            for leg in self.legs(basket_id):
+                leg_sender = leg.sender or default_sender
+                if leg.state in (SIGNED, FAILED) and leg.nonce is not None and leg_sender \
+                        and Web3.to_checksum_address(leg_sender) == sender:
+                    nonces.add(leg.nonce)
+        return nonces
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,173 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Tuple
+from web3 import Web3
+
+
+@dataclass
+class DeferredBasket:
+    """A basket execution held until the base fee is low enough, or until its deadline"""
+    name: str
+    execute: Callable[[], Any] = field(repr=False)
+    priority: int = 0
+    deadline: float = 0.0
+    max_base_fee: Optional[int] = None
+    sequence: int = 0
+    result: "Future[Any]" = field(default_factory=Future, repr=False)
+
+    @property
+    def release_order(self) -> Tuple[int, float, int]:
+        """The highest priority first, then the earliest deadline, then the first submitted"""
+        return -self.priority, self.deadline, self.sequence
+
+
+class BaseFeeScheduler:
+    """
+    Hold the non-urgent basket executions until the base fee of the next block drops to a target.
+    The base fees of the last window blocks are kept in a rolling window, refreshed with one eth_feeHistory call
+    per poll for the blocks mined since the previous one. The target of a basket is its own max_base_fee,
+    or the target_percentile of the window: a basket waits for a block cheaper than most of the recent ones.
+    Every basket is released at its deadline whatever the fees, and the baskets released together
+    run one after the other in priority order.
+    """
+    def __init__(
+            self,
+            w3: Web3,
+            window: int = 300,
+            target_percentile: float = 25.0,
+            poll_interval: float = 12.0,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param w3: valid Web3 instance
+        :param window: number of recent blocks whose base fee is kept, at most 1024 (the eth_feeHistory limit)
+        :param target_percentile: the percentile of the window used as target by the baskets without max_base_fee
+        :param poll_interval: seconds between two polls of the background thread
+        """
+        if not 0 < window <= 1024:
+            raise ValueError("window must be between 1 and 1024 blocks")
+        self.w3 = w3
+        self.window = window
+        self.target_percentile = target_percentile
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.base_fees: "deque[int]" = deque(maxlen=window)
+        self.next_base_fee: Optional[int] = None
+        self._last_block: Optional[int] = None
+        self._queue: List[DeferredBasket] = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def refresh(self) -> Optional[int]:
+        """
+        Add the base fees of the blocks mined since the last refresh to the window.
+
+        :return: the base fee of the next block
+        """
+        block_number = self.w3.eth.block_number
+        if self._last_block is not None and block_number <= self._last_block:
+            return self.next_base_fee
+        block_count = self.window if self._last_block is None else min(self.window, block_number - self._last_block)
+        fee_history = self.w3.eth.fee_history(block_count, block_number, [])
+        # baseFeePerGas has one more entry than the blocks: the base fee of the next block
+        base_fees = [int(base_fee) for base_fee in fee_history["baseFeePerGas"]]
+        self.base_fees.extend(base_fees[:-1])
+        self.next_base_fee = base_fees[-1]
+        self._last_block = block_number
+        return self.next_base_fee
+
+    def target_base_fee(self) -> Optional[int]:
+        """:return: the target_percentile of the base fees in the window, None while it is empty"""
+        if not self.base_fees:
+            return None
+        base_fees = sorted(self.base_fees)
+        return base_fees[min(len(base_fees) - 1, int(len(base_fees) * self.target_percentile / 100))]
+
+    def submit(
+            self,
+            name: str,
+            execute: Callable[[], Any],
+            priority: int = 0,
+            deadline: float = 3600.0,
+            max_base_fee: Optional[int] = None) -> "Future[Any]":
+        """
+        Queue a basket execution.
+
+        :param name: the name of the basket in the logs
+        :param execute: runs the basket, its return value is the result of the future
+        :param priority: the baskets with a higher priority are released first
+        :param deadline: seconds after which the basket is released whatever the base fee
+        :param max_base_fee: the base fee, in wei, the basket waits for, default to the percentile target
+        :return: a future of the result of execute
+        """
+        with self._lock:
+            basket = DeferredBasket(name, execute, priority, self.clock() + deadline, max_base_fee,
+                                    next(self._sequence))
+            self._queue.append(basket)
+        print(f"Basket {name} deferred, priority {priority}, deadline in {deadline:.0f}s")
+        return basket.result
+
+    def pending(self) -> List[DeferredBasket]:
+        """:return: the queued baskets, in release order"""
+        with self._lock:
+            return sorted(self._queue, key=lambda basket: basket.release_order)
+
+    def poll(self) -> List[DeferredBasket]:
+        """
+        Refresh the base fees, then run every basket whose target is met or whose deadline is passed.
+
+        :return: the released baskets, in the order they were run
+        """
+        try:
+            next_base_fee = self.refresh()
+        except Exception as e:
+            # the baskets past their deadline are still released
+            print(f"Could not refresh the base fees: {e}")
+            next_base_fee = None
+        target = self.target_base_fee()
+        now = self.clock()
+        with self._lock:
+            released, kept = [], []
+            for basket in sorted(self._queue, key=lambda basket: basket.release_order):
+                basket_target = basket.max_base_fee if basket.max_base_fee is not None else target
+                affordable = (next_base_fee is not None and basket_target is not None
+                              and next_base_fee <= basket_target)
+                (released if affordable or now >= basket.deadline else kept).append(basket)
+            self._queue = kept
+
+        for basket in released:
+            reason = "deadline reached" if now >= basket.deadline else "fees eased"
+            print(f"Releasing basket {basket.name} ({reason}): next base fee {next_base_fee}, target "
+                  f"{basket.max_base_fee if basket.max_base_fee is not None else target}")
+            if not basket.result.set_running_or_notify_cancel():
+                continue
+            try:
+                basket.result.set_result(basket.execute())
+            except Exception as e:
+                print(f"Basket {basket.name} failed: {e}")
+                basket.result.set_exception(e)
+        return released
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """Poll in a background thread until stop() is called"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="base-fee-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
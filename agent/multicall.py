@@ -0,0 +1,79 @@
+from typing import Any, List, Optional, Sequence, Tuple
+from eth_abi import decode
+from web3 import Web3
+from web3.types import BlockIdentifier, ChecksumAddress
+from uniswap_functions import FunctionABI, FunctionABIBuilder
+
+# Multicall3 is deployed at the same address on every chain we support
+MULTICALL3_ADDRESS = Web3.to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+
+
+def _build_try_block_and_aggregate() -> FunctionABI:
+    calls = FunctionABIBuilder.create_struct_array("calls").add_address("target").add_bytes("callData")
+    builder = FunctionABIBuilder("tryBlockAndAggregate")
+    return builder.add_bool("requireSuccess").add_struct_array(calls).build()
+
+
+_try_block_and_aggregate = _build_try_block_and_aggregate()
+_try_block_and_aggregate_output_types = ["uint256", "bytes32", "(bool,bytes)[]"]
+
+
+class MulticallCall:
+    """
+    One call to be aggregated: the target contract, the encoded calldata (selector included)
+    and the output types used to decode the returned data.
+    """
+    def __init__(self, target: ChecksumAddress, call_data: bytes, output_types: Sequence[str]) -> None:
+        self.target = Web3.to_checksum_address(target)
+        self.call_data = call_data
+        self.output_types = list(output_types)
+
+    @classmethod
+    def from_function(cls, target: ChecksumAddress, fct_abi: FunctionABI, args: Sequence[Any],
+                      output_types: Sequence[str]) -> "MulticallCall":
+        return cls(target, fct_abi.get_selector() + fct_abi.encode(args), output_types)
+
+
+class Multicall:
+    """
+    Aggregate many read calls into a single eth_call through Multicall3.tryBlockAndAggregate,
+    which also returns the block number the results were computed at.
+    """
+    def __init__(self, w3: Web3, address: ChecksumAddress = MULTICALL3_ADDRESS) -> None:
+        self.w3 = w3
+        self.address = Web3.to_checksum_address(address)
+
+    @staticmethod
+    def encode(calls: Sequence[MulticallCall]) -> bytes:
+        args = (False, [(call.target, call.call_data) for call in calls])
+        return _try_block_and_aggregate.get_selector() + _try_block_and_aggregate.encode(args)
+
+    @staticmethod
+    def decode(calls: Sequence[MulticallCall], raw_result: bytes) -> Tuple[int, List[Optional[Tuple[Any, ...]]]]:
+        block_number, _block_hash, results = decode(_try_block_and_aggregate_output_types, raw_result)
+        decoded: List[Optional[Tuple[Any, ...]]] = []
+        for call, (success, return_data) in zip(calls, results):
+            if not success or not return_data:
+                decoded.append(None)
+                continue
+            try:
+                decoded.append(tuple(decode(call.output_types, return_data)))
+            except Exception:
+                decoded.append(None)
+        return int(block_number), decoded
+
+    def aggregate(
+            self,
+            calls: Sequence[MulticallCall],
+            block_identifier: BlockIdentifier = "latest") -> Tuple[int, List[Optional[Tuple[Any, ...]]]]:
+        """
+        Execute all the calls in one eth_call.
+
+        :param calls: the calls to aggregate
+        :param block_identifier: the block at which the calls are executed
+        :return: the tuple (block_number, results). A result is None if its call reverted.
+        """
+        if not calls:
+            return 0, []
+        raw_result = self.w3.eth.call({"to": self.address, "data": self.encode(calls)}, block_identifier)
+        return self.decode(calls, bytes(raw_result))
@@ -0,0 +1,255 @@
+from dataclasses import dataclass, field
+from fractions import Fraction
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import ChecksumAddress, TxReceipt
+from uniswap_redemption import _transfer_topic
+
+# sends the net buys, (to_token, amount of base token in wei) of each leg -> the transaction hash of each leg
+BuySender = Callable[[List[Tuple[str, int]]], List[Optional[HexBytes]]]
+
+
+@dataclass(frozen=True)
+class FundDelta:
+    """The trade planned by one fund on one token, valued in base token wei: positive to buy, negative to sell"""
+    fund_id: str
+    token: str
+    value: int
+
+
+@dataclass(frozen=True)
+class FundFill:
+    """
+    The share of one fund in the fills of one token: the base token and token amounts it received,
+    negative for the amounts it paid, and the part of its value crossed with the opposite flows of other funds
+    """
+    fund_id: str
+    token: ChecksumAddress
+    base_delta: int
+    token_delta: int
+    crossed_value: int
+
+
+@dataclass
+class NettedToken:
+    """The buys and sells of every fund on one token, with a reference price to cross them"""
+    token: ChecksumAddress
+    buys: Dict[str, int] = field(default_factory=dict)
+    sells: Dict[str, int] = field(default_factory=dict)
+    # a quote of base token -> token: reference_in base token wei give reference_out token wei
+    reference_in: int = 0
+    reference_out: Optional[int] = None
+
+    @property
+    def bought(self) -> int:
+        return sum(self.buys.values())
+
+    @property
+    def sold(self) -> int:
+        return sum(self.sells.values())
+
+    @property
+    def crossed(self) -> int:
+        """The value matched between the funds, never traded on the market"""
+        return min(self.bought, self.sold)
+
+    @property
+    def net(self) -> int:
+        """The value left to trade on the market: positive to buy, negative to sell"""
+        return self.bought - self.sold
+
+    @property
+    def net_token_amount(self) -> Optional[int]:
+        """The token amount to sell for a negative net, at the reference price"""
+        if self.reference_out is None or not self.reference_in:
+            return None
+        return -self.net * self.reference_out // self.reference_in
+
+
+@dataclass
+class NettingPlan:
+    """The netted flows of every token traded by the funds of one rebalance window"""
+    base_token: ChecksumAddress
+    tokens: List[NettedToken]
+
+    @property
+    def buy_legs(self) -> List[Tuple[ChecksumAddress, int]]:
+        """The (token, base token amount) of the net buys"""
+        return [(netted.token, netted.net) for netted in self.tokens
+                if netted.net > 0 and netted.reference_out is not None]
+
+    @property
+    def sell_legs(self) -> List[Tuple[ChecksumAddress, int]]:
+        """The (token, token amount) of the net sells"""
+        return [(netted.token, netted.net_token_amount) for netted in self.tokens
+                if netted.net < 0 and netted.net_token_amount]
+
+    @property
+    def gross_value(self) -> int:
+        return sum(netted.bought + netted.sold for netted in self.tokens)
+
+    @property
+    def crossed_value(self) -> int:
+        """The value of the trades avoided, both sides of every internal cross"""
+        return sum(2 * netted.crossed for netted in self.tokens)
+
+
+def transferred_amounts(receipt: TxReceipt, token: str, owner: str) -> Tuple[int, int]:
+    """:return: the tuple (amount of token sent by owner, amount of token received by owner) in the receipt"""
+    token = Web3.to_checksum_address(token)
+    owner_topic = HexBytes(bytes(12) + bytes.fromhex(Web3.to_checksum_address(owner)[2:]))
+    sent = received = 0
+    for log in receipt["logs"]:
+        topics = [HexBytes(topic) for topic in log["topics"]]
+        if len(topics) != 3 or topics[0] != _transfer_topic or Web3.to_checksum_address(log["address"]) != token:
+            continue
+        amount = int.from_bytes(HexBytes(log["data"]), "big")
+        if topics[1] == owner_topic:
+            sent += amount
+        if topics[2] == owner_topic:
+            received += amount
+    return sent, received
+
+
+def _pro_rata(total: int, weights: Sequence[int]) -> List[int]:
+    """:return: total split in proportion to the weights, rounded down cumulatively so the parts sum to total"""
+    weight_sum = sum(weights)
+    parts, cumulated, allocated = [], 0, 0
+    for weight in weights:
+        cumulated += weight
+        part = total * cumulated // weight_sum - allocated
+        parts.append(part)
+        allocated += part
+    return parts
+
+
+def attribute_fills(netted: NettedToken, fill_base: int = 0, fill_token: int = 0) -> List[FundFill]:
+    """
+    Share the crossed flows and the fill of the net trade of one token between the funds.
+    Every fund trades at the same price: the one of the net fill, or the reference price if the net was nothing
+    or failed. The funds on the lighter side are filled in full by the crosses, the funds on the heavier side share
+    the crosses and the net fill pro rata of their value, so a failed net trade only leaves their excess unfilled.
+    The shares are rounded so that the fills of all the funds sum exactly to the net fill.
+
+    :param fill_base: the base token spent by a net buy or received by a net sell
+    :param fill_token: the token received by a net buy or sold by a net sell
+    """
+    if fill_base and fill_token:
+        price = Fraction(fill_token, fill_base)
+    elif netted.reference_out is not None and netted.reference_in:
+        price = Fraction(netted.reference_out, netted.reference_in)
+    else:
+        return []
+    bought, sold = netted.bought, netted.sold
+    # the lighter side is crossed in full, its sign is the one of a seller's deltas
+    lighter, heavier, sign = (netted.sells, netted.buys, 1) if bought >= sold else (netted.buys, netted.sells, -1)
+    crossed = min(bought, sold)
+    fills = []
+    crossed_token = 0
+    for fund_id, value in lighter.items():
+        token_amount = int(value * price)
+        crossed_token += token_amount
+        fills.append(FundFill(fund_id, netted.token, sign * value, -sign * token_amount, value))
+    values = list(heavier.values())
+    for fund_id, base_amount, token_amount, crossed_value in zip(
+            heavier, _pro_rata(crossed + fill_base, values), _pro_rata(crossed_token + fill_token, values),
+            _pro_rata(crossed, values)):
+        fills.append(FundFill(fund_id, netted.token, -sign * base_amount, sign * token_amount, crossed_value))
+    return fills
+
+
+class NettingEngine:
+    """
+    Net the trades planned by several funds sharing one wallet in the same rebalance window.
+    The buys and sells of a token by different funds cancel out internally, only the net flow of each token
+    is sent: the net buys as one basket from the base token, the net sells one swap each.
+    The fills are then attributed back to every fund, all of them at the price of the net fill.
+    """
+    def __init__(self, uniswap: Any, base_token: str, fee: int = 2000, slippage: float = 0.5) -> None:
+        """
+        :param uniswap: the Uniswap client of the shared wallet
+        :param base_token: the token the deltas are valued in and paid with
+        """
+        self.uniswap = uniswap
+        self.base_token = Web3.to_checksum_address(base_token)
+        self.fee = fee
+        self.slippage = slippage
+
+    def plan(self, deltas: Sequence[FundDelta]) -> NettingPlan:
+        """
+        Net the deltas of every fund, token by token, and quote the reference price of every token in one batch.
+
+        :param deltas: the planned trades of all the funds
+        """
+        by_token: Dict[ChecksumAddress, NettedToken] = {}
+        for delta in deltas:
+            if not delta.value:
+                continue
+            token = Web3.to_checksum_address(delta.token)
+            netted = by_token.setdefault(token, NettedToken(token))
+            side = netted.buys if delta.value > 0 else netted.sells
+            side[delta.fund_id] = side.get(delta.fund_id, 0) + abs(delta.value)
+
+        tokens = list(by_token.values())
+        for netted in tokens:
+            # the net is quoted at its own size, a full cross at the size of the cross
+            netted.reference_in = abs(netted.net) or netted.crossed
+        quotes = self.uniswap.quote_min_amounts_out(
+            self.base_token, [(netted.token, netted.reference_in) for netted in tokens], self.fee, 0)
+        for netted, amount_out in zip(tokens, quotes):
+            netted.reference_out = amount_out
+            if amount_out is None:
+                print(f"No quote for {netted.token}, its flows are not traded")
+            else:
+                print(f"{netted.token}: {netted.bought} bought, {netted.sold} sold, {netted.crossed} crossed, "
+                      f"net {netted.net}")
+        plan = NettingPlan(self.base_token, tokens)
+        print(f"Netting: {plan.crossed_value} of {plan.gross_value} gross value crossed internally")
+        return plan
+
+    def execute(
+            self,
+            plan: NettingPlan,
+            send_buys: Optional[BuySender] = None,
+            timeout: float = 120) -> Tuple[Dict[ChecksumAddress, Optional[HexBytes]], List[FundFill]]:
+        """
+        Send the net trades of the plan, wait for them and attribute the fills to the funds.
+
+        :param send_buys: sends the net buys, default to make_trades from the base token
+        :return: the tuple (transaction hash of the net trade of each token, fills of every fund)
+        """
+        buy_legs, sell_legs = plan.buy_legs, plan.sell_legs
+        if send_buys is None:
+            send_buys = lambda legs: self.uniswap.make_trades(self.base_token, legs, self.fee, self.slippage)
+        buy_hashes = send_buys(buy_legs) if buy_legs else []
+        sell_hashes = []
+        for token, amount in sell_legs:
+            try:
+                sell_hashes.append(self.uniswap.make_trade(
+                    token, self.base_token, amount, self.fee, self.slippage, pool_version="v4"))
+            except Exception as e:
+                print(f"Net sell of {token} failed: {e}")
+                sell_hashes.append(None)
+
+        tx_hashes = dict(zip([token for token, _amount in buy_legs + sell_legs], buy_hashes + sell_hashes))
+        sent = [(token, tx_hash) for token, tx_hash in tx_hashes.items() if tx_hash]
+        receipts = self.uniswap.receipt_watcher.wait_all([tx_hash for _token, tx_hash in sent], timeout=timeout)
+        receipts_by_token = dict(zip([token for token, _tx_hash in sent], receipts))
+
+        owner = self.uniswap.address
+        fills = []
+        for netted in plan.tokens:
+            receipt = receipts_by_token.get(netted.token)
+            fill_base = fill_token = 0
+            if receipt and receipt["status"] == 1:
+                base_sent, base_received = transferred_amounts(receipt, self.base_token, owner)
+                token_sent, token_received = transferred_amounts(receipt, netted.token, owner)
+                if netted.net > 0:
+                    fill_base, fill_token = base_sent, token_received
+                else:
+                    fill_base, fill_token = base_received, token_sent
+            elif netted.net:
+                print(f"Net trade of {netted.token} not filled, only its crossed flows are attributed")
+            fills.extend(attribute_fills(netted, fill_base, fill_token))
+        return tx_hashes, fills
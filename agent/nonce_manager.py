@@ -0,0 +1,55 @@
+import threading
+from typing import Optional
+from web3 import Web3
+from web3.types import ChecksumAddress
+
+
+class NonceManager:
+    """
+    Local nonce counter of one account, so transactions can be sent back to back without waiting for
+    each one to be mined: every send takes the next nonce instead of reading the account nonce again.
+    The counter starts from the pending nonce of the node and never goes back to a nonce handed out since:
+    a nonce allocated but never broadcast is only reused if it was the last one allocated, otherwise
+    the caller fills the gap, ex: with a cancellation, so the following nonces are not blocked.
+    """
+    def __init__(self, w3: Web3, address: ChecksumAddress) -> None:
+        self.w3 = w3
+        self.address = Web3.to_checksum_address(address)
+        self._lock = threading.Lock()
+        self._next_nonce: Optional[int] = None
+
+    def allocate(self) -> int:
+        """:return: the next unused nonce"""
+        with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = self.w3.eth.get_transaction_count(self.address, "pending")
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
+
+    def release(self, nonce: int) -> bool:
+        """
+        Give back a nonce that was allocated but not broadcast, ex: after a send failed.
+
+        :return: True if it was the last nonce allocated and is allocated again next, False if later nonces
+            were handed out meanwhile: the counter is left alone and the caller must fill the gap
+        """
+        with self._lock:
+            if self._next_nonce is not None and nonce == self._next_nonce - 1:
+                self._next_nonce = nonce
+                return True
+            return False
+
+    def resync(self) -> None:
+        """
+        Move forward to the pending nonce of the node if it is ahead, ex: nonces used by another client.
+        The counter is never moved back, the nonces held by other senders are not handed out twice.
+        """
+        pending_nonce = self.w3.eth.get_transaction_count(self.address, "pending")
+        with self._lock:
+            if self._next_nonce is None or pending_nonce > self._next_nonce:
+                self._next_nonce = pending_nonce
+
+    def peek(self) -> Optional[int]:
+        with self._lock:
+            return self._next_nonce
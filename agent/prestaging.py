@@ -0,0 +1,259 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from uniswap_functions import GasShape, TransactionSpeed
+from uniswap_universal_router import _pipelined_gas_limit
+
+# (to_token, amount in wei) of each leg, and the pool version of each leg
+BasketTargets = Tuple[str, Tuple[Tuple[str, int], ...], Tuple[str, ...]]
+
+
+@dataclass
+class StagedLeg:
+    """One leg built and signed ahead of time, with the nonce it is expected to get"""
+    leg_index: int
+    trx_params: Dict[str, Any]
+    signed_tx: Any
+    gas_shape: Optional[GasShape]
+    include_permit: bool
+
+
+@dataclass
+class StagedBasket:
+    """The calldata, nonces and signatures of the next basket, valid while the targets and the token state match"""
+    targets: BasketTargets
+    token_ready: bool
+    built_at: float
+    legs: List[Optional[StagedLeg]] = field(default_factory=list)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.built_at
+
+
+class TransactionStager:
+    """
+    Keep the next basket ready to broadcast. Whenever the targets change, and again when the staged basket
+    gets old, a background thread does the whole slow path of make_trade for every leg: balance and allowance
+    checks, Permit2 approval, permit signature, quotes, deadline, fees, gas and signature, with the nonces
+    the legs are expected to get.
+    fire() then only allocates the nonces and broadcasts the signed transactions in one batch. A leg is signed
+    again, locally, if its nonce was taken by another transaction meanwhile or if the fees are refreshed.
+    A staged basket is not used if the targets changed or if the router allowance of the token changed
+    since it was built: it is built again on the spot.
+    """
+    def __init__(
+            self,
+            uniswap: Any,
+            fee: int = 2000,
+            slippage: float = 0.5,
+            max_age: float = 60.0,
+            trx_speed: TransactionSpeed = TransactionSpeed.FAST) -> None:
+        """
+        :param uniswap: the Uniswap client sending the baskets
+        :param slippage: slippage tolerance of each leg, in percent of its quote at staging time
+        :param max_age: seconds after which a staged basket is built again, well under the 180 seconds
+            a permit signature is valid and the 300 seconds deadline of the swaps
+        :param trx_speed: the speed of the fees, when they are refreshed by fire()
+        """
+        self.uniswap = uniswap
+        self.fee = fee
+        self.slippage = slippage
+        self.max_age = max_age
+        self.trx_speed = trx_speed
+        self._targets: Optional[BasketTargets] = None
+        self._staged: Optional[StagedBasket] = None
+        self._lock = threading.Lock()
+        # serializes the builds of the background thread and of fire()
+        self._build_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def update_targets(
+            self,
+            from_token: str,
+            legs: Sequence[Tuple[str, int]],
+            pool_versions: Optional[Sequence[str]] = None) -> None:
+        """
+        Set the next basket, it is staged in the background.
+
+        :param legs: the (to_token, amount in wei) of each leg
+        :param pool_versions: the pool version of each leg, "v4" by default
+        """
+        targets = (
+            Web3.to_checksum_address(from_token),
+            tuple((Web3.to_checksum_address(to_token), int(amount)) for to_token, amount in legs),
+            tuple(pool_versions) if pool_versions else ("v4",) * len(legs),
+        )
+        with self._lock:
+            self._targets = targets
+        self._changed.set()
+
+    @property
+    def targets(self) -> Optional[BasketTargets]:
+        """The (from_token, legs, pool versions) of the next basket"""
+        with self._lock:
+            return self._targets
+
+    def staged(self) -> Optional[StagedBasket]:
+        """:return: the staged basket if it can still be fired as is"""
+        with self._lock:
+            staged, targets = self._staged, self._targets
+        if staged is None or staged.targets != targets or staged.age > self.max_age:
+            return None
+        if staged.token_ready != self.uniswap._is_token_ready(targets[0]):
+            return None
+        return staged
+
+    def stage(self, targets: BasketTargets) -> StagedBasket:
+        """
+        Build and sign every leg of the basket, without sending anything but a missing Permit2 approval.
+
+        :return: the staged basket, its legs are None when they could not be built or paid for
+        """
+        from_token, legs, pool_versions = targets
+        uniswap = self.uniswap
+        with self._build_lock:
+            uniswap.ensure_ready()
+            if not uniswap._is_permit2_approved(from_token):
+                uniswap.approve_permit2_many([from_token])
+            token_ready = uniswap._is_token_ready(from_token) or uniswap.has_router_allowance(from_token)
+            staged = StagedBasket(targets, token_ready, time.monotonic(), [None] * len(legs))
+
+            balance = uniswap.get_token_balances([from_token])[0]
+            next_nonce = uniswap.nonce_manager.peek()
+            if next_nonce is None:
+                next_nonce = uniswap.w3.eth.get_transaction_count(uniswap.account.address, "pending")
+            include_permit = not token_ready
+            for index, (to_token, amount) in enumerate(legs):
+                if amount > balance:
+                    print(f"Not staging the swap to {to_token}: {balance} left, {amount} needed")
+                    continue
+                # only the first leg carries the permit, the following ones can't be estimated before it is mined
+                pipelined = not include_permit and not uniswap._router_allowance_mined(from_token)
+                built = uniswap.build_trade(
+                    from_token, to_token, amount, self.fee, self.slippage, pool_versions[index],
+                    gas_limit=_pipelined_gas_limit if pipelined else None, include_permit=include_permit)
+                if built is None:
+                    continue
+                trx_params, gas_shape = built
+                trx_params = {**trx_params, "nonce": next_nonce}
+                signed_tx = uniswap.w3.eth.account.sign_transaction(trx_params, uniswap.account.key)
+                staged.legs[index] = StagedLeg(index, trx_params, signed_tx, gas_shape, include_permit)
+                balance -= amount
+                next_nonce += 1
+                include_permit = False
+
+            gas_cost = sum(leg.trx_params["gas"] * leg.trx_params["maxFeePerGas"] for leg in staged.legs if leg)
+            if uniswap.w3.eth.get_balance(uniswap.account.address) < gas_cost:
+                print(f"Insufficient ETH balance for the gas of the staged basket: "
+                      f"{Web3.from_wei(gas_cost, 'ether')} ETH needed")
+                staged.legs = [None] * len(legs)
+
+            print(f"Staged {sum(1 for leg in staged.legs if leg)}/{len(legs)} legs")
+            with self._lock:
+                if self._targets == targets:
+                    self._staged = staged
+            return staged
+
+    def fire(
+            self,
+            refresh_fees: bool = False,
+            on_signed: Optional[Callable[[int, HexBytes, int, Dict[str, Any]], None]] = None,
+            targets: Optional[BasketTargets] = None) -> List[Optional[HexBytes]]:
+        """
+        Broadcast the staged basket, staging it first if it is missing or stale, or if the balance of the token
+        sold no longer pays for its legs. The minimum outputs are not quoted again: they come from quotes up to
+        max_age seconds old, a price move within that window is only bounded by the slippage.
+
+        :param targets: the basket expected by the caller, ex: already journaled, default to the current targets
+        :param refresh_fees: sign the legs again with the fees of the latest block
+        :param on_signed: called with the leg index, transaction hash, nonce and parameters of each leg
+            before it is broadcast
+        :return: the transaction hash of each leg, None for the legs that were not sent
+        """
+        staged = self.staged()
+        if staged is None or (targets is not None and staged.targets != targets):
+            targets = targets or self.targets
+            if targets is None:
+                raise ValueError("No basket to fire, set the targets first")
+            print("No staged basket for the targets, staging it now")
+            staged = self.stage(targets)
+        elif not self._balance_covers(staged):
+            print("The balance changed since the basket was staged, staging it again")
+            staged = self.stage(staged.targets)
+        with self._lock:
+            # a staged basket is fired once, the next one needs new targets
+            self._staged, self._targets = None, None
+
+        uniswap = self.uniswap
+        fees = {}
+        if refresh_fees:
+            priority_fee, max_fee_per_gas = uniswap.fee_oracle.gas_fees(self.trx_speed)
+            fees = {"maxPriorityFeePerGas": priority_fee, "maxFeePerGas": max_fee_per_gas}
+
+        transactions, sent_legs, nonces = [], [], []
+        try:
+            for leg in staged.legs:
+                if leg is None:
+                    continue
+                nonce = uniswap.nonce_manager.allocate()
+                nonces.append(nonce)
+                trx_params, signed_tx = leg.trx_params, leg.signed_tx
+                if nonce != trx_params["nonce"] or fees:
+                    trx_params = {**trx_params, **fees, "nonce": nonce}
+                    signed_tx = uniswap.w3.eth.account.sign_transaction(trx_params, uniswap.account.key)
+                if on_signed:
+                    on_signed(leg.leg_index, signed_tx.hash, nonce, trx_params)
+                permit_token = staged.targets[0] if leg.include_permit else None
+                transactions.append((trx_params, signed_tx, leg.gas_shape, permit_token))
+                sent_legs.append(leg.leg_index)
+        except Exception:
+            # nothing was broadcast, the allocated nonces are given back, or cancelled if others were taken since
+            uniswap.release_nonces(nonces)
+            raise
+
+        tx_hashes: List[Optional[HexBytes]] = [None] * len(staged.legs)
+        for leg_index, tx_hash in zip(sent_legs, uniswap.send_signed_transactions(transactions)):
+            tx_hashes[leg_index] = tx_hash
+        return tx_hashes
+
+    def _balance_covers(self, staged: StagedBasket) -> bool:
+        """:return: True if the balance of the token sold still pays for every staged leg"""
+        from_token, legs, _pool_versions = staged.targets
+        needed = sum(legs[leg.leg_index][1] for leg in staged.legs if leg)
+        return self.uniswap.get_token_balances([from_token])[0] >= needed
+
+    def _run(self, poll_interval: float) -> None:
+        while not self._stop.is_set():
+            self._changed.wait(poll_interval)
+            self._changed.clear()
+            if self._stop.is_set():
+                break
+            with self._lock:
+                targets = self._targets
+            if targets is None or self.staged() is not None:
+                continue
+            try:
+                self.stage(targets)
+            except Exception as e:
+                print(f"Staging failed: {e}")
+
+    def start(self, poll_interval: float = 5.0) -> None:
+        """Keep the next basket staged from a background thread until stop() is called"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(poll_interval,), name="basket-stager", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
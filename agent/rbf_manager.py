@@ -0,0 +1,272 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from eth_account.signers.local import LocalAccount
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import Wei
+from receipt_watcher import ReceiptWatcher
+from uniswap_functions import FeeOracle, TransactionSpeed
+
+# Nodes only accept a replacement paying at least 10% more on both fee fields
+MIN_BUMP_PERCENT = 10
+# A cancellation of a transaction that can't be read from the node pays this multiple of the base fee,
+# high enough to outbid whatever fees it was sent with
+UNKNOWN_TX_BASE_FEE_MULTIPLIER = 8
+
+
+def _to_int(value: Any) -> int:
+    """The raw JSON-RPC results are hex strings"""
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+@dataclass
+class PendingTransaction:
+    """A transaction sent by this client and not mined yet, with every hash it was sent under"""
+    tx_params: Dict[str, Any]
+    tx_hashes: List[HexBytes]
+    sent_at: float
+    bumps: int = 0
+    cancelled: bool = False
+
+    @property
+    def nonce(self) -> int:
+        return int(self.tx_params["nonce"])
+
+
+class ReplacementManager:
+    """
+    Replace-by-fee manager for the transactions of one account.
+    Every nonce the client sends is tracked in the background. A transaction still pending after bump_after
+    seconds is re-signed with the same content and higher fees, on a schedule. Only after max_bumps replacements
+    the nonce is cancelled, with a 0 ETH transfer to self. Many stuck nonces are handled at once.
+    """
+    def __init__(
+            self,
+            w3: Web3,
+            account: LocalAccount,
+            fee_oracle: FeeOracle,
+            receipt_watcher: Optional[ReceiptWatcher] = None,
+            bump_after: float = 30.0,
+            bump_percent: int = 15,
+            max_bumps: int = 4,
+            max_fee_per_gas_limit: Wei = Wei(100 * 10 ** 9),
+            poll_interval: float = 2.0) -> None:
+        """
+        :param bump_after: seconds a transaction may stay pending before it is replaced
+        :param bump_percent: fee increase of each replacement, at least MIN_BUMP_PERCENT
+        :param max_bumps: replacements sent before the nonce is cancelled
+        :param max_fee_per_gas_limit: the max fee per gas is never bumped above this value
+        """
+        self.w3 = w3
+        self.account = account
+        self.fee_oracle = fee_oracle
+        self.receipt_watcher = receipt_watcher
+        self.bump_after = bump_after
+        self.bump_percent = max(bump_percent, MIN_BUMP_PERCENT)
+        self.max_bumps = max_bumps
+        self.max_fee_per_gas_limit = max_fee_per_gas_limit
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pending: Dict[int, PendingTransaction] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def track(self, tx_params: Dict[str, Any], tx_hash: HexBytes) -> None:
+        """
+        Start watching a sent transaction.
+
+        :param tx_params: the exact parameters the transaction was signed with
+        :param tx_hash: the hash of the sent transaction
+        """
+        pending = PendingTransaction(dict(tx_params), [HexBytes(tx_hash)], time.monotonic())
+        with self._lock:
+            self._pending[pending.nonce] = pending
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rbf-manager", daemon=True)
+                self._thread.start()
+
+    def pending_nonces(self) -> List[int]:
+        with self._lock:
+            return sorted(self._pending)
+
+    def _bumped(self, value: int) -> int:
+        return value * (100 + self.bump_percent) // 100 + 1
+
+    def _replacement_fees(self, tx_params: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """
+        :return: fees paying at least bump_percent more than tx_params and at least the current FASTER fees,
+        None if they would exceed max_fee_per_gas_limit
+        """
+        priority_fee, max_fee_per_gas = self.fee_oracle.gas_fees(TransactionSpeed.FASTER)
+        new_priority_fee = max(self._bumped(tx_params["maxPriorityFeePerGas"]), priority_fee)
+        new_max_fee_per_gas = max(self._bumped(tx_params["maxFeePerGas"]), max_fee_per_gas, new_priority_fee)
+        if new_max_fee_per_gas > self.max_fee_per_gas_limit:
+            return None
+        return {"maxPriorityFeePerGas": new_priority_fee, "maxFeePerGas": new_max_fee_per_gas}
+
+    def _sent_fees(self, nonce: int) -> Optional[Dict[str, int]]:
+        """
+        Read the transaction of the account pending with this nonce from the node,
+        with eth_getTransactionBySenderAndNonce or else from the txpool.
+
+        :return: the fees it was sent with, None if the node does not know it
+        """
+        tx = None
+        try:
+            tx = self.w3.manager.request_blocking(
+                "eth_getTransactionBySenderAndNonce", [self.account.address, hex(nonce)])
+        except Exception:
+            try:
+                content = self.w3.manager.request_blocking("txpool_contentFrom", [self.account.address])
+                tx = (content.get("pending") or {}).get(str(nonce)) or (content.get("queued") or {}).get(str(nonce))
+            except Exception as e:
+                print(f"Nonce {nonce}: could not read the pending transaction: {e}")
+        if not tx or tx.get("blockHash"):
+            return None
+        # a legacy transaction pays gasPrice for both fee fields
+        priority_fee = tx.get("maxPriorityFeePerGas", tx.get("gasPrice"))
+        max_fee_per_gas = tx.get("maxFeePerGas", tx.get("gasPrice"))
+        if priority_fee is None or max_fee_per_gas is None:
+            return None
+        return {
+            "maxPriorityFeePerGas": _to_int(priority_fee),
+            "maxFeePerGas": _to_int(max_fee_per_gas),
+        }
+
+    def _sign_and_send(self, tx_params: Dict[str, Any]) -> Optional[HexBytes]:
+        try:
+            signed_tx = self.account.sign_transaction(tx_params)
+            return self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception as e:
+            print(f"Error sending transaction with nonce {tx_params['nonce']}: {e}")
+            return None
+
+    def _send(
+            self,
+            pending: PendingTransaction,
+            tx_params: Dict[str, Any],
+            cancellation: bool = False) -> Optional[HexBytes]:
+        tx_hash = self._sign_and_send(tx_params)
+        if tx_hash is None:
+            return None
+        if self.receipt_watcher:
+            # a mined cancellation resolves the original transaction as a failure, not with its own receipt
+            self.receipt_watcher.replace(pending.tx_hashes[0], tx_hash, cancellation=cancellation or pending.cancelled)
+        pending.tx_hashes.append(HexBytes(tx_hash))
+        pending.tx_params = tx_params
+        pending.sent_at = time.monotonic()
+        return tx_hash
+
+    def bump(self, pending: PendingTransaction) -> Optional[HexBytes]:
+        """
+        Re-sign the original transaction with higher fees.
+
+        :return: the hash of the replacement, None if it could not be sent
+        """
+        fees = self._replacement_fees(pending.tx_params)
+        if fees is None:
+            print(f"Nonce {pending.nonce}: replacement fees would exceed the limit")
+            return None
+        tx_hash = self._send(pending, {**pending.tx_params, **fees})
+        if tx_hash:
+            pending.bumps += 1
+            print(f"Nonce {pending.nonce}: replacement #{pending.bumps} sent, "
+                  f"max fee {Web3.from_wei(fees['maxFeePerGas'], 'gwei')} gwei, hash {tx_hash.hex()}")
+        return tx_hash
+
+    def cancel(self, nonce: int, previous_tx_params: Optional[Dict[str, Any]] = None) -> Optional[HexBytes]:
+        """
+        Cancel a nonce with a 0 ETH transfer to self.
+
+        :param nonce: the nonce to cancel
+        :param previous_tx_params: the last parameters sent with this nonce, if known, so the cancellation outbids them
+        :return: the hash of the cancellation, None if it could not be sent
+        """
+        gas_limit = 21000
+        # without previous_tx_params, ex: a nonce stuck by a previous run, outbid the transaction the node holds
+        sent_fees = previous_tx_params or self._sent_fees(nonce)
+        if sent_fees:
+            fees = self._replacement_fees(sent_fees)
+            if fees is None:
+                print(f"Nonce {nonce}: cancellation fees would exceed the limit")
+                return None
+        else:
+            # its fees are unknown: pay well above the base fee to outbid them
+            sample = self.fee_oracle.sample()
+            priority_fee, max_fee_per_gas = sample.gas_fees(
+                TransactionSpeed.FASTER, self.fee_oracle.base_fee_multiplier)
+            fees = {
+                "maxPriorityFeePerGas": max(priority_fee, Web3.to_wei(0.005, "gwei")),
+                "maxFeePerGas": max(
+                    sample.next_base_fee * UNKNOWN_TX_BASE_FEE_MULTIPLIER + priority_fee, max_fee_per_gas,
+                    Web3.to_wei(0.1, "gwei")),
+            }
+
+        balance = self.w3.eth.get_balance(self.account.address)
+        if balance < gas_limit * fees["maxFeePerGas"]:
+            print(f"ERROR: Insufficient balance to cancel nonce {nonce}!")
+            return None
+
+        cancel_tx = {
+            "from": self.account.address,
+            "to": self.account.address,
+            "value": 0,
+            "gas": gas_limit,
+            "type": 2,
+            "chainId": previous_tx_params["chainId"] if previous_tx_params else self.w3.eth.chain_id,
+            "nonce": nonce,
+            **fees,
+        }
+        with self._lock:
+            pending = self._pending.get(nonce)
+        if pending:
+            tx_hash = self._send(pending, cancel_tx, cancellation=True)
+            if tx_hash:
+                with self._lock:
+                    pending.cancelled = True
+        else:
+            # a nonce from a previous run: keep bumping the cancellation itself if it gets stuck too
+            tx_hash = self._sign_and_send(cancel_tx)
+            if tx_hash:
+                self.track(cancel_tx, tx_hash)
+                with self._lock:
+                    # check() may already have forgotten the nonce if the cancellation was mined
+                    pending = self._pending.get(nonce)
+                    if pending:
+                        pending.cancelled = True
+        if tx_hash:
+            print(f"Nonce {nonce}: cancellation sent, hash {tx_hash.hex()}")
+        return tx_hash
+
+    def check(self) -> None:
+        """
+        Run one step: forget the mined nonces, replace or cancel the ones pending for too long
+        """
+        mined_nonce = self.w3.eth.get_transaction_count(self.account.address, "latest")
+        now = time.monotonic()
+        with self._lock:
+            for nonce in [nonce for nonce in self._pending if nonce < mined_nonce]:
+                del self._pending[nonce]
+            overdue = [pending for pending in self._pending.values() if now - pending.sent_at >= self.bump_after]
+
+        for pending in sorted(overdue, key=lambda p: p.nonce):
+            if pending.cancelled or pending.bumps < self.max_bumps:
+                self.bump(pending)
+            else:
+                # last resort: the original intent is dropped
+                self.cancel(pending.nonce, pending.tx_params)
+            # wait a full period before the next attempt, even if this one failed
+            pending.sent_at = now
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+            time.sleep(self.poll_interval)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Error checking pending transactions: {e}")
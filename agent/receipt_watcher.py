@@ -0,0 +1,214 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Union
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.method_formatters import receipt_formatter
+from web3.types import TxReceipt
+from web3_rpc import batch_request
+
+ReceiptCallback = Callable[[TxReceipt], None]
+
+
+def cancelled_receipt(receipt: TxReceipt) -> Dict[str, Any]:
+    """
+    :param receipt: the receipt of the cancellation of a transaction, a 0 ETH transfer to self
+    :return: the receipt the cancelled transaction resolves with: a failure, flagged as cancelled
+    """
+    return {**receipt, "status": 0, "cancelled": True}
+
+
+class ReceiptWatcher:
+    """
+    Track many in-flight transactions at once.
+    On each new block, the receipts of every pending transaction are fetched with one batched RPC request,
+    and the matching futures and callbacks are resolved as transactions confirm.
+    A transaction not mined within max_age seconds of its last send is dropped: its future gets a TimeoutError.
+    """
+    def __init__(self, w3: Web3, poll_interval: float = 1.0, max_age: float = 900.0) -> None:
+        """
+        :param max_age: seconds a transaction and its replacements are watched after the last of them was sent
+        """
+        self.w3 = w3
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._callbacks: Dict[str, List[ReceiptCallback]] = {}
+        # every hash of a transaction and of its replacements share one future
+        self._aliases: Dict[str, List[str]] = {}
+        # the replacements that cancel the original transaction instead of sending it again
+        self._cancellations: Set[str] = set()
+        # the time a transaction and its replacements expire at, for each of their hashes
+        self._expires_at: Dict[str, float] = {}
+        self._last_block: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _key(tx_hash: Union[HexBytes, str]) -> str:
+        return HexBytes(tx_hash).hex() if not isinstance(tx_hash, str) else tx_hash.lower()
+
+    def watch(self, tx_hash: Union[HexBytes, str], callback: Optional[ReceiptCallback] = None) -> Future:
+        """
+        Start tracking a transaction.
+
+        :param tx_hash: the hash of the sent transaction
+        :param callback: optional function called with the receipt once the transaction is mined
+        :return: a future resolved with the receipt once the transaction is mined
+        """
+        key = self._key(tx_hash)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = Future()
+                self._pending[key] = future
+                self._callbacks[key] = []
+                self._aliases[key] = [key]
+                self._expires_at[key] = time.monotonic() + self.max_age
+            if callback:
+                self._callbacks[key].append(callback)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="receipt-watcher", daemon=True)
+                self._thread.start()
+        return future
+
+    def replace(
+            self,
+            tx_hash: Union[HexBytes, str],
+            new_tx_hash: Union[HexBytes, str],
+            cancellation: bool = False) -> Future:
+        """
+        Track the replacement of a transaction (same nonce, higher fees). The future and the callbacks
+        of the original transaction are resolved by the receipt of whichever of them is mined.
+
+        :param cancellation: the replacement cancels the transaction: if it is mined, the future and the callbacks
+        get a cancelled_receipt, a failure, instead of its receipt
+        :return: the shared future
+        """
+        key, new_key = self._key(tx_hash), self._key(new_tx_hash)
+        future = self.watch(tx_hash)
+        with self._lock:
+            if key in self._pending and new_key not in self._pending:
+                aliases = self._aliases[key]
+                aliases.append(new_key)
+                self._pending[new_key] = future
+                self._callbacks[new_key] = self._callbacks[key]
+                self._aliases[new_key] = aliases
+                if cancellation:
+                    self._cancellations.add(new_key)
+                # the replacement was just sent, it gets a full max_age to be mined
+                expires_at = time.monotonic() + self.max_age
+                for alias in aliases:
+                    self._expires_at[alias] = expires_at
+        return future
+
+    def wait(self, tx_hash: Union[HexBytes, str], timeout: Optional[float] = 60) -> TxReceipt:
+        """
+        :return: the receipt of the transaction, raise a TimeoutError if it is not mined within timeout seconds
+        """
+        return self.watch(tx_hash).result(timeout=timeout)
+
+    def wait_all(self, tx_hashes: Sequence[Union[HexBytes, str]], timeout: Optional[float] = 60) -> List[Optional[TxReceipt]]:
+        """
+        :return: the receipts of all the transactions, None for those not mined within timeout seconds
+        """
+        futures = [self.watch(tx_hash) for tx_hash in tx_hashes]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        receipts = []
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                receipts.append(future.result(timeout=remaining))
+            except TimeoutError:
+                receipts.append(None)
+        return receipts
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _forget(self, key: str) -> None:
+        """Stop tracking a transaction and all its replacements, the lock must be held"""
+        for alias in self._aliases.pop(key, [key]):
+            self._pending.pop(alias, None)
+            self._callbacks.pop(alias, None)
+            self._aliases.pop(alias, None)
+            self._cancellations.discard(alias)
+            self._expires_at.pop(alias, None)
+
+    def expire(self) -> int:
+        """
+        Drop the transactions not mined within max_age seconds, their futures get a TimeoutError
+
+        :return: the number of expired transactions
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key in [key for key, expires_at in self._expires_at.items() if expires_at <= now]:
+                if key in self._pending:
+                    expired.append((key, self._pending[key]))
+                    self._forget(key)
+        for key, future in expired:
+            if not future.done():
+                future.set_exception(TimeoutError(f"Transaction {key} not mined within {self.max_age} seconds"))
+        return len(expired)
+
+    def poll(self) -> int:
+        """
+        Run one polling step: if a new block has been mined, fetch the receipts of all the pending transactions
+        in one batch and resolve the confirmed ones. Then drop the transactions older than max_age.
+
+        :return: the number of transactions resolved by this step
+        """
+        try:
+            return self._poll_receipts()
+        finally:
+            self.expire()
+
+    def _poll_receipts(self) -> int:
+        block_number = self.w3.eth.block_number
+        if block_number == self._last_block:
+            return 0
+        self._last_block = block_number
+
+        with self._lock:
+            keys = list(self._pending)
+        if not keys:
+            return 0
+
+        raw_receipts = batch_request(self.w3, [("eth_getTransactionReceipt", [key]) for key in keys])
+        resolved = 0
+        for key, raw_receipt in zip(keys, raw_receipts):
+            if not raw_receipt:
+                continue
+            receipt = receipt_formatter(raw_receipt)
+            with self._lock:
+                future = self._pending.pop(key, None)
+                callbacks = self._callbacks.pop(key, [])
+                if key in self._cancellations:
+                    receipt = cancelled_receipt(receipt)
+                self._forget(key)
+            if future is None or future.done():
+                continue
+            for callback in callbacks:
+                try:
+                    callback(receipt)
+                except Exception as e:
+                    print(f"Error in receipt callback for {key}: {e}")
+            future.set_result(receipt)
+            resolved += 1
+        return resolved
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling receipts: {e}")
+            time.sleep(self.poll_interval)
@@ -0,0 +1,143 @@
+"""Tests of the execution journal: leg states and reconciliation of interrupted baskets against a stubbed chain"""
+
+from typing import Any, Dict, List, Optional
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from execution_journal import (
+    CONFIRMED, DROPPED, FAILED, INTENT, REPLACED, SIGNED, SKIPPED, ExecutionJournal, call_fingerprint,
+)
+
+SENDER = Web3.to_checksum_address("0x" + "11" * 20)
+ROUTER = Web3.to_checksum_address("0x" + "22" * 20)
+FROM_TOKEN = Web3.to_checksum_address("0x" + "33" * 20)
+TO_TOKEN = Web3.to_checksum_address("0x" + "44" * 20)
+
+
+def tx_hash(n: int) -> str:
+    return "0x" + f"{n:064x}"
+
+
+class StubChain(BaseProvider):
+    """Answers the JSON-RPC calls of reconcile() from a few mined transactions of SENDER"""
+    def __init__(self, head: int, first_nonce: int, mined: Dict[int, Dict[str, Any]],
+                 receipts: Dict[str, int], pending: List[str]) -> None:
+        """
+        :param first_nonce: the nonce of SENDER before any block of mined
+        :param mined: block number -> the transaction of SENDER mined in it
+        :param receipts: transaction hash -> status, of the mined transactions
+        :param pending: the hashes of the transactions the node knows but did not mine
+        """
+        self.head = head
+        self.first_nonce = first_nonce
+        self.mined = mined
+        self.receipts = receipts
+        self.pending = pending
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return True
+
+    def _nonce_at(self, block: int) -> int:
+        return self.first_nonce + sum(1 for number in self.mined if number <= block)
+
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        if method == "eth_chainId":
+            result: Optional[Any] = "0x1"
+        elif method == "eth_blockNumber":
+            result = hex(self.head)
+        elif method == "eth_getTransactionCount":
+            block = self.head if params[1] == "latest" else int(params[1], 16)
+            result = hex(self._nonce_at(block))
+        elif method == "eth_getTransactionReceipt":
+            status = self.receipts.get(params[0])
+            result = None if status is None else {
+                "transactionHash": params[0], "status": hex(status), "blockNumber": "0x1", "logs": [],
+            }
+        elif method == "eth_getTransactionByHash":
+            result = {"hash": params[0]} if params[0] in self.pending else None
+        elif method == "eth_getBlockByNumber":
+            number = int(params[0], 16)
+            transaction = self.mined.get(number)
+            result = {"number": hex(number), "transactions": [transaction] if transaction else []}
+        else:
+            raise ValueError(f"Unexpected call {method}")
+        return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+
+def mined_transaction(nonce: int, data: str, hash_: str) -> Dict[str, Any]:
+    return {"hash": hash_, "from": SENDER, "to": ROUTER, "nonce": hex(nonce), "input": data}
+
+
+def test_leg_states(tmp_path):
+    journal = ExecutionJournal(str(tmp_path / "journal.db"))
+    basket_id = journal.start_basket(FROM_TOKEN, [(TO_TOKEN, 10), (TO_TOKEN, 20), (TO_TOKEN, 30)])
+    assert [leg.state for leg in journal.legs(basket_id)] == [INTENT, INTENT, INTENT]
+    assert [leg.amount for leg in journal.legs(basket_id)] == [10, 20, 30]
+    assert journal.open_baskets() == [basket_id]
+
+    journal.record_signed(basket_id, 0, tx_hash(1), 7, SENDER, "0xabc")
+    journal.record_signed(basket_id, 1, tx_hash(2), 8)
+    journal.record(basket_id, 2, SKIPPED, error="not staged")
+    legs = journal.legs(basket_id)
+    assert legs[0].state == SIGNED and legs[0].in_flight and not legs[0].done
+    assert legs[0].nonce == 7 and legs[0].sender == SENDER and legs[0].call_hash == "0xabc"
+    assert journal.in_flight_nonces(SENDER, default_sender=SENDER) == {7, 8}
+
+    journal.record_receipt(basket_id, 0, {"transactionHash": tx_hash(1), "status": 1})
+    journal.record_receipt(basket_id, 1, {"transactionHash": tx_hash(2), "status": 0, "cancelled": True})
+    legs = journal.legs(basket_id)
+    assert legs[0].state == CONFIRMED and legs[0].done
+    # the fingerprint recorded when signed is kept by the later events of the same transaction
+    assert legs[0].call_hash == "0xabc"
+    assert legs[1].state == DROPPED and legs[1].error == "cancelled" and not legs[1].done
+    assert legs[2].state == SKIPPED and legs[2].error == "not staged"
+    assert journal.in_flight_nonces(SENDER, default_sender=SENDER) == set()
+
+    journal.close_basket(basket_id)
+    assert journal.open_baskets() == []
+    journal.close()
+
+
+def test_reconcile(tmp_path):
+    swap_data = "0x" + "ab" * 36
+    call_hash = call_fingerprint({"to": ROUTER, "data": swap_data})
+    bump_hash = tx_hash(100)
+    chain = StubChain(
+        head=1000,
+        first_nonce=5,
+        mined={
+            400: mined_transaction(5, swap_data, bump_hash),
+            500: mined_transaction(6, "0x" + "cd" * 36, tx_hash(101)),
+            600: mined_transaction(7, "0x", tx_hash(102)),
+        },
+        receipts={tx_hash(1): 1, bump_hash: 1},
+        pending=[tx_hash(5)],
+    )
+    journal = ExecutionJournal(str(tmp_path / "journal.db"))
+    basket_id = journal.start_basket(FROM_TOKEN, [(TO_TOKEN, amount) for amount in range(1, 8)])
+    # mined as signed
+    journal.record_signed(basket_id, 0, tx_hash(1), 4, call_hash=call_hash)
+    # its nonce was mined by a fee bump of the same call
+    journal.record_signed(basket_id, 1, tx_hash(2), 5, call_hash=call_hash)
+    # its nonce was mined by another call, ex: a cancellation
+    journal.record_signed(basket_id, 2, tx_hash(3), 6, call_hash=call_hash)
+    # its nonce was mined, but without fingerprint the transaction can't be recognized
+    journal.record_signed(basket_id, 3, tx_hash(4), 7)
+    # the send reported an error, but the node knows the transaction
+    journal.record(basket_id, 4, FAILED, tx_hash=tx_hash(5), nonce=8)
+    # never reached the node
+    journal.record_signed(basket_id, 5, tx_hash(6), 9, call_hash=call_hash)
+
+    legs = journal.reconcile(Web3(chain), SENDER, basket_id)
+    assert [leg.state for leg in legs] == [CONFIRMED, CONFIRMED, DROPPED, REPLACED, SIGNED, DROPPED, INTENT]
+    assert legs[0].tx_hash == Web3.to_bytes(hexstr=tx_hash(1))
+    # the bump settles the leg with its own hash, and keeps the fingerprint
+    assert legs[1].tx_hash == Web3.to_bytes(hexstr=bump_hash) and legs[1].status == 1
+    assert legs[1].call_hash == call_hash
+    assert legs[3].done and not legs[2].done
+    assert legs[4].in_flight and legs[4].nonce == 8
+    assert journal.in_flight_nonces(SENDER, default_sender=SENDER) == {8}
+
+    # settled legs are left alone by the next reconciliation
+    assert [leg.state for leg in journal.reconcile(Web3(chain), SENDER, basket_id)] == \
+        [leg.state for leg in legs]
+    journal.close()
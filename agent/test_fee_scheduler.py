@@ -0,0 +1,110 @@
+"""Tests of the base fee scheduler of deferred baskets, against a stubbed fee history"""
+
+from types import SimpleNamespace
+from typing import List
+from fee_scheduler import BaseFeeScheduler
+
+
+class StubEth:
+    """eth_feeHistory of a chain whose base fee of block n is base_fees[n]"""
+    def __init__(self, base_fees: List[int]) -> None:
+        self.base_fees = base_fees
+        self.block_number = len(base_fees) - 2
+        self.requests = []
+
+    def fee_history(self, block_count, newest_block, reward_percentiles):
+        self.requests.append((block_count, newest_block))
+        oldest = newest_block - block_count + 1
+        # one more entry than the blocks: the base fee of the next block
+        return {"baseFeePerGas": self.base_fees[oldest:newest_block + 2]}
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_scheduler(base_fees: List[int], window: int = 10, target_percentile: float = 25.0):
+    eth = StubEth(base_fees)
+    clock = Clock()
+    scheduler = BaseFeeScheduler(SimpleNamespace(eth=eth), window=window, target_percentile=target_percentile,
+                                 clock=clock)
+    return scheduler, eth, clock
+
+
+def test_target_base_fee():
+    scheduler, _eth, _clock = make_scheduler([50, 10, 40, 20, 30, 60, 70, 80, 90, 100, 110, 25])
+    assert scheduler.target_base_fee() is None
+    assert scheduler.refresh() == 25
+    # the window keeps the last 10 mined blocks
+    assert list(scheduler.base_fees) == [10, 40, 20, 30, 60, 70, 80, 90, 100, 110]
+    assert scheduler.target_base_fee() == 30
+    scheduler.target_percentile = 0
+    assert scheduler.target_base_fee() == 10
+    scheduler.target_percentile = 100
+    assert scheduler.target_base_fee() == 110
+
+
+def test_refresh_only_fetches_new_blocks():
+    base_fees = [100] * 20
+    scheduler, eth, _clock = make_scheduler(base_fees, window=10)
+    eth.block_number = 10
+    scheduler.refresh()
+    assert eth.requests == [(10, 10)]
+    scheduler.refresh()
+    assert eth.requests == [(10, 10)]
+    eth.block_number = 13
+    scheduler.refresh()
+    assert eth.requests == [(10, 10), (3, 13)]
+    assert len(scheduler.base_fees) == 10
+
+
+def test_poll_releases_in_priority_order():
+    # the next base fee, 15, is below the 25th percentile of the window
+    scheduler, _eth, _clock = make_scheduler([50, 10, 40, 20, 30, 60, 70, 80, 90, 100, 110, 15])
+    ran = []
+    baskets = (("low", 0, 100), ("high", 5, 300), ("high_early", 5, 200), ("low_later", 0, 100))
+    futures = {
+        name: scheduler.submit(name, lambda name=name: ran.append(name) or name, priority=priority, deadline=deadline)
+        for name, priority, deadline in baskets
+    }
+    assert [basket.name for basket in scheduler.pending()] == ["high_early", "high", "low", "low_later"]
+    released = scheduler.poll()
+    assert [basket.name for basket in released] == ["high_early", "high", "low", "low_later"]
+    assert ran == ["high_early", "high", "low", "low_later"]
+    assert all(future.result() == name for name, future in futures.items())
+    assert scheduler.pending() == []
+
+
+def test_poll_waits_for_the_target_or_the_deadline():
+    # the next base fee, 95, is above the target
+    scheduler, eth, clock = make_scheduler([50, 10, 40, 20, 30, 60, 70, 80, 90, 100, 110, 95])
+    ran = []
+    scheduler.submit("deferred", lambda: ran.append("deferred"), deadline=60)
+    scheduler.submit("capped", lambda: ran.append("capped"), deadline=60, max_base_fee=100)
+    scheduler.submit("urgent", lambda: ran.append("urgent"), deadline=0)
+    assert [basket.name for basket in scheduler.poll()] == ["urgent", "capped"]
+    assert [basket.name for basket in scheduler.pending()] == ["deferred"]
+
+    clock.now = 30
+    assert scheduler.poll() == []
+    # a failed refresh still releases the baskets past their deadline
+    eth.fee_history = None
+    clock.now = 61
+    assert [basket.name for basket in scheduler.poll()] == ["deferred"]
+    assert ran == ["urgent", "capped", "deferred"]
+
+
+def test_failed_basket_sets_its_future():
+    scheduler, _eth, _clock = make_scheduler([10] * 12)
+
+    def fail():
+        raise RuntimeError("reverted")
+    future = scheduler.submit("failing", fail, deadline=0)
+    other = scheduler.submit("other", lambda: "done", deadline=0)
+    scheduler.poll()
+    assert isinstance(future.exception(), RuntimeError)
+    assert other.result() == "done"
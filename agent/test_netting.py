@@ -0,0 +1,87 @@
+"""Tests of the netting of opposing trades between funds sharing a wallet"""
+
+from typing import List, Optional, Sequence, Tuple
+from web3 import Web3
+from netting import FundDelta, FundFill, NettedToken, NettingEngine, attribute_fills
+
+BASE_TOKEN = Web3.to_checksum_address("0x" + "11" * 20)
+TOKEN = Web3.to_checksum_address("0x" + "22" * 20)
+OTHER_TOKEN = Web3.to_checksum_address("0x" + "33" * 20)
+
+
+def sums(fills: List[FundFill]) -> Tuple[int, int, int]:
+    return (sum(fill.base_delta for fill in fills), sum(fill.token_delta for fill in fills),
+            sum(fill.crossed_value for fill in fills))
+
+
+def test_attribute_net_buy_fill():
+    netted = NettedToken(TOKEN, buys={"a": 700, "b": 300, "c": 333}, sells={"d": 400, "e": 111},
+                         reference_in=822, reference_out=1644)
+    fill_base, fill_token = 822, 1700
+    fills = attribute_fills(netted, fill_base, fill_token)
+    assert len(fills) == 5
+    base, token, crossed = sums(fills)
+    # the funds exchange the crossed flows between them: only the net fill leaves or enters the wallet
+    assert (base, token) == (-fill_base, fill_token)
+    assert crossed == 2 * netted.crossed
+    by_fund = {fill.fund_id: fill for fill in fills}
+    # the sellers are crossed in full, at the price of the net fill
+    assert by_fund["d"].base_delta == 400 and by_fund["d"].crossed_value == 400
+    assert by_fund["d"].token_delta == -(400 * fill_token // fill_base)
+    # the buyers pay their own value
+    for fund_id in ("a", "b", "c"):
+        assert abs(-by_fund[fund_id].base_delta - netted.buys[fund_id]) <= 1
+
+
+def test_attribute_net_sell_fill():
+    netted = NettedToken(TOKEN, buys={"a": 100}, sells={"b": 250, "c": 150}, reference_in=300, reference_out=900)
+    fill_base, fill_token = 290, 900
+    fills = attribute_fills(netted, fill_base, fill_token)
+    base, token, crossed = sums(fills)
+    assert (base, token) == (fill_base, -fill_token)
+    assert crossed == 2 * netted.crossed == 200
+    by_fund = {fill.fund_id: fill for fill in fills}
+    assert by_fund["a"].base_delta == -100 and by_fund["a"].crossed_value == 100
+
+
+def test_attribute_failed_net_trade():
+    """Without a fill, only the crossed flows are attributed, at the reference price"""
+    netted = NettedToken(TOKEN, buys={"a": 600, "b": 200}, sells={"c": 500}, reference_in=300, reference_out=600)
+    fills = attribute_fills(netted)
+    base, token, crossed = sums(fills)
+    assert (base, token) == (0, 0)
+    assert crossed == 1000
+    by_fund = {fill.fund_id: fill for fill in fills}
+    assert by_fund["c"].token_delta == -1000
+    # the buyers share the cross pro rata, their excess is left unfilled
+    assert by_fund["a"].base_delta == -375 and by_fund["b"].base_delta == -125
+
+
+def test_attribute_without_price():
+    assert attribute_fills(NettedToken(TOKEN, buys={"a": 1})) == []
+
+
+class StubUniswap:
+    def __init__(self, quotes: Sequence[Optional[int]]) -> None:
+        self.quotes = list(quotes)
+        self.legs: List[Tuple[str, int]] = []
+
+    def quote_min_amounts_out(self, from_token, legs, fee, slippage):
+        self.legs = list(legs)
+        return self.quotes
+
+
+def test_plan():
+    uniswap = StubUniswap([2000, None])
+    plan = NettingEngine(uniswap, BASE_TOKEN).plan([
+        FundDelta("a", TOKEN, 1000),
+        FundDelta("b", TOKEN.lower(), -400),
+        FundDelta("a", OTHER_TOKEN, 50),
+        FundDelta("b", OTHER_TOKEN, 0),
+    ])
+    # the net of each token is quoted at its own size
+    assert uniswap.legs == [(TOKEN, 600), (OTHER_TOKEN, 50)]
+    assert plan.buy_legs == [(TOKEN, 600)]
+    assert plan.sell_legs == []
+    assert plan.gross_value == 1450
+    assert plan.crossed_value == 800
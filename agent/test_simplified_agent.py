@@ -221,6 +221,26 @@ def calculate_minimum_output(amount):
     # Simple simulation - in reality this would use actual pool data
     return amount * 0.95  # Assume 5% slippage tolerance
 
+def test_basket_quotes():
+    """Test batched V4 quotes for a basket of builder tokens"""
+    print("\n📐 Testing Batched Basket Quotes...")
+
+    agent = BuilderTokensIndexFundAgent()
+
+    try:
+        deployments = agent._fetch_token_deployments(page=1, limit=5)
+        legs = [(d['token_address'], agent.web3.to_wei(0.1, 'ether')) for d in deployments if d.get('token_address')]
+        print(f"Quoting {len(legs)} legs in one call...")
+
+        min_amounts_out = agent.uniswap.quote_min_amounts_out(agent.talent_token_address, legs, 2000, 0.5)
+        for (token_address, amount_in), min_amount_out in zip(legs, min_amounts_out):
+            if min_amount_out is None:
+                print(f"  ✗ {token_address[:10]}...: no quote")
+            else:
+                print(f"  ✓ {token_address[:10]}...: min amount out {min_amount_out}")
+    except Exception as e:
+        print(f"✗ Error quoting basket: {e}")
+
 def test_wallet_initialization():
     """Test wallet and Web3 initialization"""
     print("\n🔐 Testing Wallet Initialization...")
@@ -581,6 +601,7 @@ if __name__ == "__main__":
     # test_simplified_agent()
     # test_token_transfers_with_allocations()
     # test_swap_calculation()
+    # test_basket_quotes()
     test_actual_talent_transfer()
     
     print("\n✅ All tests completed!") 
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""Tests of the output-maximizing split of an order between constant product pools"""
+
+import numpy as np
+from uniswap_split import optimal_split
+
+
+def output(reserves_in, reserves_out, gammas, amounts):
+    return gammas * amounts * reserves_out / (reserves_in + gammas * amounts)
+
+
+def marginal_output(reserves_in, reserves_out, gammas, amounts):
+    return gammas * reserves_in * reserves_out / (reserves_in + gammas * amounts) ** 2
+
+
+def test_split_sums_to_amount_in():
+    reserves_in = np.array([1e21, 4e20, 2.5e21])
+    reserves_out = np.array([3e18, 1.1e18, 7e18])
+    gammas = np.array([0.997, 0.9995, 0.99])
+    amounts = optimal_split(reserves_in, reserves_out, gammas, 5e20)
+    assert np.all(amounts >= 0)
+    assert np.isclose(amounts.sum(), 5e20, rtol=1e-12)
+
+
+def test_identical_pools_share_equally():
+    amounts = optimal_split(np.array([1e20, 1e20]), np.array([5e19, 5e19]), np.array([0.997, 0.997]), 1e19)
+    assert np.allclose(amounts, [5e18, 5e18], rtol=1e-9)
+
+
+def test_single_pool_gets_everything():
+    amounts = optimal_split(np.array([1e20]), np.array([5e19]), np.array([0.997]), 3e18)
+    assert np.allclose(amounts, [3e18])
+
+
+def test_marginal_outputs_are_equalized():
+    reserves_in = np.array([1e21, 3e20])
+    reserves_out = np.array([2e21, 7e20])
+    gammas = np.array([0.997, 0.9999])
+    amounts = optimal_split(reserves_in, reserves_out, gammas, 2e20)
+    assert np.all(amounts > 0)
+    marginals = marginal_output(reserves_in, reserves_out, gammas, amounts)
+    assert np.isclose(marginals[0], marginals[1], rtol=1e-6)
+
+
+def test_split_beats_every_other_split():
+    reserves_in = np.array([1e21, 3e20])
+    reserves_out = np.array([2e21, 7e20])
+    gammas = np.array([0.997, 0.9999])
+    amount_in = 2e20
+    best = output(reserves_in, reserves_out, gammas, optimal_split(reserves_in, reserves_out, gammas, amount_in)).sum()
+    for share in np.linspace(0, 1, 101):
+        amounts = np.array([share * amount_in, (1 - share) * amount_in])
+        assert output(reserves_in, reserves_out, gammas, amounts).sum() <= best * (1 + 1e-12)
+
+
+def test_worse_priced_pool_is_left_out():
+    """A pool whose spot price is below the marginal price of the best pool after the whole order gets nothing"""
+    reserves_in = np.array([1e22, 1e20])
+    reserves_out = np.array([1e22, 5e19])
+    gammas = np.array([0.997, 0.997])
+    amounts = optimal_split(reserves_in, reserves_out, gammas, 1e18)
+    assert amounts[1] == 0
+    assert np.isclose(amounts[0], 1e18)
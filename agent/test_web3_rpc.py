@@ -0,0 +1,128 @@
+"""Tests of the BlockCache middleware against a stubbed node"""
+
+import time
+from typing import Any, Dict, List, Tuple
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from web3_rpc import install_block_cache
+
+ACCOUNT = Web3.to_checksum_address("0x" + "11" * 20)
+TX_HASH = "0x" + "22" * 32
+
+
+class StubNode(BaseProvider):
+    """A node whose head block and account balance are set by the test, counting the calls it receives"""
+    def __init__(self) -> None:
+        self.block_number = 100
+        self.balance = 1
+        self.mined = False
+        self.calls: List[Tuple[str, Any]] = []
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return True
+
+    def count(self, method: str) -> int:
+        return sum(1 for called, _params in self.calls if called == method)
+
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        self.calls.append((method, params))
+        if method == "eth_chainId":
+            result: Any = "0x1"
+        elif method == "eth_blockNumber":
+            result = hex(self.block_number)
+        elif method == "eth_getBalance":
+            result = hex(self.balance)
+        elif method == "eth_getTransactionByHash":
+            result = {
+                "hash": params[0], "nonce": "0x1",
+                "blockHash": "0x" + "33" * 32 if self.mined else None,
+                "blockNumber": hex(self.block_number) if self.mined else None,
+            }
+        elif method == "eth_getTransactionReceipt":
+            result = {"transactionHash": params[0], "status": "0x1", "blockNumber": hex(self.block_number),
+                      "logs": []}
+        elif method == "eth_sendRawTransaction":
+            result = TX_HASH
+        else:
+            raise ValueError(f"Unexpected call {method}")
+        return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+
+def make_web3(block_time: float = 60.0):
+    node = StubNode()
+    w3 = Web3(node)
+    return w3, node, install_block_cache(w3, block_time)
+
+
+def test_immutable_results_are_cached_forever():
+    w3, node, cache = make_web3()
+    assert w3.eth.chain_id == 1
+    calls = len(node.calls)
+    for _ in range(3):
+        assert w3.eth.chain_id == 1
+    assert len(node.calls) == calls
+    assert install_block_cache(w3) is cache
+
+
+def test_latest_reads_are_cached_until_a_new_block():
+    w3, node, cache = make_web3(block_time=0.05)
+    assert w3.eth.block_number == 100
+    assert w3.eth.get_balance(ACCOUNT) == 1
+    node.balance = 2
+    assert w3.eth.get_balance(ACCOUNT) == 1
+    assert node.count("eth_getBalance") == 1
+
+    node.block_number = 101
+    time.sleep(0.06)
+    # the block number is read again once block_time is over, the new block drops the cached reads
+    assert w3.eth.block_number == 101
+    assert w3.eth.get_balance(ACCOUNT) == 2
+    assert cache.stats()["eth_getBalance"] == (1, 2)
+
+
+def test_receipt_of_a_newer_block_invalidates():
+    w3, node, _cache = make_web3()
+    assert w3.eth.block_number == 100
+    assert w3.eth.get_balance(ACCOUNT) == 1
+    node.balance, node.block_number = 2, 101
+    # still trusted: block_time is not over
+    assert w3.eth.block_number == 100
+    w3.eth.get_transaction_receipt(TX_HASH)
+    assert w3.eth.block_number == 101
+    assert w3.eth.get_balance(ACCOUNT) == 2
+
+
+def test_sent_transaction_invalidates():
+    w3, node, _cache = make_web3()
+    assert w3.eth.get_balance(ACCOUNT) == 1
+    node.balance = 2
+    w3.eth.send_raw_transaction("0x01")
+    assert w3.eth.get_balance(ACCOUNT) == 2
+
+
+def test_latest_reads_expire_without_a_new_block():
+    w3, node, _cache = make_web3(block_time=0.05)
+    assert w3.eth.get_balance(ACCOUNT) == 1
+    node.balance = 2
+    time.sleep(0.06)
+    # no newer block was seen, but the read is older than block_time
+    assert w3.eth.get_balance(ACCOUNT) == 2
+
+
+def test_reads_at_a_block_number_are_kept():
+    w3, node, _cache = make_web3(block_time=0.05)
+    assert w3.eth.get_balance(ACCOUNT, 90) == 1
+    node.balance, node.block_number = 2, 101
+    time.sleep(0.06)
+    assert w3.eth.block_number == 101
+    assert w3.eth.get_balance(ACCOUNT, 90) == 1
+    assert node.count("eth_getBalance") == 1
+
+
+def test_transactions_are_cached_once_mined():
+    w3, node, _cache = make_web3()
+    assert w3.eth.get_transaction(TX_HASH)["blockHash"] is None
+    node.mined = True
+    assert w3.eth.get_transaction(TX_HASH)["blockHash"] is not None
+    assert w3.eth.get_transaction(TX_HASH)["blockHash"] is not None
+    assert node.count("eth_getTransactionByHash") == 2
@@ -0,0 +1,124 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import ChecksumAddress
+
+
+@dataclass(frozen=True)
+class ChildOrder:
+    """One slice of a leg, due at offset seconds after the start of the schedule"""
+    leg_index: int
+    slice_index: int
+    to_token: ChecksumAddress
+    amount: int
+    offset: float
+
+
+@dataclass
+class TwapLegResult:
+    """What was sent for one leg: the hash of each child order, None for the slices that could not be sent"""
+    to_token: ChecksumAddress
+    amount: int
+    tx_hashes: List[Optional[HexBytes]] = field(default_factory=list)
+
+    @property
+    def sent_slices(self) -> int:
+        return sum(1 for tx_hash in self.tx_hashes if tx_hash)
+
+
+def split_amount(amount: int, slices: int) -> List[int]:
+    """:return: slices amounts summing to amount, the remainder of the division going to the last one"""
+    child_amount = amount // slices
+    return [child_amount] * (slices - 1) + [amount - child_amount * (slices - 1)]
+
+
+class TwapScheduler:
+    """
+    Time-sliced execution of a basket of buys: every leg is split into child orders spread over the horizon,
+    so each swap only moves a thin pool by a fraction of the whole allocation.
+    The child orders of all the legs are interleaved (slice 0 of every token, then slice 1...) and evenly spaced,
+    so every block carries some work and the basket finishes in horizon seconds whatever its size.
+    Each child order is sent without waiting for the previous ones to be mined, through the nonce stream of
+    the client, and quoted when it is sent, so later slices see the price after the earlier ones.
+    """
+    def __init__(
+            self,
+            uniswap: Any,
+            horizon: float = 600.0,
+            slices: int = 10,
+            fee: int = 2000,
+            slippage: float = 0.5,
+            sleep: Callable[[float], None] = time.sleep) -> None:
+        """
+        :param uniswap: the Uniswap client sending the child orders
+        :param horizon: seconds between the first and the last child order
+        :param slices: child orders per leg
+        :param slippage: slippage tolerance of each child order, in percent of its own quote
+        """
+        if slices < 1:
+            raise ValueError("slices must be at least 1")
+        self.uniswap = uniswap
+        self.horizon = horizon
+        self.slices = slices
+        self.fee = fee
+        self.slippage = slippage
+        self.sleep = sleep
+
+    def schedule(self, legs: Sequence[Tuple[str, int]]) -> List[ChildOrder]:
+        """
+        :param legs: the (to_token, amount in wei) of each leg
+        :return: the child orders of all the legs, in sending order
+        """
+        legs = [(Web3.to_checksum_address(to_token), int(amount)) for to_token, amount in legs if amount > 0]
+        slots = self.slices * len(legs)
+        interval = self.horizon / (slots - 1) if slots > 1 else 0.0
+        amounts = [split_amount(amount, self.slices) for _to_token, amount in legs]
+        return [
+            ChildOrder(leg_index, slice_index, legs[leg_index][0], amounts[leg_index][slice_index],
+                       (slice_index * len(legs) + leg_index) * interval)
+            for slice_index in range(self.slices)
+            for leg_index in range(len(legs))
+        ]
+
+    def run(
+            self,
+            from_token: str,
+            legs: Sequence[Tuple[str, int]],
+            pool_versions: Optional[Sequence[str]] = None) -> List[TwapLegResult]:
+        """
+        Send every child order at its time.
+
+        :param from_token: the token spent by every leg
+        :param legs: the (to_token, amount in wei) of each leg
+        :param pool_versions: the pool version of each leg, "v4" by default
+        :return: the result of each leg with an amount, in the same order
+        """
+        # the pool versions are filtered with the legs, so they stay aligned with the leg indexes
+        kept = [index for index, (_to_token, amount) in enumerate(legs) if amount > 0]
+        pool_versions = [pool_versions[index] for index in kept] if pool_versions else None
+        legs = [legs[index] for index in kept]
+        results = [TwapLegResult(Web3.to_checksum_address(to_token), int(amount)) for to_token, amount in legs]
+        started = time.monotonic()
+        for order in self.schedule(legs):
+            delay = started + order.offset - time.monotonic()
+            if delay > 0:
+                self.sleep(delay)
+            pool_version = pool_versions[order.leg_index] if pool_versions else "v4"
+            try:
+                tx_hash = self.uniswap.make_trade(
+                    from_token=from_token,
+                    to_token=order.to_token,
+                    amount=order.amount,
+                    fee=self.fee,
+                    slippage=self.slippage,
+                    pool_version=pool_version,
+                )
+            except Exception as e:
+                print(f"Slice {order.slice_index + 1}/{self.slices} of {order.to_token} failed: {e}")
+                tx_hash = None
+            print(f"Slice {order.slice_index + 1}/{self.slices} of {order.to_token}: "
+                  f"{order.amount} sent, hash {tx_hash.hex() if tx_hash else None}")
+            results[order.leg_index].tx_hashes.append(tx_hash)
+        return results
@@ -0,0 +1,301 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from eth_account import Account
+from web3 import AsyncWeb3, Web3
+from web3.types import BlockIdentifier, Wei
+from multicall import Multicall, MULTICALL3_ADDRESS
+from uniswap_functions import FeeSample, RouterCodec, TransactionSpeed, _fee_history_percentiles
+from uniswap_quoter import QuoteRequest, V4_QUOTER_ADDRESSES, apply_slippage, build_quote_call
+from uniswap_universal_router import (
+    ERC20_ABI, PERMIT2_ABI, PERMIT2_ADDRESS, ROUTER_ADDRESSES, Uniswap, _large_approval_threshold,
+)
+
+
+class AsyncFeeOracle:
+    """
+    AsyncWeb3 counterpart of FeeOracle: one eth_feeHistory sample per block serves every TransactionSpeed.
+    """
+    def __init__(self, w3: AsyncWeb3, block_count: int = 10, base_fee_multiplier: float = 1.5) -> None:
+        self.w3 = w3
+        self.block_count = block_count
+        self.base_fee_multiplier = base_fee_multiplier
+        self._samples: Dict[int, FeeSample] = {}
+
+    async def sample(self, block_identifier: BlockIdentifier = "latest") -> FeeSample:
+        block_number = block_identifier if isinstance(block_identifier, int) else await self.w3.eth.block_number
+        sample = self._samples.get(block_number)
+        if sample is None:
+            fee_history = await self.w3.eth.fee_history(self.block_count, block_number, _fee_history_percentiles)
+            sample = FeeSample.from_fee_history(fee_history)
+            self._samples = {k: v for k, v in self._samples.items() if k > block_number - self.block_count}
+            self._samples[block_number] = sample
+        return sample
+
+    async def gas_fees(
+            self,
+            trx_speed: TransactionSpeed = TransactionSpeed.FAST,
+            block_identifier: BlockIdentifier = "latest") -> Tuple[Wei, Wei]:
+        sample = await self.sample(block_identifier)
+        return sample.gas_fees(trx_speed, self.base_fee_multiplier)
+
+
+class AsyncNonceManager:
+    """
+    AsyncWeb3 counterpart of NonceManager: the concurrent sends of one account take consecutive nonces
+    from a local counter started at the pending nonce of the node, instead of all reading the same one.
+    """
+    def __init__(self, w3: AsyncWeb3, address: str) -> None:
+        self.w3 = w3
+        self.address = Web3.to_checksum_address(address)
+        self._lock = asyncio.Lock()
+        self._next_nonce: Optional[int] = None
+
+    async def allocate(self) -> int:
+        """:return: the next unused nonce"""
+        async with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = await self.w3.eth.get_transaction_count(self.address, "pending")
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
+
+    async def release(self, nonce: int) -> bool:
+        """
+        Give back a nonce that was allocated but not broadcast.
+
+        :return: True if it was the last nonce allocated and is allocated again next, False if later nonces
+            were handed out meanwhile and the gap blocks them until it is filled
+        """
+        async with self._lock:
+            if self._next_nonce is not None and nonce == self._next_nonce - 1:
+                self._next_nonce = nonce
+                return True
+            return False
+
+
+class AsyncUniswap:
+    """
+    Asynchronous counterpart of Uniswap, built on AsyncWeb3, so it can be awaited from the uAgents handlers
+    without blocking the event loop. Independent reads are run concurrently with asyncio.gather.
+    """
+    def __init__(self, wallet_address, private_key, provider, web3: Optional[AsyncWeb3] = None):
+        self.wallet_address = Web3.to_checksum_address(wallet_address)
+        self.account = Account.from_key(private_key)
+        self.w3 = web3 if web3 else AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(provider))
+
+        self.chain = Uniswap.get_chain_from_provider(provider)
+        if self.chain not in ROUTER_ADDRESSES:
+            raise ValueError(f"❌ Unsupported chain: {self.chain}")
+
+        self.router_address = Web3.to_checksum_address(ROUTER_ADDRESSES[self.chain])
+        self.permit2 = self.w3.eth.contract(address=Web3.to_checksum_address(PERMIT2_ADDRESS), abi=PERMIT2_ABI)
+        self.quoter_address = Web3.to_checksum_address(V4_QUOTER_ADDRESSES[self.chain])
+
+        # encoding is done offline, no RPC is needed
+        self.codec = RouterCodec(w3=Web3())
+        self.fee_oracle = AsyncFeeOracle(self.w3)
+        self.nonce_manager = AsyncNonceManager(self.w3, self.account.address)
+        self._chain_id: Optional[int] = None
+
+    async def get_chain_id(self) -> int:
+        if self._chain_id is None:
+            self._chain_id = await self.w3.eth.chain_id
+        return self._chain_id
+
+    def _token(self, token_address):
+        return self.w3.eth.contract(address=Web3.to_checksum_address(token_address), abi=ERC20_ABI)
+
+    async def get_token_decimals(self, token_address) -> int:
+        return await self._token(token_address).functions.decimals().call()
+
+    async def get_token_balance(self, token_address, owner=None) -> int:
+        owner = Web3.to_checksum_address(owner) if owner else self.wallet_address
+        return await self._token(token_address).functions.balanceOf(owner).call()
+
+    async def get_token_balances(self, token_addresses: Sequence[str], owner=None) -> List[int]:
+        """Read the balances of many tokens concurrently"""
+        return list(await asyncio.gather(*(self.get_token_balance(token, owner) for token in token_addresses)))
+
+    async def check_permit2_allowance(self, token_address) -> bool:
+        """
+        Check if token has already been approved for Permit2
+        Returns: True if sufficient allowance exists, False otherwise
+        """
+        permit2_allowance = await self._token(token_address).functions.allowance(
+            self.wallet_address,
+            self.permit2.address
+        ).call()
+        return permit2_allowance > _large_approval_threshold
+
+    async def approve_permit2(self, token_address) -> bool:
+        """
+        Approve the Permit2 contract to spend tokens (one-time approval)
+        """
+        contract_function = self._token(token_address).functions.approve(self.permit2.address, 2**256 - 1)
+        try:
+            (priority_fee, max_fee_per_gas), chain_id, balance = await asyncio.gather(
+                self.fee_oracle.gas_fees(TransactionSpeed.FAST),
+                self.get_chain_id(),
+                self.w3.eth.get_balance(self.account.address),
+            )
+            estimated_gas = 60000  # Typical gas limit for ERC20 approval
+            if balance < estimated_gas * max_fee_per_gas:
+                print("ERROR: Insufficient ETH balance for approval!")
+                return False
+
+            tx_params = await contract_function.build_transaction({
+                "from": self.account.address,
+                "gas": estimated_gas,
+                "maxPriorityFeePerGas": priority_fee,
+                "maxFeePerGas": max_fee_per_gas,
+                "type": 2,
+                "chainId": chain_id,
+                "value": 0,
+            })
+            tx_params["nonce"] = await self.nonce_manager.allocate()
+            tx_hash = await self._sign_and_send(tx_params)
+            print(f"Permit2 token approve transaction hash: {tx_hash.hex()}")
+
+            receipt = await self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=60)
+            return receipt["status"] == 1
+        except Exception as e:
+            print(f"Error in approve_permit2: {str(e)}")
+            return False
+
+    async def create_permit_signature(self, token_address, chain_id: Optional[int] = None):
+        """
+        Create a Permit2 signature for a specific transaction (needed for each swap)
+        """
+        token_address = Web3.to_checksum_address(token_address)
+        if chain_id is None:
+            chain_id = await self.get_chain_id()
+        _amount, _expiration, p2_nonce = await self.permit2.functions.allowance(
+            self.wallet_address,
+            token_address,
+            self.router_address
+        ).call()
+        permit_data, signable_message = self.codec.create_permit2_signable_message(
+            token_address,
+            2**160 - 1,
+            self.codec.get_default_expiration(),
+            p2_nonce,
+            self.router_address,
+            self.codec.get_default_deadline(),
+            chain_id,
+        )
+        return permit_data, self.account.sign_message(signable_message)
+
+    async def quote(self, request: QuoteRequest, block_identifier: BlockIdentifier = "latest"):
+        """Quote a single V4 pool through Multicall3, returns (amount_out, gas_estimate) or None"""
+        calls = [build_quote_call(self.quoter_address, request)]
+        raw_result = await self.w3.eth.call(
+            {"to": MULTICALL3_ADDRESS, "data": Multicall.encode(calls)},
+            block_identifier,
+        )
+        _block_number, results = Multicall.decode(calls, bytes(raw_result))
+        return results[0]
+
+    async def make_trade(self, from_token, to_token, amount, fee, slippage, tick_spacing=200, min_amount_out=None):
+        """
+        Execute an exact input V4 swap through the Universal Router.
+
+        Args:
+            from_token (str): Address of token to swap from
+            to_token (str): Address of token to swap to
+            amount (int): Amount in wei (already converted to smallest unit)
+            fee (int): Fee tier (e.g., 3000 for 0.3%)
+            slippage (float): Slippage tolerance in percent
+            min_amount_out (int): Minimum accepted output in wei. If None, the swap is quoted and slippage is applied
+        """
+        from_token = Web3.to_checksum_address(from_token)
+        to_token = Web3.to_checksum_address(to_token)
+        pool_key = self.codec.encode.v4_pool_key(from_token, to_token, fee, tick_spacing)
+        zero_for_one = int(from_token, 16) < int(to_token, 16)
+
+        balance, has_permit2_allowance = await asyncio.gather(
+            self.get_token_balance(from_token),
+            self.check_permit2_allowance(from_token),
+        )
+        if balance < amount:
+            raise ValueError(f"Insufficient balance. Have: {balance}, Need: {amount}")
+
+        if not has_permit2_allowance:
+            print("Permit2 approval needed. Initiating approval...")
+            if not await self.approve_permit2(from_token):
+                print("Failed to get Permit2 approval")
+                return None
+
+        chain_id = await self.get_chain_id()
+        reads = [
+            self.create_permit_signature(from_token, chain_id),
+            self.w3.eth.get_block("latest"),
+            self.fee_oracle.gas_fees(TransactionSpeed.FAST),
+            self.w3.eth.get_balance(self.account.address),
+        ]
+        if min_amount_out is None:
+            reads.append(self.quote(QuoteRequest.from_pool_key(pool_key, zero_for_one, amount)))
+        results = await asyncio.gather(*reads)
+        (permit_data, signed_message), block, (priority_fee, max_fee_per_gas), eth_balance = results[:4]
+
+        if min_amount_out is None:
+            quote = results[4]
+            if quote is None:
+                print(f"Failed to quote {from_token} -> {to_token}, the pool may not exist")
+                return None
+            min_amount_out = apply_slippage(quote[0], slippage)
+
+        encoded_data = (
+            self.codec.encode.chain()
+            .permit2_permit(permit_data, signed_message)
+            .v4_swap()
+            .swap_exact_in_single(
+                pool_key=pool_key,
+                zero_for_one=zero_for_one,
+                amount_in=amount,
+                amount_out_min=min_amount_out,
+            )
+            .take_all(to_token, 0)
+            .settle_all(from_token, amount)
+            .build_v4_swap()
+            .build(block["timestamp"] + 300)
+        )
+
+        tx_params: Dict[str, Any] = {
+            "from": self.account.address,
+            "value": 0,
+            "to": self.router_address,
+            "chainId": chain_id,
+            "type": 2,
+            "maxPriorityFeePerGas": priority_fee,
+            "maxFeePerGas": max_fee_per_gas,
+            "data": encoded_data,
+        }
+        try:
+            tx_params["gas"] = int(await self.w3.eth.estimate_gas(tx_params) * 115 // 100)
+        except Exception as e:
+            print(f"Error building V4 transaction: {str(e)}")
+            return None
+
+        if eth_balance < tx_params["gas"] * max_fee_per_gas:
+            print("ERROR: Insufficient ETH balance for gas!")
+            return None
+
+        try:
+            # the nonce is taken last, so a leg failing above does not leave a gap
+            tx_params["nonce"] = await self.nonce_manager.allocate()
+            tx_hash = await self._sign_and_send(tx_params)
+            print(f"Transaction sent: {tx_hash.hex()}, nonce {tx_params['nonce']}")
+            return tx_hash
+        except Exception as e:
+            print(f"Error sending transaction: {str(e)}")
+            return None
+
+    async def _sign_and_send(self, tx_params: Dict[str, Any]):
+        """Sign and broadcast tx_params, giving its nonce back if it was not sent"""
+        try:
+            signed_tx = self.account.sign_transaction(tx_params)
+            return await self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception:
+            if not await self.nonce_manager.release(tx_params["nonce"]):
+                print(f"ERROR: nonce {tx_params['nonce']} was not sent, the following transactions wait for it")
+            raise
@@ -2,8 +2,11 @@ from enum import (
     auto,
     Enum,
 )
-from statistics import quantiles
-from typing import Optional, Dict, Any, Tuple, Union, Sequence, List, cast, TypedDict, TypeVar
+from types import MappingProxyType
+from weakref import WeakKeyDictionary
+from collections import deque
+import threading
+from typing import Optional, Dict, Any, Tuple, Union, Sequence, List, Mapping, Set, FrozenSet, cast, TypedDict, TypeVar
 from eth_account.messages import SignableMessage
 from eth_account.signers.local import LocalAccount
 from eth_account.account import SignedMessage
@@ -48,6 +51,97 @@ _speed_multiplier = {
     TransactionSpeed.FASTER: 1.5,
 }
 
+# eth_feeHistory reward percentiles, one per TransactionSpeed (same cut points as quintiles)
+_fee_history_percentiles = [20, 40, 60, 80]
+
+
+class FeeSample:
+    """
+    Gas fee data sampled from eth_feeHistory for a given block: the base fee of the next block and,
+    for each TransactionSpeed, the median reward paid at the matching percentile over the sampled blocks.
+    """
+    def __init__(self, block_number: int, next_base_fee: int, priority_fees: Sequence[int]) -> None:
+        self.block_number = block_number
+        self.next_base_fee = next_base_fee
+        self.priority_fees = list(priority_fees)
+
+    @classmethod
+    def from_fee_history(cls, fee_history: Dict[str, Any]) -> "FeeSample":
+        rewards = fee_history["reward"]
+        block_number = int(fee_history["oldestBlock"]) + len(rewards) - 1
+        priority_fees = []
+        for speed in TransactionSpeed:
+            tips = sorted(int(reward[speed.value]) for reward in rewards if int(reward[speed.value]) > 0)
+            if len(tips) < 3:
+                priority_fees.append(1)
+            else:
+                priority_fees.append(int(tips[len(tips) // 2] * _speed_multiplier[speed]))
+        return cls(block_number, int(fee_history["baseFeePerGas"][-1]), priority_fees)
+
+    def gas_fees(self, trx_speed: TransactionSpeed, base_fee_multiplier: float = 1.5) -> Tuple[Wei, Wei]:
+        priority_fee = self.priority_fees[trx_speed.value]
+        max_fee_per_gas = int(self.next_base_fee * base_fee_multiplier + priority_fee)
+        return Wei(priority_fee), Wei(max_fee_per_gas)
+
+
+class FeeOracle:
+    """
+    Gas fee oracle built on eth_feeHistory reward percentiles.
+    One sample is fetched per block and serves every TransactionSpeed until the next block.
+    """
+    def __init__(self, w3: Web3, block_count: int = 10, base_fee_multiplier: float = 1.5) -> None:
+        self.w3 = w3
+        self.block_count = block_count
+        self.base_fee_multiplier = base_fee_multiplier
+        self._samples: Dict[int, FeeSample] = {}
+        self._lock = threading.Lock()
+
+    def sample(self, block_identifier: BlockIdentifier = "latest") -> FeeSample:
+        """
+        :param block_identifier: the block number or identifier, default to 'latest'
+        :return: the (cached) fee sample for this block
+        """
+        block_number = block_identifier if isinstance(block_identifier, int) else self.w3.eth.block_number
+        with self._lock:
+            sample = self._samples.get(block_number)
+        if sample is None:
+            fee_history = self.w3.eth.fee_history(self.block_count, block_number, _fee_history_percentiles)
+            sample = FeeSample.from_fee_history(fee_history)
+            with self._lock:
+                # only the most recent blocks are worth keeping
+                self._samples = {k: v for k, v in self._samples.items() if k > block_number - self.block_count}
+                self._samples[block_number] = sample
+        return sample
+
+    def gas_fees(
+            self,
+            trx_speed: TransactionSpeed = TransactionSpeed.FAST,
+            block_identifier: BlockIdentifier = "latest") -> Tuple[Wei, Wei]:
+        """
+        :param trx_speed: the desired transaction 'speed'
+        :param block_identifier: the block number or identifier, default to 'latest'
+        :return: the tuple (priority_fee, max_fee_per_gas)
+        """
+        return self.sample(block_identifier).gas_fees(trx_speed, self.base_fee_multiplier)
+
+
+_fee_oracles: "WeakKeyDictionary[Web3, FeeOracle]" = WeakKeyDictionary()
+_fee_oracles_lock = threading.Lock()
+
+
+def get_fee_oracle(w3: Web3) -> FeeOracle:
+    """
+    :param w3: valid Web3 instance
+    :return: the FeeOracle shared by every user of this Web3 instance
+    """
+    with _fee_oracles_lock:
+        fee_oracle = _fee_oracles.get(w3)
+        if fee_oracle is None:
+            fee_oracle = FeeOracle(w3)
+            _fee_oracles[w3] = fee_oracle
+        return fee_oracle
+
+
 def compute_gas_fees(
         w3: Web3,
         trx_speed: TransactionSpeed = TransactionSpeed.FAST,
@@ -60,45 +154,105 @@ def compute_gas_fees(
     So, during strained conditions, the computed gas fees could be very high and should be double-checked before
     using them.
 
+    Fees come from the eth_feeHistory reward percentiles, sampled once per block by the FeeOracle shared by this
+    Web3 instance.
+
     :param w3: valid Web3 instance
     :param trx_speed: the desired transaction 'speed'
     :param block_identifier: the block number or identifier, default to 'latest'
     :return: the tuple (priority_fee, max_fee_per_gas)
     """
-    print("🩵", trx_speed, trx_speed.value)
-
-    block = w3.eth.get_block(block_identifier, True)
-    print("🩵🩵", "block", block)
-    transactions = cast(Sequence[TxData], block["transactions"])
-    print("🩵🩵🩵", "transactions", transactions)
-    tips = [
-        int(trx.get("maxPriorityFeePerGas", 0))
-        for trx
-        in transactions
-        if trx.get("maxPriorityFeePerGas", 0) > 0
-    ]
-    print("🩵🩵🩵🩵", "tips", tips)
-    if len(tips) < 3:
-        priority_fee = 1
-        print("🩵🩵🩵🩵", "priority_fee", priority_fee)
-    else:
-        quintiles = quantiles(tips, n=5, method="inclusive")
-        print("🩵🩵🩵🩵", "quintiles", quintiles)
-        print("🩵🩵🩵🩵", "trx_speed", trx_speed)
-        print("🩵🩵🩵🩵", "_speed_multiplier", _speed_multiplier)
-        print("🩵🩵🩵🩵", "trx_speed.value", trx_speed.value)
-        print("🩵🩵🩵🩵", "quintiles[trx_speed.value]", quintiles[trx_speed.value])
-        print("🩵🩵🩵🩵", "_speed_multiplier[trx_speed]", _speed_multiplier[trx_speed])
-        print("🩵🩵🩵🩵", "quintiles[trx_speed.value] * _speed_multiplier[trx_speed]", quintiles[trx_speed.value] * _speed_multiplier[trx_speed])
-        print("🩵🩵🩵🩵", "int(quintiles[trx_speed.value] * _speed_multiplier[trx_speed])", int(quintiles[trx_speed.value] * _speed_multiplier[trx_speed]))
-        priority_fee = int(quintiles[trx_speed.value] * _speed_multiplier[trx_speed])
-        print("🩵🩵🩵🩵", "priority_fee", priority_fee)
-    print("🩵🩵🩵🩵🩵", "priority_fee", priority_fee)
-    base_fee = block["baseFeePerGas"]
-    print("🩵🩵🩵🩵🩵🩵", "base_fee", base_fee)
-    max_fee_per_gas = int(base_fee * 1.5 + priority_fee)
-    print("🩵🩵🩵🩵🩵🩵🩵", "max_fee_per_gas", max_fee_per_gas)
-    return Wei(priority_fee), Wei(max_fee_per_gas)
+    return get_fee_oracle(w3).gas_fees(trx_speed, block_identifier)
+
+
+# The shape of a Universal Router call: one (command byte with its allow revert flag, V4 actions, hop count of each
+# swap) entry per command, so a multi-hop route never gets the gas limit learned from single-hop swaps
+GasShape = Tuple[Tuple[int, bytes, Tuple[int, ...]], ...]
+
+
+def _v3_hops(encoded_v3_path: bytes) -> int:
+    """:return: the number of pools of an encoded V3 path: a 20 bytes token, then a 3 bytes fee and a token per pool"""
+    return (len(encoded_v3_path) - 20) // 23
+
+
+class GasModel:
+    """
+    Learn the gas used by each shape of Universal Router call (permit + single V4 swap, N-leg basket, ...)
+    from the receipts, so the gas limit of a known shape can be predicted without an eth_estimateGas round trip.
+    """
+    def __init__(self, safety_margin: float = 0.2, max_samples: int = 20) -> None:
+        """
+        :param safety_margin: the fraction added on top of the highest recorded gas used, 0.2 is +20%
+        :param max_samples: how many of the most recent receipts are kept per shape
+        """
+        self.safety_margin = safety_margin
+        self.max_samples = max_samples
+        self._samples: Dict[GasShape, "deque[int]"] = {}
+        self._lock = threading.Lock()
+
+    def record(self, shape: GasShape, gas_used: int) -> None:
+        """
+        :param shape: the shape of the call, as returned by the builder gas_shape()
+        :param gas_used: the 'gasUsed' of a successful receipt
+        """
+        with self._lock:
+            samples = self._samples.get(shape)
+            if samples is None:
+                samples = deque(maxlen=self.max_samples)
+                self._samples[shape] = samples
+            samples.append(int(gas_used))
+
+    def predict(self, shape: GasShape) -> Optional[int]:
+        """
+        :param shape: the shape of the call, as returned by the builder gas_shape()
+        :return: the predicted gas limit, or None if this shape has never been recorded
+        """
+        with self._lock:
+            samples = self._samples.get(shape)
+            if not samples:
+                return None
+            return int(max(samples) * (1 + self.safety_margin))
+
+    def sample_count(self, shape: GasShape) -> int:
+        with self._lock:
+            return len(self._samples.get(shape, ()))
+
+
+AccessListKey = Tuple[ChecksumAddress, ChecksumAddress, GasShape, FrozenSet[Tuple[Any, ...]]]
+
+
+class AccessListCache:
+    """
+    EIP-2930 access lists of Universal Router calls, by sender, router, call shape and pool set.
+    A list is only kept if it lowers the gas estimate, an empty entry records that it did not,
+    so eth_createAccessList is called once per shape and pools, not once per transaction.
+    """
+    def __init__(self) -> None:
+        self._access_lists: Dict[AccessListKey, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: AccessListKey) -> Optional[List[Dict[str, Any]]]:
+        """:return: the access list of this key, empty if none helps, None if unknown yet"""
+        with self._lock:
+            return self._access_lists.get(key)
+
+    def store(self, key: AccessListKey, access_list: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._access_lists[key] = access_list
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._access_lists)
+
+
+def _is_unsupported_method(error: Exception) -> bool:
+    """:return: True if error is the answer of a node that does not implement the RPC method called"""
+    details = error.args[0] if error.args and isinstance(error.args[0], dict) else {}
+    if details.get("code") == -32601:
+        return True
+    message = str(details.get("message", error)).lower()
+    return any(hint in message for hint in ("not supported", "does not exist", "not available", "method not found"))
+
 
 def compute_sqrt_price_x96(amount_0: Wei, amount_1: Wei) -> int:
     """
@@ -127,6 +281,14 @@ _permit2_types = {
         {'name': 'sigDeadline', 'type': 'uint256'},
     ],
 }
+_permit2_batch_types = {
+    'PermitDetails': _permit2_types['PermitDetails'],
+    'PermitBatch': [
+        {'name': 'details', 'type': 'PermitDetails[]'},
+        {'name': 'spender', 'type': 'address'},
+        {'name': 'sigDeadline', 'type': 'uint256'},
+    ],
+}
 
 class PoolKey(TypedDict):
     """
@@ -158,6 +320,7 @@ class RouterFunction(Enum):
     V3_SWAP_EXACT_IN = 0
     V3_SWAP_EXACT_OUT = 1
     PERMIT2_TRANSFER_FROM = 2
+    PERMIT2_PERMIT_BATCH = 3
     SWEEP = 4
     TRANSFER = 5
     PAY_PORTION = 6
@@ -247,7 +410,7 @@ class FunctionABI:
     def encode(self, args: Sequence[Any]) -> bytes:
         return encode(self.get_abi_types(), args)
 
-ABIMap = Dict[Union[MiscFunctions, RouterFunction, V4Actions], FunctionABI]
+ABIMap = Mapping[Union[MiscFunctions, RouterFunction, V4Actions], FunctionABI]
 
 class FunctionRecipient(Enum):
     """
@@ -465,7 +628,7 @@ class _V4ChainedPositionFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         abi = self._abi_map[MiscFunctions.UNLOCK_DATA]
         encoded_data = abi.encode(action_values)
         args = (encoded_data, deadline)
-        self.builder._add_command(RouterFunction.V4_POSITION_MANAGER_CALL, args, True)
+        self.builder._add_command(RouterFunction.V4_POSITION_MANAGER_CALL, args, True, bytes(self.actions))
         return self.builder
 
 
@@ -478,12 +641,44 @@ class _ChainedFunctionBuilder:
         self._abi_map = abi_map
         self.commands: bytearray = bytearray()
         self.arguments: List[bytes] = []
+        self._shape: List[Tuple[int, bytes, Tuple[int, ...]]] = []
+        # the hop count of each swap of the command being built
+        self._hops: List[int] = []
+        self._pools: Set[Tuple[Any, ...]] = set()
 
-    def _add_command(self, command: RouterFunction, args: Sequence[Any], add_selector: bool = False) -> None:
+    def _add_command(
+            self,
+            command: RouterFunction,
+            args: Sequence[Any],
+            add_selector: bool = False,
+            actions: bytes = b"",
+            revert_on_fail: bool = True) -> None:
         abi = self._abi_map[command]
-        self.commands.append(command.value)
+        self.commands.append(self._get_command(command, revert_on_fail))
         arguments = abi.get_selector() + abi.encode(args) if add_selector else abi.encode(args)
         self.arguments.append(arguments)
+        self._shape.append((self.commands[-1], actions, tuple(self._hops)))
+        self._hops = []
+
+    def _add_hops(self, hops: int) -> None:
+        """Record the hop count of a swap of the next command"""
+        self._hops.append(hops)
+
+    def gas_shape(self) -> GasShape:
+        """
+        :return: the commands, with their allow revert flag, and the V4 actions and hop counts of each command,
+        chained so far. Used as GasModel key.
+        """
+        return tuple(self._shape)
+
+    def _add_pools(self, protocol: str, *pools: Sequence[Any]) -> None:
+        self._pools.update((protocol, tuple(pool)) for pool in pools)
+
+    def pool_set(self) -> FrozenSet[Tuple[Any, ...]]:
+        """
+        :return: the V2/V3 paths and V4 pool keys swapped through so far. Used with gas_shape() as AccessListCache key.
+        """
+        return frozenset(self._pools)
 
     @staticmethod
     def _get_recipient(
@@ -511,38 +706,42 @@ class _ChainedFunctionBuilder:
             self,
             function_recipient: FunctionRecipient,
             amount: Wei,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function WRAP_ETH which convert ETH to WETH through the UR
 
         :param function_recipient: A FunctionRecipient which defines the recipient of this function output.
         :param amount: The amount of sent ETH in WEI.
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (recipient, amount)
-        self._add_command(RouterFunction.WRAP_ETH, args)
+        self._add_command(RouterFunction.WRAP_ETH, args, revert_on_fail=revert_on_fail)
         return self
 
     def unwrap_weth(
             self,
             function_recipient: FunctionRecipient,
             amount: Wei,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function UNWRAP_WETH which convert WETH to ETH through the UR
 
         :param function_recipient: A FunctionRecipient which defines the recipient of this function output.
         :param amount: The amount of sent WETH in WEI.
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (recipient, amount)
-        self._add_command(RouterFunction.UNWRAP_WETH, args)
+        self._add_command(RouterFunction.UNWRAP_WETH, args, revert_on_fail=revert_on_fail)
         return self
 
     def v2_swap_exact_in(
@@ -552,7 +751,8 @@ class _ChainedFunctionBuilder:
             amount_out_min: Wei,
             path: Sequence[ChecksumAddress],
             custom_recipient: Optional[ChecksumAddress] = None,
-            payer_is_sender: bool = True) -> "_ChainedFunctionBuilder":
+            payer_is_sender: bool = True,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V2_SWAP_EXACT_IN, which swaps tokens on Uniswap V2.
         Correct allowances must have been set before sending such transaction.
@@ -563,12 +763,15 @@ class _ChainedFunctionBuilder:
         :param path: The V2 path: a list of 2 or 3 tokens where the first is token_in and the last is token_out
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
         :param payer_is_sender: True if the in tokens come from the sender, False if they already are in the router
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (recipient, amount_in, amount_out_min, path, payer_is_sender)
-        self._add_command(RouterFunction.V2_SWAP_EXACT_IN, args)
+        self._add_pools("v2", path)
+        self._add_hops(len(path) - 1)
+        self._add_command(RouterFunction.V2_SWAP_EXACT_IN, args, revert_on_fail=revert_on_fail)
         return self
 
     def v2_swap_exact_in_from_balance(
@@ -576,7 +779,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             amount_out_min: Wei,
             path: Sequence[ChecksumAddress],
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V2_SWAP_EXACT_IN, using the router balance as amount_in,
         which swaps tokens on Uniswap V2.
@@ -587,6 +791,7 @@ class _ChainedFunctionBuilder:
         :param amount_out_min: The minimum accepted bought token (token_out)
         :param path: The V2 path: a list of 2 or 3 tokens where the first is token_in and the last is token_out
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
@@ -597,6 +802,7 @@ class _ChainedFunctionBuilder:
             path,
             custom_recipient,
             False,
+            revert_on_fail=revert_on_fail,
         )
 
     def v2_swap_exact_out(
@@ -606,7 +812,8 @@ class _ChainedFunctionBuilder:
             amount_in_max: Wei,
             path: Sequence[ChecksumAddress],
             custom_recipient: Optional[ChecksumAddress] = None,
-            payer_is_sender: bool = True) -> "_ChainedFunctionBuilder":
+            payer_is_sender: bool = True,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V2_SWAP_EXACT_OUT, which swaps tokens on Uniswap V2.
         Correct allowances must have been set before sending such transaction.
@@ -617,12 +824,15 @@ class _ChainedFunctionBuilder:
         :param path: The V2 path: a list of 2 or 3 tokens where the first is token_in and the last is token_out
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
         :param payer_is_sender: True if the in tokens come from the sender, False if they already are in the router
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (recipient, amount_out, amount_in_max, path, payer_is_sender)
-        self._add_command(RouterFunction.V2_SWAP_EXACT_OUT, args)
+        self._add_pools("v2", path)
+        self._add_hops(len(path) - 1)
+        self._add_command(RouterFunction.V2_SWAP_EXACT_OUT, args, revert_on_fail=revert_on_fail)
         return self
 
     def v3_swap_exact_in(
@@ -632,7 +842,8 @@ class _ChainedFunctionBuilder:
             amount_out_min: Wei,
             path: Sequence[Union[int, ChecksumAddress]],
             custom_recipient: Optional[ChecksumAddress] = None,
-            payer_is_sender: bool = True) -> "_ChainedFunctionBuilder":
+            payer_is_sender: bool = True,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V3_SWAP_EXACT_IN, which swaps tokens on Uniswap V3.
         Correct allowances must have been set before sending such transaction.
@@ -644,13 +855,16 @@ class _ChainedFunctionBuilder:
         with the pool fee between each token in percentage * 10000 (ex: 3000 for 0.3%)
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
         :param payer_is_sender: True if the in tokens come from the sender, False if they already are in the router
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         encoded_v3_path = _Encoder.v3_path(RouterFunction.V3_SWAP_EXACT_IN.name, path)
         args = (recipient, amount_in, amount_out_min, encoded_v3_path, payer_is_sender)
-        self._add_command(RouterFunction.V3_SWAP_EXACT_IN, args)
+        self._add_pools("v3", path)
+        self._add_hops(_v3_hops(encoded_v3_path))
+        self._add_command(RouterFunction.V3_SWAP_EXACT_IN, args, revert_on_fail=revert_on_fail)
         return self
 
     def v3_swap_exact_in_from_balance(
@@ -658,7 +872,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             amount_out_min: Wei,
             path: Sequence[Union[int, ChecksumAddress]],
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V3_SWAP_EXACT_IN, using the router balance as amount_in,
         which swaps tokens on Uniswap V3.
@@ -670,6 +885,7 @@ class _ChainedFunctionBuilder:
         :param path: The V3 path: a list of tokens where the first is the token_in, the last one is the token_out, and
         with the pool fee between each token in percentage * 10000 (ex: 3000 for 0.3%)
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
@@ -680,6 +896,7 @@ class _ChainedFunctionBuilder:
             path,
             custom_recipient,
             False,
+            revert_on_fail=revert_on_fail,
         )
 
     def v3_swap_exact_out(
@@ -689,7 +906,8 @@ class _ChainedFunctionBuilder:
             amount_in_max: Wei,
             path: Sequence[Union[int, ChecksumAddress]],
             custom_recipient: Optional[ChecksumAddress] = None,
-            payer_is_sender: bool = True) -> "_ChainedFunctionBuilder":
+            payer_is_sender: bool = True,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function V3_SWAP_EXACT_OUT, which swaps tokens on Uniswap V3.
         Correct allowances must have been set before sending such transaction.
@@ -701,25 +919,30 @@ class _ChainedFunctionBuilder:
         with the pool fee between each token in percentage * 10000 (ex: 3000 for 0.3%)
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
         :param payer_is_sender: True if the in tokens come from the sender, False if they already are in the router
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         encoded_v3_path = _Encoder.v3_path(RouterFunction.V3_SWAP_EXACT_OUT.name, path)
         args = (recipient, amount_out, amount_in_max, encoded_v3_path, payer_is_sender)
-        self._add_command(RouterFunction.V3_SWAP_EXACT_OUT, args)
+        self._add_pools("v3", path)
+        self._add_hops(_v3_hops(encoded_v3_path))
+        self._add_command(RouterFunction.V3_SWAP_EXACT_OUT, args, revert_on_fail=revert_on_fail)
         return self
 
     def permit2_permit(
             self,
             permit_single: Dict[str, Any],
-            signed_permit_single: SignedMessage) -> "_ChainedFunctionBuilder":
+            signed_permit_single: SignedMessage,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function PERMIT2_PERMIT, which gives token allowances to the Permit2 contract.
         In addition, the Permit2 must be approved using the token contracts as usual.
 
         :param permit_single: The 1st element returned by create_permit2_signable_message()
         :param signed_permit_single: The 2nd element returned by create_permit2_signable_message(), once signed.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
@@ -729,7 +952,32 @@ class _ChainedFunctionBuilder:
             permit_single["sigDeadline"],
         )
         args = (struct, signed_permit_single.signature)
-        self._add_command(RouterFunction.PERMIT2_PERMIT, args)
+        self._add_command(RouterFunction.PERMIT2_PERMIT, args, revert_on_fail=revert_on_fail)
+        return self
+
+    def permit2_permit_batch(
+            self,
+            permit_batch: Dict[str, Any],
+            signed_permit_batch: SignedMessage,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
+        """
+        Encode the call to the function PERMIT2_PERMIT_BATCH, which gives allowances on several tokens
+        to the Permit2 contract with a single signature.
+        In addition, the Permit2 must be approved using the token contracts as usual.
+
+        :param permit_batch: The 1st element returned by create_permit2_batch_signable_message()
+        :param signed_permit_batch: The 2nd element returned by create_permit2_batch_signable_message(), once signed.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
+
+        :return: The chain link corresponding to this function call.
+        """
+        struct = (
+            [tuple(details.values()) for details in permit_batch["details"]],
+            permit_batch["spender"],
+            permit_batch["sigDeadline"],
+        )
+        args = (struct, signed_permit_batch.signature)
+        self._add_command(RouterFunction.PERMIT2_PERMIT_BATCH, args, revert_on_fail=revert_on_fail)
         return self
 
     def sweep(
@@ -737,7 +985,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             token_address: ChecksumAddress,
             amount_min: Wei,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function SWEEP which sweeps all of the router's ERC20 or ETH to an address
 
@@ -745,12 +994,13 @@ class _ChainedFunctionBuilder:
         :param token_address: The address of the token to sweep or "0x0000000000000000000000000000000000000000" for ETH.
         :param amount_min: The minimum desired amount
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (token_address, recipient, amount_min)
-        self._add_command(RouterFunction.SWEEP, args)
+        self._add_command(RouterFunction.SWEEP, args, revert_on_fail=revert_on_fail)
         return self
 
     def pay_portion(
@@ -758,7 +1008,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             token_address: ChecksumAddress,
             bips: int,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function PAY_PORTION which transfers a part of the router's ERC20 or ETH to an address.
         Transferred amount = balance * bips / 10_000
@@ -767,6 +1018,7 @@ class _ChainedFunctionBuilder:
         :param token_address: The address of token to pay or "0x0000000000000000000000000000000000000000" for ETH.
         :param bips: integer between 0 and 10_000
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
@@ -779,7 +1031,7 @@ class _ChainedFunctionBuilder:
 
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (token_address, recipient, bips)
-        self._add_command(RouterFunction.PAY_PORTION, args)
+        self._add_command(RouterFunction.PAY_PORTION, args, revert_on_fail=revert_on_fail)
         return self
 
     def transfer(
@@ -787,7 +1039,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             token_address: ChecksumAddress,
             value: Wei,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the call to the function TRANSFER which transfers an amount of ERC20 or ETH from the router's balance
         to an address.
@@ -796,13 +1049,14 @@ class _ChainedFunctionBuilder:
         :param token_address: The address of token to pay or "0x0000000000000000000000000000000000000000" for ETH.
         :param value: The amount to transfer (in Wei)
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
 
         :return: The chain link corresponding to this function call.
         """
 
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (token_address, recipient, value)
-        self._add_command(RouterFunction.TRANSFER, args)
+        self._add_command(RouterFunction.TRANSFER, args, revert_on_fail=revert_on_fail)
         return self
 
     def permit2_transfer_from(
@@ -810,7 +1064,8 @@ class _ChainedFunctionBuilder:
             function_recipient: FunctionRecipient,
             token_address: ChecksumAddress,
             amount: Wei,
-            custom_recipient: Optional[ChecksumAddress] = None) -> "_ChainedFunctionBuilder":
+            custom_recipient: Optional[ChecksumAddress] = None,
+            revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         Encode the transfer of tokens from the caller address to the given recipient.
         The UR must have been permit2'ed for the token first.
@@ -819,11 +1074,12 @@ class _ChainedFunctionBuilder:
         :param token_address: The address of the token to be transferred.
         :param amount: The amount to transfer.
         :param custom_recipient: If function_recipient is CUSTOM, must be the actual recipient, otherwise None.
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
         :return: The chain link corresponding to this function call.
         """
         recipient = self._get_recipient(function_recipient, custom_recipient)
         args = (token_address, recipient, amount)
-        self._add_command(RouterFunction.PERMIT2_TRANSFER_FROM, args)
+        self._add_command(RouterFunction.PERMIT2_TRANSFER_FROM, args, revert_on_fail=revert_on_fail)
         return self
 
     def v4_swap(self) -> "_V4ChainedSwapFunctionBuilder":
@@ -834,7 +1090,7 @@ class _ChainedFunctionBuilder:
         """
         return _V4ChainedSwapFunctionBuilder(self, self._w3, self._abi_map)
 
-    def v4_initialize_pool(self, pool_key: PoolKey, amount_0: Wei, amount_1: Wei) -> "_ChainedFunctionBuilder":
+    def v4_initialize_pool(self, pool_key: PoolKey, amount_0: Wei, amount_1: Wei, revert_on_fail: bool = True) -> "_ChainedFunctionBuilder":
         """
         V4 - Encode the call to initialize (create) a V4 pool.
         The amounts are used to compute the initial sqrtPriceX96. They are NOT sent.
@@ -844,11 +1100,12 @@ class _ChainedFunctionBuilder:
         :param pool_key: The pool key that identify the pool to create
         :param amount_0: "virtual" amount of PoolKey.currency_0
         :param amount_1: "virtual" amount of PoolKey.currency_1
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this command fails.
         :return: The chain link corresponding to this function call.
         """
         sqrt_price_x96 = compute_sqrt_price_x96(amount_0, amount_1)
         args = (tuple(pool_key.values()), sqrt_price_x96)
-        self._add_command(RouterFunction.V4_INITIALIZE_POOL, args)
+        self._add_command(RouterFunction.V4_INITIALIZE_POOL, args, revert_on_fail=revert_on_fail)
         return self
 
     def v4_posm_call(self) -> _V4ChainedPositionFunctionBuilder:
@@ -888,7 +1145,9 @@ class _ChainedFunctionBuilder:
             nonce: Optional[Union[int, Nonce]] = None,
             ur_address: ChecksumAddress = _ur_address,
             deadline: Optional[int] = None,
-            block_identifier: BlockIdentifier = "latest") -> TxParams:
+            block_identifier: BlockIdentifier = "latest",
+            gas_model: Optional[GasModel] = None,
+            access_lists: Optional[AccessListCache] = None) -> TxParams:
         """
         Build the encoded data and the transaction dictionary, ready to be signed.
 
@@ -915,6 +1174,8 @@ class _ChainedFunctionBuilder:
         :param ur_address: custom Universal Router address
         :param deadline: The optional unix timestamp after which the transaction won't be valid anymore.
         :param block_identifier: specify at what block the computing is done. Mostly for test purposes.
+        :param gas_model: if gas_limit is not set, predict it from this GasModel. eth_estimateGas is only called for shapes it has not recorded yet.
+        :param access_lists: if set, attach the EIP-2930 access list cached for this shape and pool set, computed with eth_createAccessList the first time.  # noqa
         :return: a transaction (TxParams) ready to be signed
         """
         encoded_data = self.build(deadline)
@@ -973,10 +1234,20 @@ class _ChainedFunctionBuilder:
 
         print("💚", "tx_params", tx_params)
 
+        estimated_gas = None
+        if access_lists is not None:
+            access_list, estimated_gas = self._access_list(tx_params, access_lists, block_identifier)
+            if access_list:
+                tx_params["accessList"] = access_list
+
+        if gas_limit is None and gas_model is not None:
+            gas_limit = gas_model.predict(self.gas_shape())
+
         if gas_limit is None:
             print("💚", "gas_limit is None")
-            estimated_gas = self._w3.eth.estimate_gas(tx_params, block_identifier)
-            gas_limit = estimated_gas * 1.15
+            if estimated_gas is None:
+                estimated_gas = self._w3.eth.estimate_gas(tx_params, block_identifier)
+            gas_limit = estimated_gas * 115 // 100
             print("💚", "estimated_gas", estimated_gas)
 
         print("💚", "gas_limit", gas_limit)
@@ -986,6 +1257,47 @@ class _ChainedFunctionBuilder:
 
         return tx_params
 
+    def _access_list(
+            self,
+            tx_params: TxParams,
+            access_lists: AccessListCache,
+            block_identifier: BlockIdentifier) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        :return: the tuple (access list to attach, possibly empty, gas estimate of the transaction with it
+        if one was made, else None)
+        """
+        key = (tx_params["from"], tx_params["to"], self.gas_shape(), self.pool_set())
+        access_list = access_lists.get(key)
+        if access_list is not None:
+            return access_list, None
+        try:
+            # eth.create_access_list is not in the supported web3 versions, the RPC method is called directly
+            created = self._w3.manager.request_blocking("eth_createAccessList", [
+                {name: Web3.to_hex(value) if isinstance(value, int) else value for name, value in tx_params.items()},
+                Web3.to_hex(block_identifier) if isinstance(block_identifier, (int, bytes)) else block_identifier,
+            ])
+            access_list = [
+                {
+                    "address": Web3.to_checksum_address(entry["address"]),
+                    "storageKeys": [Web3.to_hex(HexBytes(storage_key)) for storage_key in entry["storageKeys"]],
+                }
+                for entry in created["accessList"]
+            ]
+            gas_with_list = self._w3.eth.estimate_gas({**tx_params, "accessList": access_list}, block_identifier)
+            gas_without_list = self._w3.eth.estimate_gas(tx_params, block_identifier)
+        except Exception as e:
+            print(f"No access list: {e}")
+            if _is_unsupported_method(e):
+                # the node has no eth_createAccessList: don't ask it again for this shape and pools
+                access_lists.store(key, [])
+            # else, ex: the call reverts until a pending permit is mined, try again with the next transaction
+            return [], None
+        if gas_with_list >= gas_without_list:
+            access_lists.store(key, [])
+            return [], gas_without_list
+        access_lists.store(key, access_list)
+        return access_list, gas_with_list
+
 
 class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
 
@@ -1007,6 +1319,8 @@ class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         :return: The chain link corresponding to this function call.
         """
         args = ((tuple(pool_key.values()), zero_for_one, amount_in, amount_out_min, hook_data),)
+        self.builder._add_pools("v4", pool_key.values())
+        self.builder._add_hops(1)
         self._add_action(V4Actions.SWAP_EXACT_IN_SINGLE, args)
         return self
 
@@ -1050,6 +1364,8 @@ class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         :return: The chain link corresponding to this function call.
         """
         args = ((currency_in, [tuple(path_key.values()) for path_key in path_keys], amount_in, amount_out_min), )
+        self.builder._add_pools("v4", [currency_in], *(path_key.values() for path_key in path_keys))
+        self.builder._add_hops(len(path_keys))
         self._add_action(V4Actions.SWAP_EXACT_IN, args)
         return self
 
@@ -1071,6 +1387,8 @@ class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         :return: The chain link corresponding to this function call.
         """
         args = ((tuple(pool_key.values()), zero_for_one, amount_out, amount_in_max, hook_data),)
+        self.builder._add_pools("v4", pool_key.values())
+        self.builder._add_hops(1)
         self._add_action(V4Actions.SWAP_EXACT_OUT_SINGLE, args)
         return self
 
@@ -1090,6 +1408,8 @@ class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         :return: The chain link corresponding to this function call.
         """
         args = ((currency_out, [tuple(path_key.values()) for path_key in path_keys], amount_out, amount_in_max), )
+        self.builder._add_pools("v4", [currency_out], *(path_key.values() for path_key in path_keys))
+        self.builder._add_hops(len(path_keys))
         self._add_action(V4Actions.SWAP_EXACT_OUT, args)
         return self
 
@@ -1110,14 +1430,15 @@ class _V4ChainedSwapFunctionBuilder(_V4ChainedCommonFunctionBuilder):
         self._add_action(V4Actions.TAKE_PORTION, args)
         return self
 
-    def build_v4_swap(self) -> _ChainedFunctionBuilder:
+    def build_v4_swap(self, revert_on_fail: bool = True) -> _ChainedFunctionBuilder:
         """
         Build the V4 swap call
 
+        :param revert_on_fail: If False, the rest of the transaction is still executed when this V4 swap fails.
         :return: The chain link corresponding to this function call.
         """
         args = (bytes(self.actions), self.arguments)
-        self.builder._add_command(RouterFunction.V4_SWAP, args)
+        self.builder._add_command(RouterFunction.V4_SWAP, args, actions=bytes(self.actions), revert_on_fail=revert_on_fail)
         return self.builder
 
 
@@ -1184,6 +1505,10 @@ class FunctionABIBuilder:
         self.abi.inputs.append({"name": arg_name, "type": "bytes"})
         return self
 
+    def add_bytes32(self, arg_name: str) -> "FunctionABIBuilder":
+        self.abi.inputs.append({"name": arg_name, "type": "bytes32"})
+        return self
+
     def add_bytes_array(self, arg_name: str) -> "FunctionABIBuilder":
         self.abi.inputs.append({"name": arg_name, "type": "bytes[]"})
         return self
@@ -1196,6 +1521,23 @@ class FunctionABIBuilder:
         self.abi.inputs.append({"name": arg_name, "type": "ExactOutputParams"})
         return self
 
+# The ABI map and the eth_abi encoders are process-wide: they are built and registered once, under this lock,
+# and never modified afterwards, so every codec shares them safely across threads
+_abi_builder_lock = threading.Lock()
+_shared_abi_builder: Optional["_ABIBuilder"] = None
+
+
+def get_shared_abi_map() -> ABIMap:
+    """
+    :return: the read-only ABI map shared by every RouterCodec
+    """
+    global _shared_abi_builder
+    with _abi_builder_lock:
+        if _shared_abi_builder is None:
+            _shared_abi_builder = _ABIBuilder()
+        return _shared_abi_builder.abi_map
+
+
 class _ABIBuilder:
     def __init__(self, w3: Optional[Web3] = None) -> None:
         if w3:
@@ -1203,8 +1545,9 @@ class _ABIBuilder:
         else:
             print("🩷🩷")
 
+        # only used offline, to decode the nested V4 params
         self.w3 = w3 if w3 else Web3()
-        self.abi_map = self.build_abi_map()
+        self.abi_map = MappingProxyType(self.build_abi_map())
         if not registry.has_encoder("ExactInputParams"):
             registry.register("ExactInputParams", self.encode_v4_exact_input_params, self.decode_v4_exact_input_params)
         if not registry.has_encoder("ExactOutputParams"):
@@ -1222,6 +1565,7 @@ class _ABIBuilder:
             RouterFunction.V2_SWAP_EXACT_IN: self._build_v2_swap_exact_in(),
             RouterFunction.V2_SWAP_EXACT_OUT: self._build_v2_swap_exact_out(),
             RouterFunction.PERMIT2_PERMIT: self._build_permit2_permit(),
+            RouterFunction.PERMIT2_PERMIT_BATCH: self._build_permit2_permit_batch(),
             RouterFunction.WRAP_ETH: self._build_wrap_eth(),
             RouterFunction.UNWRAP_WETH: self._build_unwrap_weth(),
             RouterFunction.SWEEP: self._build_sweep(),
@@ -1275,6 +1619,15 @@ class _ABIBuilder:
         outer_struct.add_struct(inner_struct).add_address("spender").add_uint256("sigDeadline")
         return builder.add_struct(outer_struct).add_bytes("data").build()
 
+    @staticmethod
+    def _build_permit2_permit_batch() -> FunctionABI:
+        builder = FunctionABIBuilder(RouterFunction.PERMIT2_PERMIT_BATCH.name)
+        inner_struct_array = builder.create_struct_array("details")
+        inner_struct_array.add_address("token").add_uint160("amount").add_uint48("expiration").add_uint48("nonce")
+        outer_struct = builder.create_struct("struct")
+        outer_struct.add_struct_array(inner_struct_array).add_address("spender").add_uint256("sigDeadline")
+        return builder.add_struct(outer_struct).add_bytes("data").build()
+
     @staticmethod
     def _build_unwrap_weth() -> FunctionABI:
         builder = FunctionABIBuilder(RouterFunction.UNWRAP_WETH.name)
@@ -1576,14 +1929,14 @@ class _Decoder:
             command_function = b & _RouterConstant.COMMAND_TYPE_MASK.value
             try:
                 abi_mapping = self._abi_map[RouterFunction(command_function)]
-                if b == RouterFunction.V4_POSITION_MANAGER_CALL.value:
+                if command_function == RouterFunction.V4_POSITION_MANAGER_CALL.value:
                     data = command_input[i]
                 else:
                     data = abi_mapping.get_selector() + command_input[i]
                 sub_contract = self._w3.eth.contract(abi=abi_mapping.get_full_abi())
                 revert_on_fail = not bool(b & _RouterConstant.FLAG_ALLOW_REVERT.value)
                 decoded_fct_name, decoded_fct_params = sub_contract.decode_function_input(data)
-                if b == RouterFunction.V4_SWAP.value:
+                if command_function == RouterFunction.V4_SWAP.value:
                     decoded_command_input.append(
                         (
                             decoded_fct_name,
@@ -1597,7 +1950,7 @@ class _Decoder:
                             {"revert_on_fail": revert_on_fail},
                         )
                     )
-                elif b == RouterFunction.V4_POSITION_MANAGER_CALL.value:
+                elif command_function == RouterFunction.V4_POSITION_MANAGER_CALL.value:
                     decoded_command_input.append(
                         (
                             decoded_fct_name,
@@ -1812,7 +2165,7 @@ class RouterCodec:
             self._w3 = Web3(Web3.HTTPProvider(rpc_endpoint))
         else:
             self._w3 = Web3()
-        self._abi_map = _ABIBuilder(self._w3).abi_map
+        self._abi_map = get_shared_abi_map()
         self.decode = _Decoder(self._w3, self._abi_map)
         self.encode = _Encoder(self._w3, self._abi_map)
 
@@ -1891,6 +2244,46 @@ class RouterCodec:
         )
         return permit_single, signable_message
 
+    @staticmethod
+    def create_permit2_batch_signable_message(
+            permit_details: Sequence[Tuple[ChecksumAddress, Wei, int, int]],
+            spender: ChecksumAddress,
+            deadline: int,
+            chain_id: int = 8453,
+            verifying_contract: ChecksumAddress = _permit2_address) -> Tuple[Dict[str, Any], SignableMessage]:
+        """
+        Same as create_permit2_signable_message(), for several tokens at once.
+
+        See https://docs.uniswap.org/contracts/permit2/reference/allowance-transfer#batched-permit
+
+        :param permit_details: the (token_address, amount, expiration, nonce) of each token
+        :param spender: The spender (ie: the UR) address
+        :param deadline: The deadline, as a Unix timestamp, on the permit signature
+        :param chain_id: What it says on the box.
+        :param verifying_contract: the permit2 contract address. Default to uniswap permit2 address.
+        :return: A tuple: (PermitBatch, SignableMessage).
+            The first element is the first parameter of permit2_permit_batch().
+            The second element must be signed and the resulting SignedMessage is the 2nd parameter of
+            permit2_permit_batch().
+        """
+        permit_batch = {
+            "details": [
+                {"token": token_address, "amount": amount, "expiration": expiration, "nonce": nonce}
+                for token_address, amount, expiration, nonce in permit_details
+            ],
+            "spender": spender,
+            "sigDeadline": deadline,
+        }
+        domain_data = dict(_permit2_domain_data)
+        domain_data["chainId"] = chain_id
+        domain_data["verifyingContract"] = verifying_contract
+        signable_message = encode_typed_data(
+            domain_data=domain_data,
+            message_types=_permit2_batch_types,
+            message_data=permit_batch,
+        )
+        return permit_batch, signable_message
+
     def fetch_permit2_allowance(
             self,
             wallet: ChecksumAddress,
@@ -0,0 +1,293 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from eth_abi import decode
+from web3 import Web3
+from web3.types import BlockIdentifier, ChecksumAddress
+from uniswap_functions import PoolKey, RouterCodec
+
+# Uniswap V4 PoolManager singleton for each chain
+POOL_MANAGER_ADDRESSES = {
+    "ethereum": "0x000000000004444c5dc75cB358380D2e3dE08A90",
+    "base": "0x498581fF718922c3f8e6A244956aF099B2652b2b",
+    "optimism": "0x9a13F98Cb987694C9F086b1F5eB990EeA8264Ec3",
+    "polygon": "0x67366782805870060151383F4BbFF9daB53e5cD6",
+    "arbitrum": "0x360E68faCcca8cA495c1B759Fd9EEe466db9FB32",
+}
+
+# the block each PoolManager was deployed at, no pool was initialized before it
+POOL_MANAGER_DEPLOYMENT_BLOCKS = {
+    "ethereum": 21688329,
+    "base": 25350988,
+    "optimism": 130947675,
+    "polygon": 66980384,
+    "arbitrum": 297842872,
+}
+
+# keccak("Initialize(bytes32,address,address,uint24,int24,address,uint160,int24)")
+INITIALIZE_TOPIC = "0xdd466e674ea557f56295e2d0218a125ea4b4f0f6f3307b95f85e6110838d6438"
+_initialize_data_types = ["uint24", "int24", "address", "uint160", "int24"]
+
+# Clanker V4 pools use a hook-managed fee, flagged as dynamic in the pool key, and a tick spacing of 200.
+# The other values cover the standard Uniswap fee tiers, in case a deployment is paired differently.
+DYNAMIC_FEE_FLAG = 0x800000
+_candidate_fees = (DYNAMIC_FEE_FLAG, 100, 500, 3000, 10000)
+_candidate_tick_spacings = (200, 1, 10, 60, 100)
+
+_zero_address = "0x0000000000000000000000000000000000000000"
+
+
+@dataclass(frozen=True)
+class PoolRecord:
+    """A known V4 pool: its id, the full PoolKey it was created with, and where it was learned from"""
+    pool_id: str
+    currency_0: ChecksumAddress
+    currency_1: ChecksumAddress
+    fee: int
+    tick_spacing: int
+    hooks: ChecksumAddress
+    source: str = "deployment"
+
+    def pool_key(self) -> PoolKey:
+        return PoolKey(
+            currency_0=self.currency_0,
+            currency_1=self.currency_1,
+            fee=self.fee,
+            tick_spacing=self.tick_spacing,
+            hooks=self.hooks,
+        )
+
+    def zero_for_one(self, from_token: str) -> bool:
+        return from_token.lower() == self.currency_0.lower()
+
+
+def _pair(token_a: str, token_b: str) -> Tuple[str, str]:
+    a, b = token_a.lower(), token_b.lower()
+    return (a, b) if a < b else (b, a)
+
+
+def _pool_id_hex(pool_id: Any) -> str:
+    return Web3.to_hex(pool_id).lower() if isinstance(pool_id, (bytes, bytearray)) else str(pool_id).lower()
+
+
+class PoolRegistry:
+    """
+    Local registry of V4 pools, indexed by token pair and by pool id, so a swap can resolve its exact PoolKey
+    without guessing the fee, tick spacing or hooks.
+    It is filled from the builder token deployment records and from the PoolManager Initialize logs,
+    and optionally persisted to a JSON file.
+    """
+    def __init__(self, codec: RouterCodec, path: Optional[str] = None) -> None:
+        self.codec = codec
+        self.path = path
+        # the last block scanned for every pool, and for the pools of each token by the filtered scans
+        self.last_block = 0
+        self.token_last_blocks: Dict[str, int] = {}
+        # incremented each time a pool is added, so that route caches can be invalidated
+        self.version = 0
+        self._by_id: Dict[str, PoolRecord] = {}
+        self._by_pair: Dict[Tuple[str, str], List[PoolRecord]] = {}
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def add(self, record: PoolRecord) -> bool:
+        """
+        :return: True if the pool was not known yet
+        """
+        with self._lock:
+            if record.pool_id in self._by_id:
+                return False
+            self._by_id[record.pool_id] = record
+            self._by_pair.setdefault(_pair(record.currency_0, record.currency_1), []).append(record)
+            self.version += 1
+            return True
+
+    def get(self, pool_id: Any) -> Optional[PoolRecord]:
+        return self._by_id.get(_pool_id_hex(pool_id))
+
+    def pools_for_pair(self, token_a: str, token_b: str) -> List[PoolRecord]:
+        return list(self._by_pair.get(_pair(token_a, token_b), ()))
+
+    def pools(self) -> List[PoolRecord]:
+        return list(self._by_id.values())
+
+    def resolve(
+            self,
+            from_token: str,
+            to_token: str,
+            rank: Optional[Callable[[List[PoolRecord]], Sequence[Optional[int]]]] = None) -> Optional[Tuple[PoolKey, bool]]:
+        """
+        :param rank: scores the pools of the pair when there are several, ex: the quote of each one for the trade.
+            The pool with the highest score is picked, a None score never is. Default is the first known pool.
+        :return: the tuple (pool_key, zero_for_one) of the pool picked for this pair, None if there is none
+        """
+        pools = self.pools_for_pair(from_token, to_token)
+        if not pools:
+            return None
+        pool = pools[0]
+        if rank is not None and len(pools) > 1:
+            scores = rank(pools)
+            best = max(range(len(pools)), key=lambda index: -1 if scores[index] is None else scores[index])
+            if scores[best] is not None:
+                pool = pools[best]
+        return pool.pool_key(), pool.zero_for_one(from_token)
+
+    def match_pool_id(
+            self,
+            token_a: str,
+            token_b: str,
+            hooks: str,
+            pool_id: Any,
+            source: str = "deployment") -> Optional[PoolRecord]:
+        """
+        Find the PoolKey whose id is pool_id among the candidate fees and tick spacings, and register it.
+
+        :return: the matching pool record, None if no candidate matches
+        """
+        pool_id = _pool_id_hex(pool_id)
+        known = self.get(pool_id)
+        if known:
+            return known
+        for fee in _candidate_fees:
+            for tick_spacing in _candidate_tick_spacings:
+                pool_key = self.codec.encode.v4_pool_key(token_a, token_b, fee, tick_spacing, hooks)
+                if _pool_id_hex(self.codec.encode.v4_pool_id(pool_key)) == pool_id:
+                    record = PoolRecord(pool_id=pool_id, source=source, **pool_key)
+                    self.add(record)
+                    return record
+        return None
+
+    def add_deployments(self, deployments: Iterable[Dict[str, Any]]) -> int:
+        """
+        Register the pools of token deployment records, as returned by the /api/token-deployment endpoint.
+        Only pool_id, pool_hook and paired_token are recorded, so the fee and the tick spacing are recovered
+        by matching the candidate pool ids.
+
+        :return: the number of new pools
+        """
+        added = 0
+        with self._lock:
+            for deployment in deployments:
+                pool_id = deployment.get("pool_id")
+                token_address = deployment.get("token_address")
+                paired_token = deployment.get("paired_token")
+                if not (pool_id and token_address and paired_token):
+                    continue
+                if self.get(pool_id):
+                    continue
+                hooks = deployment.get("pool_hook") or _zero_address
+                if self.match_pool_id(token_address, paired_token, hooks, pool_id):
+                    added += 1
+                else:
+                    print(f"No pool key matches pool id {pool_id} of token {token_address}")
+        if added:
+            self.save()
+        return added
+
+    def add_initialize_logs(self, logs: Sequence[Dict[str, Any]]) -> int:
+        """
+        Register the pools of PoolManager Initialize logs.
+
+        :return: the number of new pools
+        """
+        added = 0
+        with self._lock:
+            for log in logs:
+                topics = log["topics"]
+                fee, tick_spacing, hooks, _sqrt_price_x96, _tick = decode(_initialize_data_types, bytes(log["data"]))
+                record = PoolRecord(
+                    pool_id=_pool_id_hex(bytes(topics[1])),
+                    currency_0=Web3.to_checksum_address(bytes(topics[2])[-20:]),
+                    currency_1=Web3.to_checksum_address(bytes(topics[3])[-20:]),
+                    fee=fee,
+                    tick_spacing=tick_spacing,
+                    hooks=Web3.to_checksum_address(hooks),
+                    source="initialize",
+                )
+                if self.add(record):
+                    added += 1
+        return added
+
+    def _token_last_block(self, token: str) -> int:
+        """:return: the last block scanned for the pools of token, by a filtered or an unfiltered scan"""
+        return max(self.token_last_blocks.get(token.lower(), 0), self.last_block)
+
+    def sync_initialize_logs(
+            self,
+            w3: Web3,
+            pool_manager: ChecksumAddress,
+            from_block: Optional[int] = None,
+            to_block: BlockIdentifier = "latest",
+            tokens: Optional[Sequence[str]] = None,
+            chunk_size: int = 10000,
+            start_block: int = 0) -> int:
+        """
+        Fetch the PoolManager Initialize logs since the last synced block and register their pools.
+        A scan filtered by tokens only moves the synced block of these tokens, a later scan of other tokens
+        or of every pool still starts where they were last synced.
+
+        :param start_block: the first block scanned when nothing was synced yet, ex: the PoolManager deployment block
+        :param tokens: only fetch the pools whose currency_0 is one of these tokens (and, in a second pass,
+            whose currency_1 is). Default is every pool, which can be a lot of logs.
+        :return: the number of new pools
+        """
+        token_keys = [token.lower() for token in tokens] if tokens else []
+        if from_block is not None:
+            start = from_block
+        elif token_keys:
+            start = max(min(self._token_last_block(token) for token in token_keys) + 1, start_block)
+        else:
+            start = max(self.last_block + 1, start_block)
+        end = w3.eth.block_number if not isinstance(to_block, int) else to_block
+        token_topics = [Web3.to_hex(bytes(12) + bytes.fromhex(token[2:])) for token in tokens] if tokens else None
+        topic_filters = [[INITIALIZE_TOPIC, None, token_topics], [INITIALIZE_TOPIC, None, None, token_topics]] \
+            if token_topics else [[INITIALIZE_TOPIC]]
+
+        added = 0
+        for chunk_start in range(start, end + 1, chunk_size):
+            chunk_end = min(chunk_start + chunk_size - 1, end)
+            for topics in topic_filters:
+                logs = w3.eth.get_logs({
+                    "address": Web3.to_checksum_address(pool_manager),
+                    "topics": topics,
+                    "fromBlock": chunk_start,
+                    "toBlock": chunk_end,
+                })
+                added += self.add_initialize_logs(logs)
+        with self._lock:
+            if token_keys:
+                for token in token_keys:
+                    self.token_last_blocks[token] = max(self._token_last_block(token), end)
+            else:
+                self.last_block = max(self.last_block, end)
+        self.save()
+        return added
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "last_block": self.last_block,
+                "token_last_blocks": self.token_last_blocks,
+                "pools": [asdict(record) for record in self._by_id.values()],
+            }
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        with open(self.path) as f:
+            data = json.load(f)
+        with self._lock:
+            self.last_block = data.get("last_block", 0)
+            self.token_last_blocks = data.get("token_last_blocks", {})
+            for record in data.get("pools", []):
+                self.add(PoolRecord(**record))
@@ -0,0 +1,239 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from web3 import Web3
+from web3.types import ChecksumAddress
+from multicall import Multicall, MulticallCall
+from uniswap_functions import FunctionABI, FunctionABIBuilder, PoolKey
+
+# Uniswap V4 Quoter addresses for each chain
+V4_QUOTER_ADDRESSES = {
+    "ethereum": "0x52f0e24d1c21c8a0cb1e5a5dd6198556bd9e1203",
+    "base": "0x0d5e0f971ed27fbff6c2837bf31316121532048d",
+    "optimism": "0x1f3131a13296fb91c90870043742c3cdbff1a8d7",
+    "polygon": "0xb3d5c3dfc3a7aebff71895a7191796bffc2c81b9",
+    "arbitrum": "0x3972c00f7ed4885e145823eb7c655375d275a1c5",
+}
+
+# Uniswap V3 QuoterV2 addresses for each chain
+V3_QUOTER_ADDRESSES = {
+    "ethereum": "0x61fFE014bA17989E743c5F6cB21bF9697530B21e",
+    "base": "0x3d4e44Eb1374240CE5F1B871ab261CD16335B76a",
+    "optimism": "0x61fFE014bA17989E743c5F6cB21bF9697530B21e",
+    "polygon": "0x61fFE014bA17989E743c5F6cB21bF9697530B21e",
+    "arbitrum": "0x61fFE014bA17989E743c5F6cB21bF9697530B21e",
+}
+
+_quote_output_types = ["uint256", "uint256"]
+_v3_quote_output_types = ["uint256", "uint160[]", "uint32[]", "uint256"]
+
+
+def _v4_pool_key_struct_builder() -> FunctionABIBuilder:
+    return (
+        FunctionABIBuilder.create_struct("poolKey")
+        .add_address("currency0")
+        .add_address("currency1")
+        .add_uint24("fee")
+        .add_int24("tickSpacing")
+        .add_address("hooks")
+    )
+
+
+def _build_quote_exact_input_single() -> FunctionABI:
+    params = (
+        FunctionABIBuilder.create_struct("params")
+        .add_struct(_v4_pool_key_struct_builder())
+        .add_bool("zeroForOne")
+        .add_uint128("exactAmount")
+        .add_bytes("hookData")
+    )
+    return FunctionABIBuilder("quoteExactInputSingle").add_struct(params).build()
+
+
+def _build_quote_exact_input() -> FunctionABI:
+    path = (
+        FunctionABIBuilder.create_struct_array("path")
+        .add_address("intermediateCurrency")
+        .add_uint24("fee")
+        .add_int24("tickSpacing")
+        .add_address("hooks")
+        .add_bytes("hookData")
+    )
+    params = (
+        FunctionABIBuilder.create_struct("params")
+        .add_address("exactCurrency")
+        .add_struct_array(path)
+        .add_uint128("exactAmount")
+    )
+    return FunctionABIBuilder("quoteExactInput").add_struct(params).build()
+
+
+def _build_v3_quote_exact_input() -> FunctionABI:
+    return FunctionABIBuilder("quoteExactInput").add_bytes("path").add_uint256("amountIn").build()
+
+
+_quote_exact_input_single = _build_quote_exact_input_single()
+_quote_exact_input = _build_quote_exact_input()
+_v3_quote_exact_input = _build_v3_quote_exact_input()
+
+
+@dataclass(frozen=True)
+class QuoteRequest:
+    """An exact input V4 quote request for a single pool"""
+    pool_key: Tuple
+    zero_for_one: bool
+    amount_in: int
+    hook_data: bytes = b""
+
+    @classmethod
+    def from_pool_key(cls, pool_key: PoolKey, zero_for_one: bool, amount_in: int,
+                      hook_data: bytes = b"") -> "QuoteRequest":
+        return cls(tuple(pool_key.values()), zero_for_one, int(amount_in), hook_data)
+
+
+@dataclass(frozen=True)
+class PathQuoteRequest:
+    """An exact input V4 quote request for a multi-hop path"""
+    currency_in: ChecksumAddress
+    path: Tuple[Tuple, ...]
+    amount_in: int
+
+
+@dataclass(frozen=True)
+class V3QuoteRequest:
+    """An exact input V3 quote request, path being the encoded V3 path"""
+    path: bytes
+    amount_in: int
+
+
+AnyQuoteRequest = Union[QuoteRequest, PathQuoteRequest, V3QuoteRequest]
+
+
+@dataclass(frozen=True)
+class Quote:
+    """The quoter answer for a QuoteRequest, and the block it was computed at"""
+    amount_out: int
+    gas_estimate: int
+    block_number: int
+
+
+def apply_slippage(amount_out: int, slippage: float) -> int:
+    """
+    :param amount_out: the quoted output amount
+    :param slippage: the slippage tolerance in percent (ex: 0.5 for 0.5%)
+    :return: the minimum accepted output amount
+    """
+    slippage_bps = int(round(slippage * 100))
+    if slippage_bps < 0 or slippage_bps > 10_000:
+        raise ValueError(f"Invalid slippage: {slippage}. Must be between 0 and 100 percent")
+    return amount_out * (10_000 - slippage_bps) // 10_000
+
+
+def build_quote_call(quoter_address: ChecksumAddress, request: QuoteRequest) -> MulticallCall:
+    """
+    :param quoter_address: the V4 Quoter address
+    :param request: the exact input quote request
+    :return: the quoteExactInputSingle call, ready to be aggregated
+    """
+    args = ((request.pool_key, request.zero_for_one, request.amount_in, request.hook_data), )
+    return MulticallCall.from_function(quoter_address, _quote_exact_input_single, args, _quote_output_types)
+
+
+def build_path_quote_call(quoter_address: ChecksumAddress, request: PathQuoteRequest) -> MulticallCall:
+    """
+    :param quoter_address: the V4 Quoter address
+    :param request: the exact input multi-hop quote request
+    :return: the quoteExactInput call, ready to be aggregated
+    """
+    args = ((request.currency_in, list(request.path), request.amount_in), )
+    return MulticallCall.from_function(quoter_address, _quote_exact_input, args, _quote_output_types)
+
+
+def build_v3_quote_call(quoter_address: ChecksumAddress, request: V3QuoteRequest) -> MulticallCall:
+    """
+    :param quoter_address: the V3 QuoterV2 address
+    :param request: the exact input V3 quote request
+    :return: the quoteExactInput call, ready to be aggregated
+    """
+    args = (request.path, request.amount_in)
+    return MulticallCall.from_function(quoter_address, _v3_quote_exact_input, args, _v3_quote_output_types)
+
+
+class QuoteEngine:
+    """
+    Get V4 quotes for many pools at once.
+    All the quoter calls are wrapped in a single Multicall3 eth_call, and answers are cached for the block
+    they were computed at, so quoting a whole basket costs one round trip.
+    V3 paths can be quoted in the same batch if a V3 QuoterV2 address is given.
+    """
+    def __init__(
+            self,
+            w3: Web3,
+            quoter_address: ChecksumAddress,
+            multicall: Optional[Multicall] = None,
+            v3_quoter_address: Optional[ChecksumAddress] = None) -> None:
+        self.w3 = w3
+        self.quoter_address = Web3.to_checksum_address(quoter_address)
+        self.v3_quoter_address = Web3.to_checksum_address(v3_quoter_address) if v3_quoter_address else None
+        self.multicall = multicall if multicall else Multicall(w3)
+        self._cache_block: Optional[int] = None
+        self._cache: Dict[AnyQuoteRequest, Optional[Quote]] = {}
+        self._lock = threading.Lock()
+
+    def _build_call(self, request: AnyQuoteRequest) -> MulticallCall:
+        if isinstance(request, V3QuoteRequest):
+            if self.v3_quoter_address is None:
+                raise ValueError("V3 quotes need a V3 quoter address")
+            return build_v3_quote_call(self.v3_quoter_address, request)
+        if isinstance(request, PathQuoteRequest):
+            return build_path_quote_call(self.quoter_address, request)
+        return build_quote_call(self.quoter_address, request)
+
+    def quote_many(self, requests: Sequence[AnyQuoteRequest], block_number: Optional[int] = None) -> List[Optional[Quote]]:
+        """
+        Quote all the requests in one batched call.
+
+        :param requests: the exact input quote requests
+        :param block_number: the block to quote at. Default is the latest block.
+        :return: the quotes, in the same order as the requests. A quote is None if the quoter reverted (ex: no pool)
+        """
+        if block_number is None:
+            block_number = self.w3.eth.block_number
+        with self._lock:
+            if block_number != self._cache_block:
+                self._cache_block = block_number
+                self._cache = {}
+            quotes = {request: self._cache[request] for request in requests if request in self._cache}
+
+        missing = list(dict.fromkeys(request for request in requests if request not in quotes))
+        if missing:
+            calls = [self._build_call(request) for request in missing]
+            result_block, results = self.multicall.aggregate(calls, block_number)
+            for request, result in zip(missing, results):
+                # the gas estimate is the last returned value of both the V3 and the V4 quoters
+                quotes[request] = Quote(int(result[0]), int(result[-1]), result_block) if result else None
+            with self._lock:
+                # another thread may have moved the cache to a newer block meanwhile
+                if self._cache_block == block_number:
+                    self._cache.update((request, quotes[request]) for request in missing)
+
+        return [quotes[request] for request in requests]
+
+    def quote(self, request: AnyQuoteRequest, block_number: Optional[int] = None) -> Optional[Quote]:
+        return self.quote_many([request], block_number)[0]
+
+    def min_amounts_out(
+            self,
+            requests: Sequence[AnyQuoteRequest],
+            slippage: float,
+            block_number: Optional[int] = None) -> List[Optional[int]]:
+        """
+        :param requests: the exact input quote requests
+        :param slippage: the slippage tolerance in percent (ex: 0.5 for 0.5%)
+        :param block_number: the block to quote at. Default is the latest block.
+        :return: the slippage-adjusted minimum output for each request, or None if it could not be quoted
+        """
+        return [
+            apply_slippage(quote.amount_out, slippage) if quote else None
+            for quote in self.quote_many(requests, block_number)
+        ]
@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import ChecksumAddress, TxReceipt
+from uniswap_functions import _ChainedFunctionBuilder, _V4ChainedSwapFunctionBuilder
+from uniswap_pools import PoolRegistry
+from uniswap_quoter import QuoteEngine, apply_slippage
+from uniswap_routing import Route, RouteFinder
+
+# ERC20 Transfer(address,address,uint256)
+_transfer_topic = HexBytes(Web3.keccak(text="Transfer(address,address,uint256)"))
+
+
+@dataclass(frozen=True)
+class RedemptionLeg:
+    """The sale of one holding: amount_in of route.token_in sold through a V4 route"""
+    route: Route
+    amount_in: int
+    amount_out: int
+    amount_out_min: int
+
+    @property
+    def token_in(self) -> ChecksumAddress:
+        return self.route.token_in
+
+
+@dataclass(frozen=True)
+class RedemptionBatch:
+    """Legs sold together in one Universal Router transaction, all of them to token_out"""
+    token_out: ChecksumAddress
+    legs: Tuple[RedemptionLeg, ...]
+
+    @property
+    def amount_out(self) -> int:
+        return sum(leg.amount_out for leg in self.legs)
+
+    @property
+    def amount_out_min(self) -> int:
+        return sum(leg.amount_out_min for leg in self.legs)
+
+    def add_to_chain(self, builder: _ChainedFunctionBuilder, revert_on_fail: bool = True) -> _ChainedFunctionBuilder:
+        """
+        Append the V4 swaps selling every leg. The input tokens must already be permitted to the router
+        (ex: with permit2_permit_batch).
+
+        :param revert_on_fail: if True, a single V4_SWAP command: one swap action per leg, each with its own
+        minimum output, then one settlement per input token and one take of the whole output.
+        If False, one V4_SWAP command per leg, allowed to revert, so a failing leg is skipped and the others settle.
+        """
+        if revert_on_fail:
+            v4_swap = builder.v4_swap()
+            for leg in self.legs:
+                self._add_swap(v4_swap, leg)
+            for leg in self.legs:
+                v4_swap.settle_all(leg.token_in, leg.amount_in)
+            return v4_swap.take_all(self.token_out, self.amount_out_min).build_v4_swap()
+
+        for leg in self.legs:
+            v4_swap = self._add_swap(builder.v4_swap(), leg)
+            builder = v4_swap.settle_all(leg.token_in, leg.amount_in) \
+                .take_all(self.token_out, leg.amount_out_min) \
+                .build_v4_swap(revert_on_fail=False)
+        return builder
+
+    @staticmethod
+    def _add_swap(v4_swap: _V4ChainedSwapFunctionBuilder, leg: RedemptionLeg) -> _V4ChainedSwapFunctionBuilder:
+        if leg.route.hops == 1:
+            pool = leg.route.pools[0]
+            return v4_swap.swap_exact_in_single(
+                pool_key=pool.pool_key(),
+                zero_for_one=pool.zero_for_one(leg.token_in),
+                amount_in=leg.amount_in,
+                amount_out_min=leg.amount_out_min,
+            )
+        return v4_swap.swap_exact_in(leg.token_in, leg.route.v4_path_keys(), leg.amount_in, leg.amount_out_min)
+
+    def failed_legs(self, receipt: TxReceipt, owner: str) -> List[RedemptionLeg]:
+        """
+        :param receipt: the receipt of the transaction selling this batch
+        :param owner: the sender of the transaction
+        :return: the legs that were not sold: all of them if the transaction reverted, else the legs
+        whose input token was never transferred from owner, their V4_SWAP command having reverted
+        """
+        if receipt["status"] != 1:
+            return list(self.legs)
+        owner_topic = HexBytes(bytes(12) + bytes.fromhex(Web3.to_checksum_address(owner)[2:]))
+        sold = {
+            Web3.to_checksum_address(log["address"])
+            for log in receipt["logs"]
+            if len(log["topics"]) == 3 and HexBytes(log["topics"][0]) == _transfer_topic
+            and HexBytes(log["topics"][1]) == owner_topic
+        }
+        return [leg for leg in self.legs if leg.token_in not in sold]
+
+
+class RedemptionPlanner:
+    """
+    Plan the sale of several holdings to one target token, as V4 swaps grouped in as few
+    Universal Router transactions as possible.
+    The V4 routes of every holding are quoted in one batch and the best one is kept for each.
+    """
+    def __init__(self, registry: PoolRegistry, route_finder: RouteFinder, quote_engine: QuoteEngine) -> None:
+        self.registry = registry
+        self.route_finder = route_finder
+        self.quote_engine = quote_engine
+
+    def plan(
+            self,
+            holdings: Sequence[Tuple[str, int]],
+            token_out: str,
+            slippage: float,
+            max_legs_per_tx: int = 8,
+            block_number: Optional[int] = None) -> Tuple[List[RedemptionBatch], List[ChecksumAddress]]:
+        """
+        :param holdings: the (token, amount in wei) to sell
+        :param token_out: the token received for all of them
+        :param slippage: slippage tolerance in percent, applied to the quote of each leg
+        :param max_legs_per_tx: legs per transaction at most, to stay well within the block gas limit
+        :return: the tuple (batches, tokens without any V4 route to token_out)
+        """
+        token_out = Web3.to_checksum_address(token_out)
+        candidates: List[Tuple[int, Route]] = []
+        skipped: List[ChecksumAddress] = []
+        for index, (token_in, amount_in) in enumerate(holdings):
+            token_in = Web3.to_checksum_address(token_in)
+            if token_in == token_out or amount_in <= 0:
+                continue
+            routes = [route for route in self.route_finder.candidate_routes(token_in, token_out)
+                      if route.protocol == "v4"]
+            if not routes:
+                print(f"No V4 route from {token_in} to {token_out}")
+                skipped.append(token_in)
+            candidates.extend((index, route) for route in routes)
+
+        quotes = self.quote_engine.quote_many(
+            [route.quote_request(holdings[index][1]) for index, route in candidates], block_number)
+        best: Dict[int, RedemptionLeg] = {}
+        for (index, route), quote in zip(candidates, quotes):
+            if not quote or quote.amount_out == 0:
+                continue
+            if index not in best or quote.amount_out > best[index].amount_out:
+                amount_in = int(holdings[index][1])
+                best[index] = RedemptionLeg(route, amount_in, quote.amount_out,
+                                            apply_slippage(quote.amount_out, slippage))
+        for index in {index for index, _route in candidates} - set(best):
+            print(f"No V4 route from {holdings[index][0]} to {token_out} could be quoted")
+            skipped.append(Web3.to_checksum_address(holdings[index][0]))
+
+        legs = [best[index] for index in sorted(best)]
+        batches = [
+            RedemptionBatch(token_out, tuple(legs[i:i + max_legs_per_tx]))
+            for i in range(0, len(legs), max_legs_per_tx)
+        ]
+        return batches, skipped
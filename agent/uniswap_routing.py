@@ -0,0 +1,266 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+from web3 import Web3
+from web3.types import ChecksumAddress
+from uniswap_functions import FunctionRecipient, _ChainedFunctionBuilder, _Encoder
+from uniswap_pools import PoolRecord, PoolRegistry
+from uniswap_quoter import AnyQuoteRequest, PathQuoteRequest, QuoteEngine, QuoteRequest, V3QuoteRequest
+
+# Wrapped native token for each chain, used as V3 connector and as gas price reference
+WETH_ADDRESSES = {
+    "ethereum": "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2",
+    "base": "0x4200000000000000000000000000000000000006",
+    "optimism": "0x4200000000000000000000000000000000000006",
+    "polygon": "0x7ceB23fD6bC0adD59E62ac25578270cFf1b9f619",
+    "arbitrum": "0x82aF49447D8a07e3bd95BD0d56f35241523fBab1",
+}
+
+V3_FEE_TIERS = (500, 3000, 10000)
+
+# amount of WETH quoted to convert the gas cost of a route into output tokens
+_gas_reference_amount = 10 ** 15
+
+
+@dataclass(frozen=True)
+class Route:
+    """
+    A swap route from tokens[0] to tokens[-1].
+    V4 routes go through the registry pools, V3 routes through the fee tier between each pair of tokens.
+    """
+    protocol: str
+    tokens: Tuple[ChecksumAddress, ...]
+    pools: Tuple[PoolRecord, ...] = ()
+    fees: Tuple[int, ...] = ()
+
+    @property
+    def hops(self) -> int:
+        return len(self.tokens) - 1
+
+    @property
+    def token_in(self) -> ChecksumAddress:
+        return self.tokens[0]
+
+    @property
+    def token_out(self) -> ChecksumAddress:
+        return self.tokens[-1]
+
+    def v3_path(self) -> List:
+        """:return: the V3 path: token_in, fee, token, fee, ..., token_out"""
+        path: List = [self.tokens[0]]
+        for fee, token in zip(self.fees, self.tokens[1:]):
+            path.extend([fee, token])
+        return path
+
+    def v4_path_keys(self) -> List:
+        return [
+            _Encoder.v4_path_key(token, pool.fee, pool.tick_spacing, pool.hooks)
+            for pool, token in zip(self.pools, self.tokens[1:])
+        ]
+
+    def quote_request(self, amount_in: int) -> AnyQuoteRequest:
+        if self.protocol == "v3":
+            return V3QuoteRequest(_Encoder.v3_path("V3_SWAP_EXACT_IN", self.v3_path()), int(amount_in))
+        if self.hops == 1:
+            pool = self.pools[0]
+            return QuoteRequest.from_pool_key(pool.pool_key(), pool.zero_for_one(self.token_in), amount_in)
+        path = tuple(tuple(path_key.values()) for path_key in self.v4_path_keys())
+        return PathQuoteRequest(self.token_in, path, int(amount_in))
+
+    def add_to_chain(
+            self,
+            builder: _ChainedFunctionBuilder,
+            amount_in: int,
+            amount_out_min: int) -> _ChainedFunctionBuilder:
+        """
+        Append the swap commands of this route to a Universal Router chain of commands.
+        The input tokens are pulled from the sender through Permit2 and the output tokens are sent to the sender.
+        """
+        if self.protocol == "v3":
+            return builder.v3_swap_exact_in(FunctionRecipient.SENDER, amount_in, amount_out_min, self.v3_path())
+        v4_swap = builder.v4_swap()
+        if self.hops == 1:
+            pool = self.pools[0]
+            v4_swap.swap_exact_in_single(
+                pool_key=pool.pool_key(),
+                zero_for_one=pool.zero_for_one(self.token_in),
+                amount_in=amount_in,
+                amount_out_min=amount_out_min,
+            )
+        else:
+            v4_swap.swap_exact_in(self.token_in, self.v4_path_keys(), amount_in, amount_out_min)
+        return v4_swap.take_all(self.token_out, 0).settle_all(self.token_in, amount_in).build_v4_swap()
+
+    def __str__(self) -> str:
+        return f"{self.protocol}: " + " -> ".join(self.tokens)
+
+
+@dataclass(frozen=True)
+class RouteQuote:
+    """A quoted route. score is the quoted output minus the gas cost, both in output tokens."""
+    route: Route
+    amount_in: int
+    amount_out: int
+    gas_estimate: int
+    gas_cost_out: int
+    block_number: int
+
+    @property
+    def score(self) -> int:
+        return self.amount_out - self.gas_cost_out
+
+
+class RouteFinder:
+    """
+    Find the best swap route over the local pool graph: V4 paths through the registry pools, and V3 paths
+    through the fee tiers, directly or via a connector token (WETH by default).
+    All the candidate routes of a pair are quoted in one batch and ranked by quoted output minus gas.
+
+    Candidate routes are cached per pair until the registry learns new pools, best routes are cached per
+    pair and amount for the block they were quoted at, as any swap in a later block changes the pool state.
+    """
+    def __init__(
+            self,
+            registry: PoolRegistry,
+            quote_engine: QuoteEngine,
+            weth_address: ChecksumAddress,
+            connectors: Optional[Sequence[str]] = None,
+            max_hops: int = 3,
+            v3_fee_tiers: Sequence[int] = V3_FEE_TIERS) -> None:
+        self.registry = registry
+        self.quote_engine = quote_engine
+        self.weth_address = Web3.to_checksum_address(weth_address)
+        self.connectors = [Web3.to_checksum_address(c) for c in connectors] if connectors else [self.weth_address]
+        self.max_hops = max_hops
+        self.v3_fee_tiers = tuple(v3_fee_tiers)
+        self._lock = threading.Lock()
+        self._graph_version = -1
+        self._graph: Dict[str, List[PoolRecord]] = {}
+        self._routes: Dict[Tuple[str, str], List[Route]] = {}
+        self._best_block: Optional[int] = None
+        self._best: Dict[Tuple[str, str, int, int], Optional[RouteQuote]] = {}
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._graph_version = -1
+            self._routes = {}
+            self._best = {}
+
+    def _refresh_graph(self) -> None:
+        if self._graph_version == self.registry.version:
+            return
+        graph: Dict[str, List[PoolRecord]] = {}
+        for pool in self.registry.pools():
+            graph.setdefault(pool.currency_0.lower(), []).append(pool)
+            graph.setdefault(pool.currency_1.lower(), []).append(pool)
+        self._graph = graph
+        self._routes = {}
+        self._best = {}
+        self._graph_version = self.registry.version
+
+    def _v4_routes(self, token_in: ChecksumAddress, token_out: ChecksumAddress) -> List[Route]:
+        routes: List[Route] = []
+        target = token_out.lower()
+
+        def walk(tokens: List[ChecksumAddress], pools: List[PoolRecord]) -> None:
+            current = tokens[-1]
+            for pool in self._graph.get(current.lower(), ()):
+                if pool in pools:
+                    continue
+                following = pool.currency_1 if pool.currency_0.lower() == current.lower() else pool.currency_0
+                if following.lower() == target:
+                    routes.append(Route("v4", tuple(tokens + [following]), tuple(pools + [pool])))
+                elif len(pools) + 1 < self.max_hops and following not in tokens:
+                    walk(tokens + [following], pools + [pool])
+
+        walk([token_in], [])
+        return routes
+
+    def _v3_routes(self, token_in: ChecksumAddress, token_out: ChecksumAddress) -> List[Route]:
+        routes = [Route("v3", (token_in, token_out), fees=(fee, )) for fee in self.v3_fee_tiers]
+        for connector in self.connectors:
+            if connector.lower() in (token_in.lower(), token_out.lower()):
+                continue
+            routes.extend(
+                Route("v3", (token_in, connector, token_out), fees=(fee_in, fee_out))
+                for fee_in in self.v3_fee_tiers
+                for fee_out in self.v3_fee_tiers
+            )
+        return routes
+
+    def candidate_routes(self, token_in: str, token_out: str) -> List[Route]:
+        """
+        :return: every V4 path of at most max_hops pools, and every direct or single connector V3 path
+        """
+        token_in, token_out = Web3.to_checksum_address(token_in), Web3.to_checksum_address(token_out)
+        with self._lock:
+            self._refresh_graph()
+            key = (token_in.lower(), token_out.lower())
+            routes = self._routes.get(key)
+            if routes is None:
+                routes = self._v4_routes(token_in, token_out)
+                if self.quote_engine.v3_quoter_address:
+                    routes += self._v3_routes(token_in, token_out)
+                self._routes[key] = routes
+            return routes
+
+    def find_best(
+            self,
+            token_in: str,
+            token_out: str,
+            amount_in: int,
+            gas_price: int = 0,
+            block_number: Optional[int] = None) -> Optional[RouteQuote]:
+        """
+        Quote all the candidate routes in one batch and return the best one.
+
+        :param token_in: the sold token
+        :param token_out: the bought token
+        :param amount_in: the exact amount sold, in wei
+        :param gas_price: the expected gas price in wei. If 0, routes are only ranked by quoted output.
+        :param block_number: the block to quote at. Default is the latest block.
+        :return: the best route and its quote, None if no route could be quoted
+        """
+        if block_number is None:
+            block_number = self.quote_engine.w3.eth.block_number
+        routes = self.candidate_routes(token_in, token_out)
+        key = (token_in.lower(), token_out.lower(), int(amount_in), int(gas_price))
+        with self._lock:
+            if self._best_block != block_number:
+                self._best_block = block_number
+                self._best = {}
+            if key in self._best:
+                return self._best[key]
+        if not routes:
+            return None
+
+        requests = [route.quote_request(amount_in) for route in routes]
+        reference_routes: List[Route] = []
+        if gas_price and Web3.to_checksum_address(token_out) != self.weth_address:
+            reference_routes = [
+                route for route in self.candidate_routes(self.weth_address, token_out) if route.hops == 1
+            ]
+            requests += [route.quote_request(_gas_reference_amount) for route in reference_routes]
+        quotes = self.quote_engine.quote_many(requests, block_number)
+
+        # output tokens per wei of gas, taken from the best direct WETH pool of the output token
+        reference_out = _gas_reference_amount if Web3.to_checksum_address(token_out) == self.weth_address else 0
+        for quote in quotes[len(routes):]:
+            if quote:
+                reference_out = max(reference_out, quote.amount_out)
+
+        best: Optional[RouteQuote] = None
+        for route, quote in zip(routes, quotes[:len(routes)]):
+            if not quote or quote.amount_out == 0:
+                continue
+            gas_cost_out = quote.gas_estimate * gas_price * reference_out // _gas_reference_amount
+            route_quote = RouteQuote(route, int(amount_in), quote.amount_out, quote.gas_estimate, gas_cost_out,
+                                     quote.block_number)
+            # prefer fewer hops for equal scores
+            if best is None or (route_quote.score, -route.hops) > (best.score, -best.route.hops):
+                best = route_quote
+
+        with self._lock:
+            if self._best_block == block_number:
+                self._best[key] = best
+        return best
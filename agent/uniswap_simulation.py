@@ -0,0 +1,228 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from eth_abi import decode
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import BlockIdentifier, TxParams, Wei
+from uniswap_functions import RouterCodec, _permit2_abi, _pool_manager_abi, _position_manager_abi, _router_abi
+from web3_rpc import batch_responses
+
+# Error(string) and Panic(uint256) are the reverts of require() and of failed asserts / overflows
+_error_string_selector = "0x08c379a0"
+_panic_selector = "0x4e487b71"
+# WrappedError(address,bytes4,bytes,bytes): a V4 hook or token call reverted inside the PoolManager
+_wrapped_error_selector = "0x90bfb865"
+
+# OpenZeppelin v5 ERC20 errors, used by the Clanker tokens
+_erc20_errors_abi = (
+    '[{"inputs":[{"name":"sender","type":"address"},{"name":"balance","type":"uint256"},'
+    '{"name":"needed","type":"uint256"}],"name":"ERC20InsufficientBalance","type":"error"},'
+    '{"inputs":[{"name":"spender","type":"address"},{"name":"allowance","type":"uint256"},'
+    '{"name":"needed","type":"uint256"}],"name":"ERC20InsufficientAllowance","type":"error"}]'
+)
+_error_abis = (_permit2_abi, _pool_manager_abi, _position_manager_abi, _router_abi, _erc20_errors_abi)
+
+# the nested reverts are unwrapped at most this many times
+_max_error_depth = 4
+
+_max_uint256 = 2 ** 256 - 1
+
+
+def _word(value: Union[int, str]) -> bytes:
+    if isinstance(value, str):
+        return bytes(12) + bytes.fromhex(value[2:])
+    return value.to_bytes(32, "big")
+
+
+def mapping_slot(key: Union[int, str], slot: int) -> bytes:
+    """
+    :return: the storage slot of mapping[key], for a mapping declared at slot
+    """
+    return Web3.keccak(_word(key) + _word(slot))
+
+
+class StateOverrides:
+    """
+    Builder of the eth_call state override set, to simulate a transaction as if some balances or allowances
+    were already in place. ERC20 values are written to the storage of the token, so the mapping slots must
+    match its layout: the defaults are those of the OpenZeppelin ERC20 (balances at 0, allowances at 1).
+    """
+    def __init__(self) -> None:
+        self._overrides: Dict[str, Dict[str, Any]] = {}
+
+    def _account(self, address: str) -> Dict[str, Any]:
+        return self._overrides.setdefault(Web3.to_checksum_address(address), {})
+
+    def _store(self, address: str, slot: bytes, value: int) -> "StateOverrides":
+        state_diff = self._account(address).setdefault("stateDiff", {})
+        state_diff[Web3.to_hex(slot)] = Web3.to_hex(_word(value))
+        return self
+
+    def eth_balance(self, address: str, amount: Wei) -> "StateOverrides":
+        self._account(address)["balance"] = hex(amount)
+        return self
+
+    def token_balance(self, token: str, owner: str, amount: int, slot: int = 0) -> "StateOverrides":
+        return self._store(token, mapping_slot(Web3.to_checksum_address(owner), slot), amount)
+
+    def token_allowance(
+            self,
+            token: str,
+            owner: str,
+            spender: str,
+            amount: int = _max_uint256,
+            slot: int = 1) -> "StateOverrides":
+        owner_slot = mapping_slot(Web3.to_checksum_address(owner), slot)
+        allowance_slot = Web3.keccak(_word(Web3.to_checksum_address(spender)) + owner_slot)
+        return self._store(token, allowance_slot, amount)
+
+    def merge(self, other: Optional["StateOverrides"]) -> "StateOverrides":
+        """:return: a new set with the overrides of both, other taking precedence"""
+        merged = StateOverrides()
+        for overrides in (self, other):
+            if overrides is None:
+                continue
+            for address, account in overrides._overrides.items():
+                target = merged._account(address)
+                for key, value in account.items():
+                    target[key] = {**target.get(key, {}), **value} if key == "stateDiff" else value
+        return merged
+
+    def to_rpc(self) -> Dict[str, Dict[str, Any]]:
+        return {address: dict(account) for address, account in self._overrides.items()}
+
+    def __bool__(self) -> bool:
+        return bool(self._overrides)
+
+
+@dataclass
+class SimulationResult:
+    """
+    The outcome of a simulated transaction.
+    error is the decoded revert, ex: 'V3TooLittleReceived()', and error_params its arguments.
+    A revert wrapped by the Universal Router or the PoolManager is unwrapped: error_trace lists every layer.
+    """
+    success: bool
+    return_data: HexBytes = HexBytes(b"")
+    error: Optional[str] = None
+    error_params: Dict[str, Any] = field(default_factory=dict)
+    error_trace: List[str] = field(default_factory=list)
+    raw_error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.success:
+            return "success"
+        return " -> ".join(self.error_trace) if self.error_trace else f"reverted: {self.error}"
+
+
+def decode_revert(codec: RouterCodec, data: Union[bytes, str]) -> Tuple[str, Dict[str, Any], List[str]]:
+    """
+    Decode revert data, unwrapping the Universal Router ExecutionFailed and the V4 WrappedError reverts.
+
+    :return: the tuple (innermost error, its params, every decoded layer from the outermost)
+    """
+    trace: List[str] = []
+    error, params = "Unknown error", {}
+    data = HexBytes(data)
+    for _ in range(_max_error_depth):
+        if len(data) < 4:
+            error, params = ("Reverted without reason", {}) if not trace else (error, params)
+            break
+        selector, payload = Web3.to_hex(data[:4]), data[4:]
+        if selector == _error_string_selector:
+            error, params = f"Error({decode(['string'], payload)[0]})", {}
+            trace.append(error)
+            break
+        if selector == _panic_selector:
+            error, params = f"Panic({hex(decode(['uint256'], payload)[0])})", {}
+            trace.append(error)
+            break
+        if selector == _wrapped_error_selector:
+            target, wrapped_selector, reason, _details = decode(["address", "bytes4", "bytes", "bytes"], payload)
+            trace.append(f"WrappedError({target}, {Web3.to_hex(wrapped_selector)})")
+            data = HexBytes(reason)
+            continue
+        error, params = codec.decode.contract_error(Web3.to_hex(data), _error_abis)
+        if error == "Unknown error":
+            error = f"Unknown error {selector}"
+        trace.append(error)
+        if error.startswith("ExecutionFailed(") and params.get("message"):
+            data = HexBytes(params["message"])
+            continue
+        break
+    return error, dict(params), trace
+
+
+def _revert_data(error: Dict[str, Any]) -> Optional[str]:
+    """Nodes put the revert data either in error.data or, for some providers, one level deeper"""
+    data = error.get("data")
+    if isinstance(data, dict):
+        data = data.get("data") or data.get("result")
+    if isinstance(data, str) and data.startswith("0x"):
+        return data
+    return None
+
+
+class Simulator:
+    """
+    Simulate Universal Router transactions with eth_call before they are signed and sent,
+    optionally on top of state overrides.
+    Many transactions are simulated in one batched RPC request, against the same block.
+    """
+    def __init__(self, w3: Web3, codec: RouterCodec) -> None:
+        self.w3 = w3
+        self.codec = codec
+
+    @staticmethod
+    def _call_object(tx_params: TxParams) -> Dict[str, Any]:
+        # fee fields are left out so the sender's ETH balance is not checked against the gas cost
+        call = {
+            "from": tx_params["from"],
+            "to": tx_params["to"],
+            "data": Web3.to_hex(HexBytes(tx_params["data"])),
+            "value": hex(tx_params.get("value", 0)),
+        }
+        if tx_params.get("gas"):
+            call["gas"] = hex(tx_params["gas"])
+        return call
+
+    def _result(self, response: Dict[str, Any]) -> SimulationResult:
+        if "error" not in response:
+            return SimulationResult(True, HexBytes(response.get("result") or b""))
+        raw_error = _revert_data(response["error"])
+        if raw_error is None:
+            message = response["error"].get("message", "eth_call failed")
+            return SimulationResult(False, error=message, error_trace=[message])
+        error, params, trace = decode_revert(self.codec, raw_error)
+        return SimulationResult(False, error=error, error_params=params, error_trace=trace, raw_error=raw_error)
+
+    def simulate_many(
+            self,
+            txs: Sequence[TxParams],
+            state_overrides: Optional[Sequence[Optional[StateOverrides]]] = None,
+            block_identifier: BlockIdentifier = "latest") -> List[SimulationResult]:
+        """
+        Simulate independent transactions in one batch. Each one runs on top of the block state only,
+        not on top of the others.
+
+        :param txs: the transactions, as returned by build_transaction
+        :param state_overrides: optional overrides for each transaction
+        :param block_identifier: the block to simulate against. Default is the latest block.
+        :return: the result of each transaction, in the same order
+        """
+        block = block_identifier if isinstance(block_identifier, str) else hex(block_identifier)
+        calls = []
+        for i, tx_params in enumerate(txs):
+            params: List[Any] = [self._call_object(tx_params), block]
+            overrides = state_overrides[i] if state_overrides else None
+            if overrides:
+                params.append(overrides.to_rpc())
+            calls.append(("eth_call", params))
+        return [self._result(response) for response in batch_responses(self.w3, calls)]
+
+    def simulate(
+            self,
+            tx_params: TxParams,
+            state_override: Optional[StateOverrides] = None,
+            block_identifier: BlockIdentifier = "latest") -> SimulationResult:
+        return self.simulate_many([tx_params], [state_override], block_identifier)[0]
@@ -0,0 +1,285 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from eth_abi import encode
+from eth_utils import keccak
+from web3 import Web3
+from web3.types import ChecksumAddress
+from multicall import Multicall, MulticallCall
+from uniswap_functions import FunctionABIBuilder, FunctionRecipient, _ChainedFunctionBuilder
+from uniswap_pools import PoolRegistry
+from uniswap_quoter import AnyQuoteRequest, QuoteEngine, apply_slippage
+from uniswap_routing import V3_FEE_TIERS, Route
+
+# Uniswap V3 factory for each chain, pools are deployed with CREATE2 so their addresses are computed offline
+V3_FACTORY_ADDRESSES = {
+    "ethereum": "0x1F98431c8aD98523631AE4a59f267346ea31F984",
+    "base": "0x33128a8fC17869897dcE68Ed026d694621f6FDfD",
+    "optimism": "0x1F98431c8aD98523631AE4a59f267346ea31F984",
+    "polygon": "0x1F98431c8aD98523631AE4a59f267346ea31F984",
+    "arbitrum": "0x1F98431c8aD98523631AE4a59f267346ea31F984",
+}
+V3_POOL_INIT_CODE_HASH = bytes.fromhex("e34f199b19b2b4f47f68442619d555527d244f78a3297ea89325f843f87b8b54")
+
+# Uniswap V4 StateView, the read-only lens on the PoolManager state
+V4_STATE_VIEW_ADDRESSES = {
+    "ethereum": "0x7fFE42C4a5DEeA5b0feC41C94C136Cf115597227",
+    "base": "0xA3c0c9b65baD0b08107Aa264b0f3dB444b867A71",
+    "optimism": "0xc18a3169788F4F75A170290584ECA6395C75Ecdb",
+    "polygon": "0x5eA1bD7974c8A611cBAB0bDCAFcB1D9CC9b3BA5a",
+    "arbitrum": "0x76Fd297e2D437cd7f76d50F01AfE6160f86e9990",
+}
+
+_v3_slot0 = FunctionABIBuilder("slot0").build()
+_v3_slot0_output_types = ["uint160", "int24", "uint16", "uint16", "uint16", "uint8", "bool"]
+_v3_liquidity = FunctionABIBuilder("liquidity").build()
+_v4_get_slot0 = FunctionABIBuilder("getSlot0").add_bytes32("poolId").build()
+_v4_get_slot0_output_types = ["uint160", "int24", "uint24", "uint24"]
+_v4_get_liquidity = FunctionABIBuilder("getLiquidity").add_bytes32("poolId").build()
+_liquidity_output_types = ["uint128"]
+
+_q96 = 2.0 ** 96
+
+
+def v3_pool_address(factory: str, token_a: str, token_b: str, fee: int) -> ChecksumAddress:
+    """
+    :return: the CREATE2 address of the V3 pool of this pair and fee tier, whether it is deployed or not
+    """
+    token_0, token_1 = sorted((Web3.to_checksum_address(token_a), Web3.to_checksum_address(token_b)),
+                              key=lambda token: int(token, 16))
+    salt = keccak(encode(["address", "address", "uint24"], [token_0, token_1, fee]))
+    return Web3.to_checksum_address(keccak(b"\xff" + bytes.fromhex(factory[2:]) + salt + V3_POOL_INIT_CODE_HASH)[12:])
+
+
+@dataclass(frozen=True)
+class PoolState:
+    """
+    The current price and in-range liquidity of a candidate pool, seen from the token_in -> token_out direction.
+    fee is in hundredths of a bip (3000 is 0.3%).
+    """
+    route: Route
+    fee: int
+    sqrt_price_x96: int
+    liquidity: int
+
+    @property
+    def zero_for_one(self) -> bool:
+        return int(self.route.token_in, 16) < int(self.route.token_out, 16)
+
+    def virtual_reserves(self) -> Tuple[float, float]:
+        """
+        :return: the (reserve_in, reserve_out) of the constant product curve matching the in-range liquidity
+        """
+        sqrt_price = self.sqrt_price_x96 / _q96
+        reserve_0, reserve_1 = self.liquidity / sqrt_price, self.liquidity * sqrt_price
+        return (reserve_0, reserve_1) if self.zero_for_one else (reserve_1, reserve_0)
+
+
+def optimal_split(
+        reserves_in: np.ndarray,
+        reserves_out: np.ndarray,
+        gammas: np.ndarray,
+        amount_in: float,
+        iterations: int = 100) -> np.ndarray:
+    """
+    Split amount_in between constant product pools so that the total output is maximal, by equalizing the
+    marginal prices: the marginal output of a pool is gamma * x * y / (x + gamma * a) ** 2, and each pool
+    receives the amount at which its marginal output is the common level, found by bisection.
+
+    :param reserves_in: the virtual input reserve of each pool
+    :param reserves_out: the virtual output reserve of each pool
+    :param gammas: 1 - fee of each pool
+    :param amount_in: the amount to split
+    :return: the amount sent to each pool, summing to amount_in
+    """
+    k = gammas * reserves_in * reserves_out
+    # at the highest marginal price no pool gets anything, at the lowest one the best pool alone gets everything
+    log_high = np.log(np.max(k / reserves_in ** 2))
+    log_low = np.log(np.min(k / (reserves_in + gammas * amount_in) ** 2))
+    for _ in range(iterations):
+        level = np.exp((log_high + log_low) / 2)
+        allocated = np.maximum(0.0, (np.sqrt(k / level) - reserves_in) / gammas)
+        if allocated.sum() > amount_in:
+            log_low = np.log(level)
+        else:
+            log_high = np.log(level)
+    allocated = np.maximum(0.0, (np.sqrt(k / np.exp(log_high)) - reserves_in) / gammas)
+    total = allocated.sum()
+    return allocated * (amount_in / total) if total > 0 else allocated
+
+
+@dataclass(frozen=True)
+class SplitSlice:
+    pool: PoolState
+    amount_in: int
+    amount_out: int
+    amount_out_min: int
+
+
+@dataclass(frozen=True)
+class SplitPlan:
+    """The slices of a split order, all quoted at the same block"""
+    token_in: ChecksumAddress
+    token_out: ChecksumAddress
+    slices: Tuple[SplitSlice, ...]
+    block_number: int
+
+    @property
+    def amount_in(self) -> int:
+        return sum(s.amount_in for s in self.slices)
+
+    @property
+    def amount_out(self) -> int:
+        return sum(s.amount_out for s in self.slices)
+
+    @property
+    def amount_out_min(self) -> int:
+        return sum(s.amount_out_min for s in self.slices)
+
+    def add_to_chain(self, builder: _ChainedFunctionBuilder) -> _ChainedFunctionBuilder:
+        """
+        Append every slice to a Universal Router chain of commands: one V3_SWAP_EXACT_IN command per V3 slice,
+        and a single V4_SWAP command holding all the V4 slices.
+        """
+        v4_slices = [s for s in self.slices if s.pool.route.protocol == "v4"]
+        for s in self.slices:
+            if s.pool.route.protocol == "v3":
+                builder = builder.v3_swap_exact_in(
+                    FunctionRecipient.SENDER, s.amount_in, s.amount_out_min, s.pool.route.v3_path()
+                )
+        if v4_slices:
+            v4_swap = builder.v4_swap()
+            for s in v4_slices:
+                pool = s.pool.route.pools[0]
+                v4_swap.swap_exact_in_single(
+                    pool_key=pool.pool_key(),
+                    zero_for_one=pool.zero_for_one(self.token_in),
+                    amount_in=s.amount_in,
+                    amount_out_min=s.amount_out_min,
+                )
+            v4_amount_in = sum(s.amount_in for s in v4_slices)
+            builder = v4_swap.take_all(self.token_out, 0).settle_all(self.token_in, v4_amount_in).build_v4_swap()
+        return builder
+
+
+class SplitOptimizer:
+    """
+    Split an order between the parallel V3 and V4 pools of a pair.
+    The price and liquidity of every candidate pool are read in one Multicall3 batch, the output-maximizing
+    split is computed offline, then all the slices are quoted in one more batch to set their minimum outputs.
+    """
+    def __init__(
+            self,
+            registry: PoolRegistry,
+            quote_engine: QuoteEngine,
+            chain: str,
+            multicall: Optional[Multicall] = None,
+            v3_fee_tiers: Sequence[int] = V3_FEE_TIERS,
+            min_share: float = 0.05) -> None:
+        """
+        :param min_share: slices smaller than this fraction of the order are not worth their gas and are dropped
+        """
+        self.registry = registry
+        self.quote_engine = quote_engine
+        self.multicall = multicall if multicall else Multicall(quote_engine.w3)
+        self.v3_factory = V3_FACTORY_ADDRESSES[chain]
+        self.state_view = Web3.to_checksum_address(V4_STATE_VIEW_ADDRESSES[chain])
+        self.v3_fee_tiers = tuple(v3_fee_tiers)
+        self.min_share = min_share
+
+    def _candidates(self, token_in: ChecksumAddress, token_out: ChecksumAddress) -> List[Tuple[Route, List[MulticallCall]]]:
+        candidates = []
+        for pool in self.registry.pools_for_pair(token_in, token_out):
+            pool_id = bytes.fromhex(pool.pool_id[2:])
+            calls = [
+                MulticallCall.from_function(self.state_view, _v4_get_slot0, (pool_id, ), _v4_get_slot0_output_types),
+                MulticallCall.from_function(self.state_view, _v4_get_liquidity, (pool_id, ), _liquidity_output_types),
+            ]
+            candidates.append((Route("v4", (token_in, token_out), (pool, )), calls))
+        if self.quote_engine.v3_quoter_address:
+            for fee in self.v3_fee_tiers:
+                pool_address = v3_pool_address(self.v3_factory, token_in, token_out, fee)
+                calls = [
+                    MulticallCall.from_function(pool_address, _v3_slot0, (), _v3_slot0_output_types),
+                    MulticallCall.from_function(pool_address, _v3_liquidity, (), _liquidity_output_types),
+                ]
+                candidates.append((Route("v3", (token_in, token_out), fees=(fee, )), calls))
+        return candidates
+
+    def read_pool_states(self, token_in: str, token_out: str, block_number: Optional[int] = None) -> List[PoolState]:
+        """
+        :return: the state of every existing candidate pool with in-range liquidity, read in one batch
+        """
+        token_in, token_out = Web3.to_checksum_address(token_in), Web3.to_checksum_address(token_out)
+        candidates = self._candidates(token_in, token_out)
+        calls = [call for _route, route_calls in candidates for call in route_calls]
+        _block_number, results = self.multicall.aggregate(calls, block_number if block_number else "latest")
+
+        states = []
+        for i, (route, _calls) in enumerate(candidates):
+            slot0, liquidity = results[2 * i], results[2 * i + 1]
+            if not slot0 or not liquidity or slot0[0] == 0 or liquidity[0] == 0:
+                continue
+            # V4 pools report the current LP fee, which is the actual one for dynamic fee pools
+            fee = slot0[3] if route.protocol == "v4" else route.fees[0]
+            states.append(PoolState(route, int(fee), int(slot0[0]), int(liquidity[0])))
+        return states
+
+    def allocate(self, states: Sequence[PoolState], amount_in: int) -> List[int]:
+        """
+        :return: the integer amount sent to each pool, summing to amount_in. Pools below min_share get 0.
+        """
+        active = list(range(len(states)))
+        while True:
+            reserves = np.array([states[i].virtual_reserves() for i in active], dtype=float)
+            gammas = np.array([1 - states[i].fee / 1_000_000 for i in active], dtype=float)
+            split = optimal_split(reserves[:, 0], reserves[:, 1], gammas, float(amount_in))
+            small = split < self.min_share * amount_in
+            if not small.any() or small.all():
+                break
+            active = [i for i, is_small in zip(active, small) if not is_small]
+
+        amounts = [0] * len(states)
+        for i, amount in zip(active, split):
+            amounts[i] = int(amount)
+        # give the rounding remainder to the biggest slice
+        amounts[max(active, key=lambda i: amounts[i])] += amount_in - sum(amounts)
+        return amounts
+
+    def plan(
+            self,
+            token_in: str,
+            token_out: str,
+            amount_in: int,
+            slippage: float,
+            block_number: Optional[int] = None) -> Optional[SplitPlan]:
+        """
+        :param token_in: the sold token
+        :param token_out: the bought token
+        :param amount_in: the exact amount sold, in wei
+        :param slippage: the slippage tolerance in percent, applied to each slice
+        :param block_number: the block to read and quote at. Default is the latest block.
+        :return: the split plan, None if no candidate pool could be quoted
+        """
+        token_in, token_out = Web3.to_checksum_address(token_in), Web3.to_checksum_address(token_out)
+        if block_number is None:
+            block_number = self.quote_engine.w3.eth.block_number
+        states = self.read_pool_states(token_in, token_out, block_number)
+
+        # a pool whose slice can't be quoted is dropped, and the order is split again between the others
+        while states:
+            amounts = self.allocate(states, amount_in)
+            used = [(state, amount) for state, amount in zip(states, amounts) if amount > 0]
+            requests: List[AnyQuoteRequest] = [state.route.quote_request(amount) for state, amount in used]
+            quotes = self.quote_engine.quote_many(requests, block_number)
+            failed = [state for (state, _amount), quote in zip(used, quotes) if not quote or quote.amount_out == 0]
+            if failed:
+                states = [state for state in states if state not in failed]
+                continue
+            slices = tuple(
+                SplitSlice(state, amount, quote.amount_out, apply_slippage(quote.amount_out, slippage))
+                for (state, amount), quote in zip(used, quotes)
+            )
+            return SplitPlan(token_in, token_out, slices, quotes[0].block_number)
+        return None
+
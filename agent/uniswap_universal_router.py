@@ -1,13 +1,30 @@
+import copy
 import json
 from web3 import Web3
 from eth_account import Account
+from eth_abi import decode
 from eth_abi.codec import ABICodec
 from eth_account.signers.local import LocalAccount
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Callable, Dict, Any, Set, Tuple, List, Sequence
 from eth_account.messages import SignableMessage
-from uniswap_functions import FunctionRecipient, RouterCodec
+from hexbytes import HexBytes
+from web3.types import ChecksumAddress
+from uniswap_functions import AccessListCache, FunctionRecipient, GasModel, RouterCodec, TransactionSpeed, get_fee_oracle
+from uniswap_quoter import QuoteEngine, QuoteRequest, V3_QUOTER_ADDRESSES, V4_QUOTER_ADDRESSES, apply_slippage
+from receipt_watcher import ReceiptWatcher
+from web3_rpc import batch_request, batch_responses, install_block_cache, make_provider
+from rbf_manager import ReplacementManager
+from nonce_manager import NonceManager
+from uniswap_pools import POOL_MANAGER_ADDRESSES, POOL_MANAGER_DEPLOYMENT_BLOCKS, PoolRegistry
+from uniswap_routing import WETH_ADDRESSES, RouteFinder
+from uniswap_split import SplitOptimizer
+from uniswap_simulation import SimulationResult, Simulator, StateOverrides
+from uniswap_redemption import RedemptionPlanner
 
 # 🚀 Uniswap V4 Universal Router Addresses for Each Chain
 ROUTER_ADDRESSES = {
@@ -18,6 +35,27 @@ ROUTER_ADDRESSES = {
     "arbitrum": "0xa51afafe0263b40edaef0df8781ea9aa03e381a3",  # Replace with Arbitrum UniswapV4 router address
 }
 
+# Permit2 is deployed at the same address on every chain
+PERMIT2_ADDRESS = "0x000000000022D473030F116dDEE9F6B43aC78BA3"
+
+# gas limit of simulated swaps: high enough for any route, and it skips eth_estimateGas which reverts the same way
+_simulation_gas_limit = 2_000_000
+
+# a router allowance expiring within this many seconds is renewed with a new permit
+_permit_expiration_margin = 600
+
+# gas limit of swaps relying on a permit not mined yet, which eth_estimateGas can't see
+_pipelined_gas_limit = 1_000_000
+
+# balanceOf(address)
+_balance_of_selector = "0x70a08231"
+# allowance(address,address)
+_allowance_selector = "0xdd62ed3e"
+# Typical gas limit for ERC20 approval
+_approval_gas_limit = 60000
+# Any allowance larger than this is considered "infinite"
+_large_approval_threshold = 2**200
+
 # ✅ Universal Router ABI (Stored as JSON String)
 UNIVERSAL_ROUTER_ABI_JSON = "[{\"inputs\":[{\"components\":[{\"internalType\":\"address\",\"name\":\"permit2\",\"type\":\"address\"},{\"internalType\":\"address\",\"name\":\"weth9\",\"type\":\"address\"},{\"internalType\":\"address\",\"name\":\"v2Factory\",\"type\":\"address\"},{\"internalType\":\"address\",\"name\":\"v3Factory\",\"type\":\"address\"},{\"internalType\":\"bytes32\",\"name\":\"pairInitCodeHash\",\"type\":\"bytes32\"},{\"internalType\":\"bytes32\",\"name\":\"poolInitCodeHash\",\"type\":\"bytes32\"},{\"internalType\":\"address\",\"name\":\"v4PoolManager\",\"type\":\"address\"},{\"internalType\":\"address\",\"name\":\"v3NFTPositionManager\",\"type\":\"address\"},{\"internalType\":\"address\",\"name\":\"v4PositionManager\",\"type\":\"address\"}],\"internalType\":\"struct RouterParameters\",\"name\":\"params\",\"type\":\"tuple\"}],\"stateMutability\":\"nonpayable\",\"type\":\"constructor\"},{\"inputs\":[],\"name\":\"BalanceTooLow\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"ContractLocked\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"Currency\",\"name\":\"currency\",\"type\":\"address\"}],\"name\":\"DeltaNotNegative\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"Currency\",\"name\":\"currency\",\"type\":\"address\"}],\"name\":\"DeltaNotPositive\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"ETHNotAccepted\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"commandIndex\",\"type\":\"uint256\"},{\"internalType\":\"bytes\",\"name\":\"message\",\"type\":\"bytes\"}],\"name\":\"ExecutionFailed\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"FromAddressIsNotOwner\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InputLengthMismatch\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InsufficientBalance\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InsufficientETH\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InsufficientToken\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"bytes4\",\"name\":\"action\",\"type\":\"bytes4\"}],\"name\":\"InvalidAction\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InvalidBips\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"commandType\",\"type\":\"uint256\"}],\"name\":\"InvalidCommandType\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InvalidEthSender\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InvalidPath\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"InvalidReserves\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"LengthMismatch\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"tokenId\",\"type\":\"uint256\"}],\"name\":\"NotAuthorizedForToken\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"NotPoolManager\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"OnlyMintAllowed\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"SliceOutOfBounds\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"TransactionDeadlinePassed\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"UnsafeCast\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"action\",\"type\":\"uint256\"}],\"name\":\"UnsupportedAction\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V2InvalidPath\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V2TooLittleReceived\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V2TooMuchRequested\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3InvalidAmountOut\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3InvalidCaller\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3InvalidSwap\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3TooLittleReceived\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3TooMuchRequested\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"minAmountOutReceived\",\"type\":\"uint256\"},{\"internalType\":\"uint256\",\"name\":\"amountReceived\",\"type\":\"uint256\"}],\"name\":\"V4TooLittleReceived\",\"type\":\"error\"},{\"inputs\":[{\"internalType\":\"uint256\",\"name\":\"maxAmountInRequested\",\"type\":\"uint256\"},{\"internalType\":\"uint256\",\"name\":\"amountRequested\",\"type\":\"uint256\"}],\"name\":\"V4TooMuchRequested\",\"type\":\"error\"},{\"inputs\":[],\"name\":\"V3_POSITION_MANAGER\",\"outputs\":[{\"internalType\":\"contract INonfungiblePositionManager\",\"name\":\"\",\"type\":\"address\"}],\"stateMutability\":\"view\",\"type\":\"function\"},{\"inputs\":[],\"name\":\"V4_POSITION_MANAGER\",\"outputs\":[{\"internalType\":\"contract IPositionManager\",\"name\":\"\",\"type\":\"address\"}],\"stateMutability\":\"view\",\"type\":\"function\"},{\"inputs\":[{\"internalType\":\"bytes\",\"name\":\"commands\",\"type\":\"bytes\"},{\"internalType\":\"bytes[]\",\"name\":\"inputs\",\"type\":\"bytes[]\"}],\"name\":\"execute\",\"outputs\":[],\"stateMutability\":\"payable\",\"type\":\"function\"},{\"inputs\":[{\"internalType\":\"bytes\",\"name\":\"commands\",\"type\":\"bytes\"},{\"internalType\":\"bytes[]\",\"name\":\"inputs\",\"type\":\"bytes[]\"},{\"internalType\":\"uint256\",\"name\":\"deadline\",\"type\":\"uint256\"}],\"name\":\"execute\",\"outputs\":[],\"stateMutability\":\"payable\",\"type\":\"function\"},{\"inputs\":[],\"name\":\"msgSender\",\"outputs\":[{\"internalType\":\"address\",\"name\":\"\",\"type\":\"address\"}],\"stateMutability\":\"view\",\"type\":\"function\"},{\"inputs\":[],\"name\":\"poolManager\",\"outputs\":[{\"internalType\":\"contract IPoolManager\",\"name\":\"\",\"type\":\"address\"}],\"stateMutability\":\"view\",\"type\":\"function\"},{\"inputs\":[{\"internalType\":\"int256\",\"name\":\"amount0Delta\",\"type\":\"int256\"},{\"internalType\":\"int256\",\"name\":\"amount1Delta\",\"type\":\"int256\"},{\"internalType\":\"bytes\",\"name\":\"data\",\"type\":\"bytes\"}],\"name\":\"uniswapV3SwapCallback\",\"outputs\":[],\"stateMutability\":\"nonpayable\",\"type\":\"function\"},{\"inputs\":[{\"internalType\":\"bytes\",\"name\":\"data\",\"type\":\"bytes\"}],\"name\":\"unlockCallback\",\"outputs\":[{\"internalType\":\"bytes\",\"name\":\"\",\"type\":\"bytes\"}],\"stateMutability\":\"nonpayable\",\"type\":\"function\"},{\"stateMutability\":\"payable\",\"type\":\"receive\"}]"
 
@@ -32,21 +70,54 @@ UNIVERSAL_ROUTER_ABI = json.loads(UNIVERSAL_ROUTER_ABI_JSON)
 PERMIT2_ABI = json.loads(PERMIT2_ABI_JSON)
 ERC20_ABI = json.loads(ERC20_ABI_JSON)
 
+
+@dataclass(frozen=True)
+class ChainContext:
+    """Chain level values that never change for a provider, resolved once and shared by every client"""
+    chain: str
+    chain_id: int
+    router_address: ChecksumAddress
+    permit2_address: ChecksumAddress
+
+
+_chain_contexts: Dict[Tuple[str, str], ChainContext] = {}
+_chain_contexts_lock = threading.Lock()
+
+
+def get_chain_context(w3: Web3, chain: str) -> ChainContext:
+    """
+    :param w3: valid Web3 instance
+    :param chain: the chain name, as returned by Uniswap.get_chain_from_provider
+    :return: the cached chain context of this provider, eth_chainId is only requested the first time
+    """
+    key = (str(getattr(w3.provider, "endpoint_uri", id(w3.provider))), chain)
+    with _chain_contexts_lock:
+        context = _chain_contexts.get(key)
+        if context is None:
+            context = ChainContext(
+                chain=chain,
+                chain_id=w3.eth.chain_id,
+                router_address=Web3.to_checksum_address(ROUTER_ADDRESSES[chain]),
+                permit2_address=Web3.to_checksum_address(PERMIT2_ADDRESS),
+            )
+            _chain_contexts[key] = context
+        return context
+
+
 class Uniswap:
-    def __init__(self, wallet_address, private_key, provider, web3):
+    def __init__(self, wallet_address, private_key, provider, web3, pool_registry_path: Optional[str] = None,
+                 use_access_lists: bool = True):
         self.w3=web3
-        self.wallet_address = wallet_address
-        self.private_key = private_key
-        self.account = Account.from_key(private_key)
-        self.address = Web3.to_checksum_address(wallet_address)  # This is what was missing
 
         if web3:
             print("🧡")
         else:
             print("🧡🧡")
 
-        self.w3 = web3 if web3 else Web3(Web3.HTTPProvider(provider))
-        assert self.w3.is_connected(), "❌ Web3 connection failed"
+        # No RPC is sent here: the connection check and the stuck transaction check run on first use (ensure_ready)
+        self.w3 = web3 if web3 else Web3(make_provider(provider))
+        # chain id, latest block, fees... are fetched once per block instead of once per use
+        self.rpc_cache = install_block_cache(self.w3)
 
         # 🟢 Auto-select correct UniswapV4 Universal Router based on L2
         self.chain = self.get_chain_from_provider(provider)
@@ -56,21 +127,93 @@ class Uniswap:
         self.router_address = Web3.to_checksum_address(ROUTER_ADDRESSES[self.chain])
         self.router = self.w3.eth.contract(address=self.router_address, abi=UNIVERSAL_ROUTER_ABI)
 
-        self.permit2 = self.w3.eth.contract(address=Web3.to_checksum_address("0x000000000022D473030F116dDEE9F6B43aC78BA3"), abi=PERMIT2_ABI)
+        self.permit2 = self.w3.eth.contract(address=Web3.to_checksum_address(PERMIT2_ADDRESS), abi=PERMIT2_ABI)
 
-        # Check for stuck transaction
-        stuck_nonce = self.check_for_stuck_transactions()
-        if stuck_nonce is not None:
-            print("stuck transaction detected")
-            self.cancel_transaction(stuck_nonce)
-        else:
-            print("No stuck transactions to cancel")
-            time.sleep(1)
+        self.codec = RouterCodec(w3=self.w3)
+        self.fee_oracle = get_fee_oracle(self.w3)
+        self.quote_engine = QuoteEngine(
+            self.w3,
+            V4_QUOTER_ADDRESSES[self.chain],
+            v3_quoter_address=V3_QUOTER_ADDRESSES[self.chain],
+        )
+        self.receipt_watcher = ReceiptWatcher(self.w3)
+        self._init_wallet(wallet_address, private_key)
+        self.gas_model = GasModel()
+        # EIP-2930 access lists, created once per call shape and pool set and attached when they lower the gas
+        self.access_lists = AccessListCache() if use_access_lists else None
+        self.pool_registry = PoolRegistry(self.codec, pool_registry_path)
+        self.route_finder = RouteFinder(self.pool_registry, self.quote_engine, WETH_ADDRESSES[self.chain])
+        self.split_optimizer = SplitOptimizer(self.pool_registry, self.quote_engine, self.chain)
+        self.simulator = Simulator(self.w3, self.codec)
+        self.redemption_planner = RedemptionPlanner(self.pool_registry, self.route_finder, self.quote_engine)
+
+        self._chain_context: Optional[ChainContext] = None
+        # address -> nonces of swaps recorded by an execution journal, ensure_ready must not cancel them
+        self.journaled_nonces: Optional[Callable[[str], Set[int]]] = None
 #        stuck_nonce = 1  # Explicitly set the known stuck nonce
 #        self.cancel_transaction(stuck_nonce)
 
 
-    def get_chain_from_provider(self, provider_url):
+    def _init_wallet(self, wallet_address, private_key):
+        """Set up the state owned by the wallet: account, nonce stream, replacements and Permit2 allowances"""
+        self.wallet_address = wallet_address
+        self.private_key = private_key
+        self.account = Account.from_key(private_key)
+        self.address = Web3.to_checksum_address(wallet_address)  # This is what was missing
+        self.nonce_manager = NonceManager(self.w3, self.account.address)
+        self.rbf_manager = ReplacementManager(self.w3, self.account, self.fee_oracle, self.receipt_watcher)
+        # token -> (expiration, mined) of the router allowance given through Permit2, including permits not mined yet
+        self._router_allowances: Dict[str, Tuple[int, bool]] = {}
+        self._router_allowances_lock = threading.Lock()
+        # tokens known to be approved for Permit2, and the lock serializing the approval and first permit of each token
+        self._permit2_approved = set()
+        self._token_locks: Dict[str, threading.Lock] = {}
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def for_wallet(self, wallet_address, private_key):
+        """
+        Client for another wallet of the same chain. The read side is shared with this client (codec, quotes,
+        pool registry, receipt watcher, fee oracle, gas model), the wallet has its own nonce stream,
+        replacement manager and Permit2 state.
+        """
+        client = copy.copy(self)
+        client._init_wallet(wallet_address, private_key)
+        return client
+
+    @property
+    def chain_context(self) -> ChainContext:
+        if self._chain_context is None:
+            self._chain_context = get_chain_context(self.w3, self.chain)
+        return self._chain_context
+
+    def ensure_ready(self):
+        """
+        Run the one-time network checks before the first transaction: connection, chain id
+        and stuck transactions. Safe to call many times, and from a background startup task.
+        """
+        with self._ready_lock:
+            if self._ready:
+                return
+            assert self.w3.is_connected(), "❌ Web3 connection failed"
+            print(f"Connected to {self.chain} (chain id {self.chain_context.chain_id})")
+
+            # Transactions left pending by a previous run can't be re-signed, their intent is unknown,
+            # unless they are journaled swaps: those are settled by the journal, never cancelled
+            stuck_nonces = self.find_stuck_nonces()
+            journaled = self.journaled_nonces(self.address) if self.journaled_nonces else set()
+            for stuck_nonce in stuck_nonces:
+                if stuck_nonce in journaled:
+                    print(f"pending transaction with nonce {stuck_nonce} is a journaled swap, keeping it")
+                    continue
+                print(f"stuck transaction detected with nonce {stuck_nonce}")
+                self.cancel_transaction(stuck_nonce)
+            if not stuck_nonces:
+                print("No stuck transactions to cancel")
+            self._ready = True
+
+    @staticmethod
+    def get_chain_from_provider(provider_url):
         """Detects the blockchain network from the provider URL."""
         if "base" in provider_url:
             return "base"
@@ -91,6 +234,7 @@ class Uniswap:
         """
         Approve the Permit2 contract to spend tokens (one-time approval)
         """
+        self.ensure_ready()
         token_address = Web3.to_checksum_address(token_address)
         token_contract = self.w3.eth.contract(
             address=token_address, 
@@ -108,28 +252,11 @@ class Uniswap:
         
         # Simple gas calculation for approval transaction
         try:
-            # Get current gas values
-            base_fee = self.w3.eth.get_block("latest")["baseFeePerGas"]
-            priority_fee = self.w3.eth.max_priority_fee
-            
-            # Apply reasonable multipliers for approval transaction
-            max_fee_per_gas = int(base_fee * 1.2 + priority_fee * 1.1)
-            max_priority_fee_per_gas = int(priority_fee * 1.1)
-            
-            # Set minimum values
-            min_max_fee = Web3.to_wei(0.003, 'gwei')
-            min_priority_fee = Web3.to_wei(0.001, 'gwei')
-            
-            max_fee_per_gas = max(max_fee_per_gas, min_max_fee)
-            max_priority_fee_per_gas = max(max_priority_fee_per_gas, min_priority_fee)
-            
-            # Ensure max fee is higher than priority fee
-            if max_fee_per_gas < max_priority_fee_per_gas:
-                max_fee_per_gas = max_priority_fee_per_gas * 2
-                
+            max_priority_fee_per_gas, max_fee_per_gas = self._approval_fees()
+
             # Check balance
             balance = self.w3.eth.get_balance(self.account.address)
-            estimated_gas = 60000  # Typical gas limit for ERC20 approval
+            estimated_gas = _approval_gas_limit
             estimated_cost = estimated_gas * max_fee_per_gas
             
             if balance < estimated_cost:
@@ -144,20 +271,24 @@ class Uniswap:
                 "maxPriorityFeePerGas": max_priority_fee_per_gas,
                 "maxFeePerGas": max_fee_per_gas,
                 "type": 2,
-                "chainId": self.w3.eth.chain_id,
+                "chainId": self.chain_context.chain_id,
                 "value": 0,
-                "nonce": self.w3.eth.get_transaction_count(self.account.address),
+                "nonce": self.nonce_manager.allocate(),
             })
             
             signed_tx = self.w3.eth.account.sign_transaction(tx_params, self.account.key)
-            tx_hash = self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+            try:
+                tx_hash = self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+            except Exception:
+                self.release_nonces([tx_params["nonce"]])
+                raise
             print(f"Permit2 token approve transaction hash: {tx_hash.hex()}")
+            self.rbf_manager.track(tx_params, tx_hash)
             
             try:
-                receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=60)
-                if receipt.status == 1:
+                receipt = self.receipt_watcher.wait(tx_hash, timeout=60)
+                if receipt["status"] == 1:
                     print("Approval transaction confirmed")
-                    time.sleep(2)  # Wait for state update
                     return True
             except Exception as e:
                 print(f"Error waiting for approval: {str(e)}")
@@ -167,6 +298,110 @@ class Uniswap:
             print(f"Error in approve_permit2: {str(e)}")
             return False
 
+    def _approval_fees(self):
+        """Returns: the (max priority fee, max fee) per gas of ERC20 approvals"""
+        # Get current gas values from the shared fee oracle
+        max_priority_fee_per_gas, max_fee_per_gas = self.fee_oracle.gas_fees(TransactionSpeed.FAST)
+
+        # Set minimum values
+        min_max_fee = Web3.to_wei(0.003, 'gwei')
+        min_priority_fee = Web3.to_wei(0.001, 'gwei')
+
+        max_fee_per_gas = max(max_fee_per_gas, min_max_fee)
+        max_priority_fee_per_gas = max(max_priority_fee_per_gas, min_priority_fee)
+
+        # Ensure max fee is higher than priority fee
+        if max_fee_per_gas < max_priority_fee_per_gas:
+            max_fee_per_gas = max_priority_fee_per_gas * 2
+        return max_priority_fee_per_gas, max_fee_per_gas
+
+    def get_permit2_allowances(self, tokens: Sequence[str]) -> List[int]:
+        """
+        Fetch the ERC20 allowance given to Permit2 on every token in one batched call
+        Returns: the allowances in wei, 0 for a token whose allowance could not be read
+        """
+        owner = bytes.fromhex(Web3.to_checksum_address(self.wallet_address)[2:]).rjust(32, b"\0")
+        spender = bytes.fromhex(self.permit2.address[2:]).rjust(32, b"\0")
+        calls = [
+            ("eth_call", [{"to": Web3.to_checksum_address(token), "data": _allowance_selector + owner.hex() + spender.hex()},
+                          "latest"])
+            for token in tokens
+        ]
+        return [int(result, 16) if result and result != "0x" else 0 for result in batch_request(self.w3, calls)]
+
+    def approve_permit2_many(self, tokens: Sequence[str], timeout=120) -> Dict[str, bool]:
+        """
+        Approve Permit2 on many tokens at once. The allowances are read in one batch, the approvals of the tokens
+        that need one are signed with consecutive nonces and broadcast in one batch, then all the receipts are
+        waited for together.
+        The nonces of the rejected approvals are given back with release_nonces: reused if no later nonce
+        was sent, else cancelled so the following approvals are still mined.
+
+        Args:
+            tokens (list): the token addresses
+            timeout (float): seconds to wait for all the receipts
+        Returns: token -> True if Permit2 is approved on it
+        """
+        self.ensure_ready()
+        tokens = list(dict.fromkeys(Web3.to_checksum_address(token) for token in tokens))
+        approved = {token: self._is_permit2_approved(token) for token in tokens}
+        unknown = [token for token in tokens if not approved[token]]
+        for token, allowance in zip(unknown, self.get_permit2_allowances(unknown)):
+            approved[token] = allowance > _large_approval_threshold
+        needed = [token for token in unknown if not approved[token]]
+        print(f"Permit2 approvals: {len(tokens) - len(needed)} tokens already approved, {len(needed)} to approve")
+
+        if needed:
+            max_priority_fee_per_gas, max_fee_per_gas = self._approval_fees()
+            balance = self.w3.eth.get_balance(self.account.address)
+            estimated_cost = len(needed) * _approval_gas_limit * max_fee_per_gas
+            if balance < estimated_cost:
+                print(f"ERROR: Insufficient ETH balance for {len(needed)} approvals!")
+                print(f"Current balance: {Web3.from_wei(balance, 'ether')} ETH")
+                print(f"Estimated cost: {Web3.from_wei(estimated_cost, 'ether')} ETH")
+                return {token: approved[token] for token in tokens}
+
+            signed = []
+            for token in needed:
+                contract_function = self.w3.eth.contract(address=token, abi=ERC20_ABI).functions.approve(
+                    self.permit2.address, 2**256 - 1)
+                tx_params = contract_function.build_transaction({
+                    "from": self.account.address,
+                    "gas": _approval_gas_limit,
+                    "maxPriorityFeePerGas": max_priority_fee_per_gas,
+                    "maxFeePerGas": max_fee_per_gas,
+                    "type": 2,
+                    "chainId": self.chain_context.chain_id,
+                    "value": 0,
+                    "nonce": self.nonce_manager.allocate(),
+                })
+                signed.append((token, tx_params, self.w3.eth.account.sign_transaction(tx_params, self.account.key)))
+
+            responses = batch_responses(
+                self.w3, [("eth_sendRawTransaction", [Web3.to_hex(signed_tx.raw_transaction)])
+                          for _token, _tx_params, signed_tx in signed])
+            sent, rejected_nonces = [], []
+            for (token, tx_params, signed_tx), response in zip(signed, responses):
+                if "error" in response:
+                    print(f"Permit2 approval of {token} rejected: {response['error'].get('message')}")
+                    rejected_nonces.append(tx_params["nonce"])
+                    continue
+                tx_hash = HexBytes(response["result"])
+                print(f"Permit2 token approve transaction hash: {tx_hash.hex()}")
+                self.rbf_manager.track(tx_params, tx_hash)
+                sent.append((token, tx_hash))
+            self.release_nonces(rejected_nonces)
+
+            receipts = self.receipt_watcher.wait_all([tx_hash for _token, tx_hash in sent], timeout=timeout)
+            for (token, _tx_hash), receipt in zip(sent, receipts):
+                approved[token] = bool(receipt) and receipt["status"] == 1
+                if not approved[token]:
+                    print(f"Permit2 approval of {token} {'reverted' if receipt else 'not mined in time'}")
+
+        with self._router_allowances_lock:
+            self._permit2_approved.update(token for token in tokens if approved[token])
+        return {token: approved[token] for token in tokens}
+
     def create_permit_signature(self, token_address):
         """
         Create a Permit2 signature for a specific transaction (needed for each swap)
@@ -182,20 +417,78 @@ class Uniswap:
         
         print("p2_amount, p2_expiration, p2_nonce: ", p2_amount, p2_expiration, p2_nonce)
         
-        codec = RouterCodec(w3=self.w3)
         allowance_amount = 2**160 - 1  # max/infinite
-        permit_data, signable_message = codec.create_permit2_signable_message(
+        permit_data, signable_message = self.codec.create_permit2_signable_message(
             token_address,
             allowance_amount,
-            codec.get_default_expiration(),
+            self.codec.get_default_expiration(),
             p2_nonce,
             self.router_address,
-            codec.get_default_deadline(),
-            self.w3.eth.chain_id,
+            self.codec.get_default_deadline(),
+            self.chain_context.chain_id,
         )
         signed_message = self.account.sign_message(signable_message)
         return permit_data, signed_message
 
+    def _new_chain(self, permit_data, signed_message):
+        """Start a chain of commands, with the Permit2 permit if there is one"""
+        chain = self.codec.encode.chain()
+        return chain.permit2_permit(permit_data, signed_message) if permit_data else chain
+
+    def has_router_allowance(self, token_address):
+        """
+        Check if the router can already pull token_address through Permit2, so a swap doesn't need a new permit.
+        The allowances given by the permits sent by this client are known before they are mined.
+        """
+        token_address = Web3.to_checksum_address(token_address)
+        now = time.time()
+        with self._router_allowances_lock:
+            expiration, _mined = self._router_allowances.get(token_address, (0, False))
+        if expiration > now + _permit_expiration_margin:
+            return True
+
+        amount, expiration, _nonce = self.permit2.functions.allowance(
+            self.wallet_address, token_address, self.router_address
+        ).call()
+        if amount >= 2**159 and expiration > now + _permit_expiration_margin:
+            self._remember_router_allowance(token_address, expiration, mined=True)
+            return True
+        return False
+
+    def _token_lock(self, token_address):
+        with self._router_allowances_lock:
+            return self._token_locks.setdefault(Web3.to_checksum_address(token_address), threading.Lock())
+
+    def _is_permit2_approved(self, token_address):
+        with self._router_allowances_lock:
+            return Web3.to_checksum_address(token_address) in self._permit2_approved
+
+    def _is_token_ready(self, token_address):
+        """True if Permit2 is approved on the token and the router has a live allowance, so no lock is needed"""
+        token_address = Web3.to_checksum_address(token_address)
+        with self._router_allowances_lock:
+            expiration, _mined = self._router_allowances.get(token_address, (0, False))
+            return token_address in self._permit2_approved \
+                and expiration > time.time() + _permit_expiration_margin
+
+    def _router_allowance_mined(self, token_address):
+        with self._router_allowances_lock:
+            return self._router_allowances.get(Web3.to_checksum_address(token_address), (0, False))[1]
+
+    def _remember_router_allowance(self, token_address, expiration, mined=False):
+        with self._router_allowances_lock:
+            self._router_allowances[Web3.to_checksum_address(token_address)] = (expiration, mined)
+
+    def _on_permit_receipt(self, token_address, expiration, receipt):
+        if receipt["status"] == 1:
+            self._remember_router_allowance(token_address, expiration, mined=True)
+        else:
+            self._forget_router_allowance(token_address)
+
+    def _forget_router_allowance(self, token_address):
+        with self._router_allowances_lock:
+            self._router_allowances.pop(Web3.to_checksum_address(token_address), None)
+
     def check_permit2_allowance(self, token_address):
         """
         Check if token has already been approved for Permit2
@@ -215,21 +508,101 @@ class Uniswap:
         print(f"Current Permit2 allowance: {permit2_allowance}")
         
         # Check if allowance is effectively infinite (very large number)
-        LARGE_APPROVAL_THRESHOLD = 2**200  # Any number larger than this is considered "infinite"
-        
-        return permit2_allowance > LARGE_APPROVAL_THRESHOLD
+        return permit2_allowance > _large_approval_threshold
 
-    def make_trade(self, from_token, to_token, amount, fee, slippage, pool_version="v3"):
+    def get_v4_pool_key(self, from_token, to_token, fee, tick_spacing=200, amount_in=None):
+        """
+        Resolve the V4 pool key and the swap direction for a from_token -> to_token swap.
+        Known pools come from the pool registry, fee and tick_spacing are only used for unknown pairs.
+        If the registry knows several pools for the pair and amount_in is given, they are quoted in one batch
+        and the pool giving the most output is picked.
+        Returns: (pool_key, zero_for_one)
+        """
+        def rank(pools):
+            quotes = self.quote_engine.quote_many([
+                QuoteRequest.from_pool_key(pool.pool_key(), pool.zero_for_one(from_token), amount_in)
+                for pool in pools
+            ])
+            return [quote.amount_out if quote else None for quote in quotes]
+
+        resolved = self.pool_registry.resolve(from_token, to_token, rank if amount_in else None)
+        if resolved:
+            return resolved
+        from_token = Web3.to_checksum_address(from_token)
+        to_token = Web3.to_checksum_address(to_token)
+        pool_key = self.codec.encode.v4_pool_key(from_token, to_token, fee, tick_spacing)
+        zero_for_one = int(from_token, 16) < int(to_token, 16)
+        return pool_key, zero_for_one
+
+    def sync_pool_registry(self, tokens: Optional[Sequence[str]] = None, from_block: Optional[int] = None) -> int:
+        """
+        Register the pools created since the last sync from the PoolManager Initialize logs,
+        a first sync starts at the block the PoolManager was deployed at
+        Returns: the number of new pools
+        """
+        pool_manager = POOL_MANAGER_ADDRESSES[self.chain]
+        return self.pool_registry.sync_initialize_logs(
+            self.w3, pool_manager, from_block, tokens=tokens, start_block=POOL_MANAGER_DEPLOYMENT_BLOCKS[self.chain])
+
+    def get_token_balances(self, tokens: Sequence[str]) -> List[int]:
+        """
+        Fetch the wallet balance of every token in one batched call
+        Returns: the balances in wei, 0 for a token whose balance could not be read
+        """
+        owner = bytes.fromhex(Web3.to_checksum_address(self.wallet_address)[2:]).rjust(32, b"\0")
+        calls = [
+            ("eth_call", [{"to": Web3.to_checksum_address(token), "data": _balance_of_selector + owner.hex()}, "latest"])
+            for token in tokens
+        ]
+        return [int(result, 16) if result and result != "0x" else 0 for result in batch_request(self.w3, calls)]
+
+    def fetch_permit2_nonces(self, tokens: Sequence[str]) -> List[int]:
+        """
+        Fetch the Permit2 nonce of the router allowance of every token in one batched call
+        """
+        calls = []
+        for token in tokens:
+            data = self.permit2.encodeABI(
+                fn_name="allowance", args=[self.wallet_address, Web3.to_checksum_address(token), self.router_address])
+            calls.append(("eth_call", [{"to": self.permit2.address, "data": data}, "latest"]))
+        nonces = []
+        for token, result in zip(tokens, batch_request(self.w3, calls)):
+            if not result:
+                raise ValueError(f"Failed to read the Permit2 allowance of {token}")
+            _amount, _expiration, nonce = decode(["uint160", "uint48", "uint48"], bytes.fromhex(result[2:]))
+            nonces.append(nonce)
+        return nonces
+
+    def quote_min_amounts_out(self, from_token, legs: Sequence[Tuple[str, int]], fee, slippage, tick_spacing=200) -> List[Optional[int]]:
+        """
+        Quote every (to_token, amount_in) leg of a basket in one batched call
+        Returns: the slippage-adjusted min_amount_out of each leg, None if the leg could not be quoted
+        """
+        requests = []
+        for to_token, amount_in in legs:
+            pool_key, zero_for_one = self.get_v4_pool_key(from_token, to_token, fee, tick_spacing, amount_in)
+            requests.append(QuoteRequest.from_pool_key(pool_key, zero_for_one, amount_in))
+        return self.quote_engine.min_amounts_out(requests, slippage)
+
+    def make_trade(self, from_token, to_token, amount, fee, slippage, pool_version="v3", min_amount_out=None,
+                   on_signed=None):
         """
         Execute an exact input swap using Universal Router with RouterCodec.
-        
+
         Args:
             from_token (str): Address of token to swap from
             to_token (str): Address of token to swap to
             amount (int): Amount in wei (already converted to smallest unit)
             fee (int): Fee tier (e.g., 3000 for 0.3%)
             slippage (float): Slippage tolerance in percent
+            pool_version (str): "v3", "v4", "auto" to swap through the best V3 or V4 route, multi-hop included,
+                or "split" to split the order between the parallel V3 and V4 pools of the pair
+            min_amount_out (int): Minimum accepted output in wei. If None, V4 and auto swaps are quoted and slippage is applied.
+                Split orders always use the slippage-adjusted quote of each slice
+            on_signed (callable): called with the transaction hash, nonce and parameters once signed,
+                before it is broadcast
         """
+        self.ensure_ready()
 
         # Convert addresses to checksum format
         from_token = Web3.to_checksum_address(from_token)
@@ -248,26 +621,101 @@ class Uniswap:
         if balance < amount:
             raise ValueError(f"Insufficient balance. Have: {balance / (10 ** decimals_in)}, Need: {amount / (10 ** decimals_in)}")
 
-        # Check for existing Permit2 approval
-        has_permit2_allowance = self.check_permit2_allowance(from_token)
-        if not has_permit2_allowance:
-            print("Permit2 approval needed. Initiating approval...")
-            approval_success = self.approve_permit2(from_token, amount)
-            if not approval_success:
-                print("Failed to get Permit2 approval")
+        if not self._is_token_ready(from_token):
+            # Approvals and permits are per token: concurrent trades on the same token wait for the first one
+            with self._token_lock(from_token):
+                # Check for existing Permit2 approval
+                has_permit2_allowance = self._is_permit2_approved(from_token) or self.check_permit2_allowance(from_token)
+                if not has_permit2_allowance:
+                    print("Permit2 approval needed. Initiating approval...")
+                    approval_success = self.approve_permit2(from_token, amount)
+                    if not approval_success:
+                        print("Failed to get Permit2 approval")
+                        return None
+                else:
+                    print("Sufficient Permit2 allowance already exists")
+                with self._router_allowances_lock:
+                    self._permit2_approved.add(from_token)
+
+                # Swaps sent after a permit, even one not mined yet, use the allowance it gives
+                if not self.has_router_allowance(from_token):
+                    return self._build_and_send_trade(
+                        from_token, to_token, amount, fee, slippage, pool_version, min_amount_out, True, on_signed)
+
+        return self._build_and_send_trade(
+            from_token, to_token, amount, fee, slippage, pool_version, min_amount_out, False, on_signed)
+
+    def make_trades(self, from_token, legs: Sequence[Tuple[str, int]], fee, slippage, pool_versions=None,
+                    min_amounts_out=None, max_workers=8, on_signed=None):
+        """
+        Execute the legs of a basket in parallel, from a pool of worker threads. Each worker builds, signs and
+        broadcasts its own leg (signing is stateless), the nonces come from the shared nonce stream, and the
+        first leg of a token gives the Permit2 approval and permit used by the others.
+
+        Args:
+            legs (list): the (to_token, amount in wei) of each leg
+            pool_versions (list): the pool version of each leg, "v4" by default
+            min_amounts_out (list): the minimum output of each leg, None to quote it
+            max_workers (int): legs built and sent at the same time
+            on_signed (callable): called with the leg index, transaction hash, nonce and parameters of each
+                signed leg, before it is broadcast
+        Returns: the transaction hash of each leg, None for the legs that failed
+        """
+        self.ensure_ready()
+
+        def trade(index):
+            to_token, amount = legs[index]
+            try:
+                return self.make_trade(
+                    from_token, to_token, amount, fee, slippage,
+                    pool_versions[index] if pool_versions else "v4",
+                    min_amounts_out[index] if min_amounts_out else None,
+                    (lambda tx_hash, nonce, trx_params: on_signed(index, tx_hash, nonce, trx_params))
+                    if on_signed else None,
+                )
+            except Exception as e:
+                print(f"Swap to {to_token} failed: {e}")
                 return None
-            time.sleep(2)  # Wait for approval to be mined
-        else:
-            print("Sufficient Permit2 allowance already exists")
-        
-        # Create permit signature for the swap
-        permit_data, signed_message = self.create_permit_signature(from_token)
-        if not permit_data or not signed_message:
-            print("Failed to create permit signature")
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="uniswap-trade") as executor:
+            return list(executor.map(trade, range(len(legs))))
+
+    def _build_and_send_trade(self, from_token, to_token, amount, fee, slippage, pool_version, min_amount_out,
+                              include_permit, on_signed=None):
+        gas_limit = None if include_permit or self._router_allowance_mined(from_token) else _pipelined_gas_limit
+        built = self.build_trade(from_token, to_token, amount, fee, slippage, pool_version, min_amount_out,
+                                 gas_limit=gas_limit, include_permit=include_permit)
+        if built is None:
             return None
+        trx_params, gas_shape = built
+
+        tx_hash = self.send_transaction(trx_params, gas_shape, on_signed)
+        if tx_hash and include_permit:
+            expiration = self.codec.get_default_expiration()
+            self._remember_router_allowance(from_token, expiration)
+            self.receipt_watcher.watch(tx_hash, lambda receipt: self._on_permit_receipt(from_token, expiration, receipt))
+        return tx_hash
+
+    def build_trade(self, from_token, to_token, amount, fee, slippage, pool_version="v3", min_amount_out=None,
+                    gas_limit=None, include_permit=True):
+        """
+        Sign the Permit2 permit and build the swap transaction, without any balance or allowance check.
+        See make_trade for the arguments. If gas_limit is None, it is predicted by the gas model or estimated.
+        If include_permit is False, the router must already have a Permit2 allowance on from_token.
+        Returns: the tuple (trx_params, gas_shape), or None if the swap could not be built
+        """
+        from_token = Web3.to_checksum_address(from_token)
+
+        permit_data, signed_message = None, None
+        if include_permit:
+            # Create permit signature for the swap
+            permit_data, signed_message = self.create_permit_signature(from_token)
+            if not permit_data or not signed_message:
+                print("Failed to create permit signature")
+                return None
 
-        print(f"permit_data: {permit_data}")
-        print(f"signed_message: {signed_message}")
+            print(f"permit_data: {permit_data}")
+            print(f"signed_message: {signed_message}")
         print(f"amount_in_wei: {amount}")
 
         # Continue with swap logic...
@@ -282,11 +730,9 @@ class Uniswap:
         print(f"Input amount in token: {amount_in_wei / (10 ** decimals_in)}")
         print(f"Token decimals: {decimals_in}")
 
-        # Initialize codec
-        codec = RouterCodec(w3=self.w3)
-
-        # Add slippage and correct min_amount_out with calculation using uniswap quoters
-        min_amount_out = 0
+        # V3 swaps keep min_amount_out at 0 unless provided, V4 swaps are quoted below
+        if min_amount_out is None and pool_version.lower() == "v3":
+            min_amount_out = 0
 
         # Get deadline (current block timestamp + 300 seconds)
         deadline = self.w3.eth.get_block("latest")["timestamp"] + 300
@@ -294,9 +740,8 @@ class Uniswap:
         if pool_version.lower() == "v3":
             # Encode V3 swap using recommended approach
             try:
-                trx_params = (
-                    codec.encode.chain()
-                    .permit2_permit(permit_data, signed_message)
+                builder = (
+                    self._new_chain(permit_data, signed_message)
                     .v3_swap_exact_in(
                         FunctionRecipient.SENDER,
                         amount_in_wei,
@@ -307,12 +752,16 @@ class Uniswap:
                             to_token,
                         ],
                     )
-                    .build_transaction(
-                        self.account.address,
-                        0,  # value=0 for ERC20 to ERC20 swaps
-                        deadline=deadline,
-                        ur_address=self.router_address
-                    )
+                )
+                gas_shape = builder.gas_shape()
+                trx_params = builder.build_transaction(
+                    self.account.address,
+                    0,  # value=0 for ERC20 to ERC20 swaps
+                    deadline=deadline,
+                    ur_address=self.router_address,
+                    gas_limit=gas_limit,
+                    gas_model=self.gas_model,
+                    access_lists=self.access_lists
                 )
                 print(f"V3 swap transaction built successfully")
                 
@@ -322,17 +771,18 @@ class Uniswap:
             
         elif pool_version.lower() == "v4":
             # Encode V4 swap using recommended approach
-            tick_spacing = 200  # Default tick spacing, adjust if needed
-            
-            pool_key = codec.encode.v4_pool_key(
-                from_token,
-                to_token,
-                fee,
-                tick_spacing,
-            )
-            
+            tick_spacing = 200  # Only used if the pool registry doesn't know this pair
+
             # Determine swap direction based on token ordering
-            zero_for_one = int(from_token, 16) < int(to_token, 16)
+            pool_key, zero_for_one = self.get_v4_pool_key(from_token, to_token, fee, tick_spacing, amount_in_wei)
+
+            if min_amount_out is None:
+                quote = self.quote_engine.quote(QuoteRequest.from_pool_key(pool_key, zero_for_one, amount_in_wei))
+                if quote is None:
+                    print(f"Failed to quote {from_token} -> {to_token}, the pool may not exist")
+                    return None
+                min_amount_out = apply_slippage(quote.amount_out, slippage)
+                print(f"Quoted amount out: {quote.amount_out} at block {quote.block_number}")
 
             print(f"Pool key: {pool_key}")
             print(f"Zero for one: {zero_for_one}")
@@ -340,9 +790,8 @@ class Uniswap:
             print(f"Min amount out: {min_amount_out}")
 
             try:
-                trx_params = (
-                    codec.encode.chain()
-                    .permit2_permit(permit_data, signed_message)
+                builder = (
+                    self._new_chain(permit_data, signed_message)
                     .v4_swap()
                     .swap_exact_in_single(
                         pool_key=pool_key,
@@ -353,12 +802,16 @@ class Uniswap:
                     .take_all(to_token, 0)
                     .settle_all(from_token, amount_in_wei)
                     .build_v4_swap()
-                    .build_transaction(
-                        self.account.address,
-                        0,  # value=0 for ERC20 to ERC20 swaps
-                        deadline=deadline,
-                        ur_address=self.router_address
-                    )
+                )
+                gas_shape = builder.gas_shape()
+                trx_params = builder.build_transaction(
+                    self.account.address,
+                    0,  # value=0 for ERC20 to ERC20 swaps
+                    deadline=deadline,
+                    ur_address=self.router_address,
+                    gas_limit=gas_limit,
+                    gas_model=self.gas_model,
+                    access_lists=self.access_lists
                 )
                 print(f"V4 swap transaction built successfully")
                 
@@ -384,16 +837,85 @@ class Uniswap:
                 try:
                     # You might need to add pool existence check here
                     print("Checking if pool exists...")
-                    pool_id = codec.encode.v4_pool_id(pool_key)
+                    pool_id = self.codec.encode.v4_pool_id(pool_key)
                     print(f"Pool id: {pool_id}")
                 except Exception as pool_check_error:
                     print(f"Pool check error: {pool_check_error}")
                 
                 return None
         
+        elif pool_version.lower() == "auto":
+            # Pick the best route by quoted output minus gas cost
+            _priority_fee, gas_price = self.fee_oracle.gas_fees(TransactionSpeed.FAST)
+            route_quote = self.route_finder.find_best(from_token, to_token, amount_in_wei, gas_price)
+            if route_quote is None:
+                print(f"No route found for {from_token} -> {to_token}")
+                return None
+            print(f"Best route: {route_quote.route}, quoted amount out: {route_quote.amount_out}")
+            if min_amount_out is None:
+                min_amount_out = apply_slippage(route_quote.amount_out, slippage)
+
+            try:
+                builder = route_quote.route.add_to_chain(
+                    self._new_chain(permit_data, signed_message),
+                    amount_in_wei,
+                    min_amount_out,
+                )
+                gas_shape = builder.gas_shape()
+                trx_params = builder.build_transaction(
+                    self.account.address,
+                    0,  # value=0 for ERC20 to ERC20 swaps
+                    deadline=deadline,
+                    ur_address=self.router_address,
+                    gas_limit=gas_limit,
+                    gas_model=self.gas_model,
+                    access_lists=self.access_lists
+                )
+                print(f"Routed swap transaction built successfully")
+            except Exception as e:
+                print(f"Error building routed transaction: {str(e)}")
+                return None
+
+        elif pool_version.lower() == "split":
+            split_plan = self.split_optimizer.plan(from_token, to_token, amount_in_wei, slippage)
+            if split_plan is None:
+                print(f"No pool could be quoted for {from_token} -> {to_token}")
+                return None
+            for split_slice in split_plan.slices:
+                print(f"Slice {split_slice.pool.route.protocol} fee {split_slice.pool.fee}: "
+                      f"{split_slice.amount_in} in, {split_slice.amount_out} quoted out")
+
+            try:
+                builder = split_plan.add_to_chain(
+                    self._new_chain(permit_data, signed_message)
+                )
+                gas_shape = builder.gas_shape()
+                trx_params = builder.build_transaction(
+                    self.account.address,
+                    0,  # value=0 for ERC20 to ERC20 swaps
+                    deadline=deadline,
+                    ur_address=self.router_address,
+                    gas_limit=gas_limit,
+                    gas_model=self.gas_model,
+                    access_lists=self.access_lists
+                )
+                print(f"Split swap transaction built successfully")
+            except Exception as e:
+                print(f"Error building split transaction: {str(e)}")
+                return None
+
         else:
-            raise ValueError("Unsupported pool_version. Use 'v3' or 'v4'.")
-        
+            raise ValueError("Unsupported pool_version. Use 'v3', 'v4', 'auto' or 'split'.")
+
+        return trx_params, gas_shape
+
+    def send_transaction(self, trx_params, gas_shape=None, on_signed=None):
+        """
+        Sign and send a built Universal Router transaction, then track its receipt and replace it if it gets stuck.
+        on_signed is called with the hash, nonce and parameters of the signed transaction before it is broadcast,
+        ex: to journal it. If it raises, the transaction is not sent.
+        Returns: the transaction hash, None if the account can't pay for the gas or the transaction was rejected
+        """
         # Check if we have sufficient ETH balance for gas
         balance = self.w3.eth.get_balance(self.account.address)
         estimated_gas_cost = trx_params['gas'] * trx_params['maxFeePerGas']
@@ -406,102 +928,287 @@ class Uniswap:
             print(f"Need {needed_eth} more ETH")
             return None
         
-        # Sign and send transaction using the built transaction parameters
+        # Sign and send transaction using the built transaction parameters, with the next nonce of the stream
+        trx_params = {**trx_params, "nonce": self.nonce_manager.allocate()}
+        tx_hash = None
         try:
             signed_tx = self.w3.eth.account.sign_transaction(trx_params, self.account.key)
+            if on_signed:
+                on_signed(signed_tx.hash, trx_params['nonce'], trx_params)
             tx_hash = self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
-            print(f"Transaction sent: {tx_hash.hex()}")
+            print(f"Transaction sent: {tx_hash.hex()}, nonce {trx_params['nonce']}")
+            self.receipt_watcher.watch(tx_hash, lambda receipt: self._on_swap_receipt(gas_shape, receipt))
+            self.rbf_manager.track(trx_params, tx_hash)
             return tx_hash
             
         except Exception as e:
             print(f"Error sending transaction: {str(e)}")
+            if tx_hash is None:
+                self.release_nonces([trx_params['nonce']])
             return None
 
-    def cancel_transaction(self, stuck_nonce):
+    def send_signed_transactions(self, transactions):
         """
-        Cancel stuck transaction by sending 0 ETH to self
+        Broadcast transactions already signed with nonces of this client's stream, in one batch request,
+        then track them like send_transaction. The nonces of the rejected transactions are given back with
+        release_nonces: reused if no later nonce was sent, else cancelled so the following ones are still mined.
+
+        Args:
+            transactions (list): the (trx_params, signed_tx, gas_shape, permit_token) of each transaction,
+                permit_token being the token whose Permit2 permit the transaction carries, if any
+        Returns: the hash of each transaction, None for the rejected ones
         """
-        # First, get the original stuck transaction
-        try:
+        responses = batch_responses(
+            self.w3, [("eth_sendRawTransaction", [Web3.to_hex(signed_tx.raw_transaction)])
+                      for _trx_params, signed_tx, _gas_shape, _permit_token in transactions])
+        tx_hashes, rejected_nonces = [], []
+        for (trx_params, _signed_tx, gas_shape, permit_token), response in zip(transactions, responses):
+            if "error" in response:
+                print(f"Transaction with nonce {trx_params['nonce']} rejected: {response['error'].get('message')}")
+                rejected_nonces.append(trx_params["nonce"])
+                tx_hashes.append(None)
+                continue
+            tx_hash = HexBytes(response["result"])
+            print(f"Transaction sent: {tx_hash.hex()}, nonce {trx_params['nonce']}")
+            self.receipt_watcher.watch(tx_hash, lambda receipt, shape=gas_shape: self._on_swap_receipt(shape, receipt))
+            self.rbf_manager.track(trx_params, tx_hash)
+            if permit_token:
+                expiration = self.codec.get_default_expiration()
+                self._remember_router_allowance(permit_token, expiration)
+                self.receipt_watcher.watch(
+                    tx_hash, lambda receipt, token=permit_token: self._on_permit_receipt(token, expiration, receipt))
+            tx_hashes.append(tx_hash)
+        self.release_nonces(rejected_nonces)
+        return tx_hashes
 
-            # Get current gas values
-            base_fee = self.w3.eth.get_block("latest")["baseFeePerGas"]
-            priority_fee = self.w3.eth.max_priority_fee
+    def release_nonces(self, nonces: Sequence[int]) -> None:
+        """
+        Give back the nonces of transactions allocated but never broadcast. The last nonces handed out are
+        allocated again next. A nonce followed by nonces already held by other sends can't be reused without
+        handing them out twice: it is cancelled instead, so it does not block them.
 
-            # Apply different multipliers
-            base_multiplier = 8   # High multiplier to prevent underpricing
-            priority_multiplier = 5  # Lower multiplier for miner tips
+        Args:
+            nonces (list): the nonces allocated and not sent
+        """
+        for nonce in sorted(set(nonces), reverse=True):
+            if self.nonce_manager.release(nonce):
+                continue
+            if not self.rbf_manager.cancel(nonce):
+                print(f"ERROR: nonce {nonce} could not be cancelled, the following transactions wait for it")
+        if nonces:
+            # the node may know of nonces this client did not send, ex: a "nonce too low" rejection
+            self.nonce_manager.resync()
 
-            new_max_fee_per_gas = max(base_fee * base_multiplier + priority_fee * 3, Web3.to_wei(0.1, "gwei"))  
-            new_max_priority_fee = max(priority_fee * priority_multiplier, Web3.to_wei(0.005, "gwei"))
+    def simulate_basket(
+            self,
+            from_token,
+            legs: Sequence[Tuple[str, int]],
+            fee,
+            slippage,
+            pool_version="v3",
+            state_overrides: Optional[StateOverrides] = None,
+            pool_versions: Optional[Sequence[str]] = None,
+            min_amounts_out: Optional[Sequence[Optional[int]]] = None) -> List[Optional[SimulationResult]]:
+        """
+        Build the exact swap transaction of each leg of a basket and simulate them all with eth_call,
+        in one batched request against the latest block, before anything is signed and sent.
+        Each leg is simulated on its own, on top of the current state and of the overrides.
+        If Permit2 is not approved yet for from_token, the approval is stubbed with a state override
+        (OpenZeppelin ERC20 storage layout), as make_trade would send it first.
 
-            # Estimate gas required
-            gas_limit = 21000  # Example gas limit for a swap
+        :param from_token: the token sold by every leg
+        :param legs: the (to_token, amount in wei) tuples
+        :param state_overrides: extra overrides, ex: a stubbed balance for a basket not funded yet
+        :param pool_versions: the pool version of each leg, if they differ. Default is pool_version for all.
+        :param min_amounts_out: the minimum output of each leg, as passed to make_trade
+        :return: the result of each leg, None for a leg whose transaction could not be built
+        """
+        self.ensure_ready()
+        from_token = Web3.to_checksum_address(from_token)
+        overrides = StateOverrides()
+        if not self.check_permit2_allowance(from_token):
+            overrides.token_allowance(from_token, self.wallet_address, self.permit2.address)
+        overrides = overrides.merge(state_overrides)
 
-            # ✅ Correct Total Gas Cost Calculation
-            total_gas_wei = gas_limit * new_max_fee_per_gas
-            total_gas_eth = Web3.from_wei(total_gas_wei, "ether")
+        built_legs = []
+        for i, (to_token, amount) in enumerate(legs):
+            built = self.build_trade(
+                from_token, to_token, amount, fee, slippage,
+                pool_versions[i] if pool_versions else pool_version,
+                min_amounts_out[i] if min_amounts_out else None,
+                gas_limit=_simulation_gas_limit,
+            )
+            built_legs.append(built[0] if built else None)
 
-            print(f"🟢 Estimated Total Gas Cost: {total_gas_eth} ETH")
-            print(f"🔹 Max Fee per Gas: {Web3.from_wei(new_max_fee_per_gas, 'gwei')} Gwei")
-            print(f"🔹 Max Priority Fee per Gas: {Web3.from_wei(new_max_priority_fee, 'gwei')} Gwei")
+        txs = [trx_params for trx_params in built_legs if trx_params is not None]
+        simulated = iter(self.simulator.simulate_many(txs, [overrides] * len(txs)))
+        results = [next(simulated) if trx_params is not None else None for trx_params in built_legs]
+        for (to_token, amount), result in zip(legs, results):
+            print(f"Simulated {from_token} -> {to_token} ({amount}): {result if result else 'not built'}")
+        return results
 
-            # Check if we have enough balance
-            balance = self.w3.eth.get_balance(self.account.address)
+    def redeem(self, fraction, tokens: Sequence[str], to_token, slippage, max_legs_per_tx=8, allow_partial=True,
+               retries=1):
+        """
+        Sell the same fraction of every holding to one token, with as few transactions as possible:
+        one Permit2 batch permit covers all the input tokens of a transaction.
+        With allow_partial, each leg is its own V4_SWAP command allowed to revert: a failing leg is skipped on chain
+        while the others settle, and the failed legs, found in the receipts, are quoted and sent again.
+        Otherwise all the legs of a transaction are V4 swap actions of a single V4_SWAP command.
 
-            print(f"\nCurrent balance: {Web3.from_wei(balance, 'ether')} ETH")
-            print(f"Required balance: {(total_gas_eth, 'ether')} ETH")
+        Args:
+            fraction (float): share of each balance to sell, between 0 and 1
+            tokens (list): the held tokens to sell
+            to_token (str): the token received, ex: $TALENT
+            slippage (float): Slippage tolerance in percent, applied to the quote of each leg
+            max_legs_per_tx (int): tokens sold per transaction at most
+            allow_partial (bool): let the legs of a transaction fail independently
+            retries (int): rounds of retries of the failed legs, only with allow_partial. Each round waits for
+                the receipts of the previous one
+        Returns: the hashes of the sent transactions, and the tokens that could not be routed or sent.
+            The legs failing in the last round are only seen in the receipts
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+        self.ensure_ready()
+        tokens = [Web3.to_checksum_address(token) for token in tokens]
+        to_token = Web3.to_checksum_address(to_token)
 
-            if balance < total_gas_wei:
-                print(f"ERROR: Insufficient balance for cancellation!")
-                print(f"Need {(total_gas_eth - Web3.from_wei(balance), 'ether')} more ETH")
-                return
+        # Sell a fraction of each balance, rounded down to the wei
+        fraction_ppm = int(fraction * 10 ** 6)
+        balances = self.get_token_balances(tokens)
+        holdings = [(token, balance * fraction_ppm // 10 ** 6) for token, balance in zip(tokens, balances)]
+        holdings = [(token, amount) for token, amount in holdings if amount > 0]
+        if not holdings:
+            print("Nothing to redeem")
+            return [], []
 
-            cancel_tx = {
-                "from": self.account.address,
-                "to": self.account.address,
-                "value": 0,
-                "gas": 21000,
-                "maxPriorityFeePerGas": new_max_priority_fee,
-                "maxFeePerGas": new_max_fee_per_gas,
-                "type": 2,
-                "chainId": self.w3.eth.chain_id,
-                "nonce": stuck_nonce
-            }
+        tx_hashes = []
+        skipped = []
+        for attempt in range(1 + (retries if allow_partial else 0)):
+            batches, unroutable = self.redemption_planner.plan(holdings, to_token, slippage, max_legs_per_tx)
+            skipped.extend(unroutable)
+            if not batches:
+                break
+            sent = self._send_redemption_batches(batches, allow_partial)
+            tx_hashes.extend(tx_hash for _batch, tx_hash in sent)
+            unsent = [leg for batch in batches[len(sent):] for leg in batch.legs]
+            skipped.extend(leg.token_in for leg in unsent)
+            if not allow_partial or attempt == retries:
+                break
 
-            print(f"\nAttempting cancellation with:")
-            print(f"New Max Fee: {Web3.from_wei(new_max_fee_per_gas, 'gwei')} gwei")
-            print(f"New Priority Fee: {Web3.from_wei(new_max_priority_fee, 'gwei')} gwei")
+            # Only the legs that failed on chain are sent again, with fresh quotes
+            receipts = self.receipt_watcher.wait_all([tx_hash for _batch, tx_hash in sent], timeout=120)
+            failed = []
+            for (batch, _tx_hash), receipt in zip(sent, receipts):
+                failed.extend(batch.failed_legs(receipt, self.address) if receipt else [])
+            if not failed:
+                break
+            print(f"{len(failed)} redemption legs failed, retrying them")
+            holdings = [(leg.token_in, leg.amount_in) for leg in failed]
+        return tx_hashes, skipped
 
-            signed_tx = self.w3.eth.account.sign_transaction(cancel_tx, self.account.key)
-            tx_hash = self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
-            print(f"Cancellation transaction hash: {tx_hash.hex()}")
+    def _send_redemption_batches(self, batches, allow_partial):
+        """
+        Sign and send one transaction per redemption batch, stopping at the first one that can't be sent
+        Returns: the (batch, tx_hash) of the sent transactions
+        """
+        # Permit2 is approved on each token once, the router allowances are then given by signature
+        approvals = self.approve_permit2_many([leg.token_in for batch in batches for leg in batch.legs])
+        not_approved = [token for token, approved in approvals.items() if not approved]
+        if not_approved:
+            raise ValueError(f"Failed to get Permit2 approval for {', '.join(not_approved)}")
 
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            print("Consider sending more ETH to cover higher gas fees")
+        deadline = self.w3.eth.get_block("latest")["timestamp"] + 300
+        sent = []
+        for batch in batches:
+            # Tokens still allowed by an earlier permit, even one not mined yet, are left out of the batch permit
+            permit_tokens = [leg.token_in for leg in batch.legs if not self.has_router_allowance(leg.token_in)]
+            builder = self.codec.encode.chain()
+            expiration = self.codec.get_default_expiration()
+            if permit_tokens:
+                permit_details = [
+                    (token, 2**160 - 1, expiration, permit2_nonce)
+                    for token, permit2_nonce in zip(permit_tokens, self.fetch_permit2_nonces(permit_tokens))
+                ]
+                permit_batch, signable_message = self.codec.create_permit2_batch_signable_message(
+                    permit_details,
+                    self.router_address,
+                    self.codec.get_default_deadline(),
+                    self.chain_context.chain_id,
+                )
+                signed_message = self.account.sign_message(signable_message)
+                builder = builder.permit2_permit_batch(permit_batch, signed_message)
 
-    def check_for_stuck_transactions(self):
+            builder = batch.add_to_chain(builder, revert_on_fail=not allow_partial)
+            gas_shape = builder.gas_shape()
+            pipelined = any(
+                leg.token_in not in permit_tokens and not self._router_allowance_mined(leg.token_in)
+                for leg in batch.legs
+            )
+            trx_params = builder.build_transaction(
+                self.account.address,
+                0,
+                deadline=deadline,
+                ur_address=self.router_address,
+                chain_id=self.chain_context.chain_id,
+                gas_limit=_pipelined_gas_limit * len(batch.legs) if pipelined else None,
+                gas_model=self.gas_model,
+                access_lists=self.access_lists
+            )
+            print(f"Redemption of {len(batch.legs)} tokens built, quoted amount out: {batch.amount_out}")
+            tx_hash = self.send_transaction(trx_params)
+            if tx_hash is None:
+                break
+            self.receipt_watcher.watch(
+                tx_hash, lambda receipt, batch=batch, gas_shape=gas_shape: self._on_redemption_receipt(
+                    batch, gas_shape, receipt))
+            for token in permit_tokens:
+                self._remember_router_allowance(token, expiration)
+                self.receipt_watcher.watch(
+                    tx_hash, lambda receipt, token=token: self._on_permit_receipt(token, expiration, receipt))
+            sent.append((batch, tx_hash))
+        return sent
+
+    def _on_redemption_receipt(self, batch, gas_shape, receipt):
+        failed = batch.failed_legs(receipt, self.address)
+        if failed:
+            print(f"Redemption {receipt['transactionHash'].hex()}: {len(failed)} of {len(batch.legs)} legs failed")
+        # The gas used is only learnt from the transactions where every leg went through
+        elif gas_shape:
+            self.gas_model.record(gas_shape, receipt["gasUsed"])
+
+    def _on_swap_receipt(self, gas_shape, receipt):
+        status = "confirmed" if receipt["status"] == 1 else "reverted"
+        print(f"Swap {receipt['transactionHash'].hex()} {status} in block {receipt['blockNumber']}, gas used: {receipt['gasUsed']}")
+        # Reverted transactions don't tell how much gas the full call needs
+        if receipt["status"] == 1 and gas_shape:
+            self.gas_model.record(gas_shape, receipt["gasUsed"])
+
+    def cancel_transaction(self, stuck_nonce):
         """
-        Check for stuck transactions by comparing pending vs latest nonce
-        Returns: stuck nonce if found, None if no stuck transactions
+        Cancel stuck transaction by sending 0 ETH to self.
+        Nonces sent by this client are replaced with higher fees first, and only cancelled as a last resort,
+        by the rbf_manager.
+        """
+        return self.rbf_manager.cancel(stuck_nonce)
+
+    def find_stuck_nonces(self):
+        """
+        Returns: every nonce sent but not mined yet, from the latest to the pending nonce
         """
         try:
             pending_nonce = self.w3.eth.get_transaction_count(self.account.address, 'pending')
             latest_nonce = self.w3.eth.get_transaction_count(self.account.address, 'latest')
-            
-            print(f"Pending nonce: {pending_nonce}")
-            print(f"Latest nonce: {latest_nonce}")
-            
-            if pending_nonce > latest_nonce:
-                print(f"Found stuck transaction with nonce {latest_nonce}")
-                return latest_nonce
-            else:
-                print("No stuck transactions found")
-                return None
-            
+            return list(range(latest_nonce, pending_nonce))
         except Exception as e:
             print(f"Error checking for stuck transactions: {e}")
-            return None
-
+            return []
 
+    def check_for_stuck_transactions(self):
+        """
+        Check for stuck transactions by comparing pending vs latest nonce
+        Returns: the first stuck nonce if found, None if no stuck transactions
+        """
+        stuck_nonces = self.find_stuck_nonces()
+        return stuck_nonces[0] if stuck_nonces else None
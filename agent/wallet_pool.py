@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from eth_account import Account
+from web3 import Web3
+from web3.types import ChecksumAddress
+from web3_rpc import batch_request
+
+_balance_of_selector = "0x70a08231"
+
+# runs the given legs of a basket from one wallet: (client, leg indices) -> a result dict for each of the legs
+ShardExecutor = Callable[[Any, List[int]], List[Dict[str, Any]]]
+
+
+class WalletPool:
+    """
+    Hot wallets sending the legs of one basket side by side. Each wallet has its own nonce stream, so the legs
+    of different wallets never wait on each other, and its own Permit2 state.
+    Legs are assigned to the wallets holding enough of the input token, to the one with the fewest legs first,
+    then with the largest balance left, so every wallet has about the same number of transactions in flight.
+    """
+    def __init__(self, clients: Sequence[Any]) -> None:
+        """
+        :param clients: one Uniswap client per wallet, ex: from Uniswap.for_wallet
+        """
+        if not clients:
+            raise ValueError("The wallet pool needs at least one wallet")
+        self.clients = list(clients)
+
+    @classmethod
+    def from_private_keys(cls, uniswap: Any, private_keys: Sequence[str]) -> "WalletPool":
+        """
+        :param uniswap: the client of the main wallet, its read side is shared by the others
+        :param private_keys: the keys of the other hot wallets
+        """
+        clients = [uniswap]
+        for private_key in private_keys:
+            address = Account.from_key(private_key).address
+            if address != uniswap.address:
+                clients.append(uniswap.for_wallet(address, private_key))
+        return cls(clients)
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    @property
+    def addresses(self) -> List[ChecksumAddress]:
+        return [client.address for client in self.clients]
+
+    def balances(self, token: str) -> List[int]:
+        """:return: the token balance of every wallet, read in one batch"""
+        token = Web3.to_checksum_address(token)
+        w3 = self.clients[0].w3
+        results = batch_request(w3, [
+            ("eth_call", [{"to": token, "data": _balance_of_selector + address[2:].lower().rjust(64, "0")}, "latest"])
+            for address in self.addresses
+        ])
+        return [int(result, 16) if result and result != "0x" else 0 for result in results]
+
+    def assign(
+            self,
+            token: str,
+            legs: Sequence[Tuple[str, int]],
+            balances: Optional[Sequence[int]] = None) -> Tuple[List[List[int]], List[int]]:
+        """
+        Spread the legs over the wallets. The largest legs are placed first.
+
+        :param token: the input token of every leg
+        :param legs: the (to_token, amount in wei) of each leg
+        :param balances: the token balance of every wallet, read from the chain if None
+        :return: the tuple (leg indices of each wallet, indices of the legs no wallet can pay for)
+        """
+        remaining = list(balances if balances is not None else self.balances(token))
+        assignments: List[List[int]] = [[] for _ in self.clients]
+        unassigned = []
+        for index in sorted(range(len(legs)), key=lambda i: legs[i][1], reverse=True):
+            amount = legs[index][1]
+            candidates = [wallet for wallet in range(len(self.clients)) if remaining[wallet] >= amount]
+            if not candidates:
+                unassigned.append(index)
+                continue
+            wallet = min(candidates, key=lambda w: (len(assignments[w]), -remaining[w]))
+            assignments[wallet].append(index)
+            remaining[wallet] -= amount
+        return [sorted(indices) for indices in assignments], sorted(unassigned)
+
+    def run(
+            self,
+            token: str,
+            legs: Sequence[Tuple[str, int]],
+            execute: ShardExecutor,
+            balances: Optional[Sequence[int]] = None) -> List[Dict[str, Any]]:
+        """
+        Assign the legs and run the share of every wallet in parallel.
+
+        :param execute: called from a thread per wallet with its client and its leg indices
+        :return: the result of every leg, in leg order, with the address of the wallet that sent it
+        """
+        assignments, unassigned = self.assign(token, legs, balances)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(legs)
+        for index in unassigned:
+            print(f"No wallet holds enough to buy {legs[index][0]}")
+            results[index] = {"token_address": legs[index][0], "tx_hash": None, "status": None, "wallet": None,
+                              "error": "insufficient balance in every wallet"}
+
+        shards = [(client, indices) for client, indices in zip(self.clients, assignments) if indices]
+        for client, indices in shards:
+            print(f"Wallet {client.address}: {len(indices)} legs")
+
+        def run_shard(shard):
+            client, indices = shard
+            try:
+                return execute(client, indices)
+            except Exception as e:
+                print(f"Wallet {client.address} failed: {e}")
+                return [{"token_address": legs[index][0], "tx_hash": None, "status": None, "error": str(e)}
+                        for index in indices]
+
+        if shards:
+            with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="wallet-shard") as executor:
+                for (client, indices), shard_results in zip(shards, executor.map(run_shard, shards)):
+                    for index, result in zip(indices, shard_results):
+                        results[index] = {**result, "wallet": client.address}
+        return results
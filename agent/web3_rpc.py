@@ -0,0 +1,572 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import requests
+from web3 import HTTPProvider, Web3
+from web3.providers.base import BaseProvider
+from web3._utils.encoding import Web3JsonEncoder
+from web3.types import RPCEndpoint, RPCResponse
+
+RpcCall = Tuple[str, Sequence[Any]]
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(endpoint_uri: str) -> requests.Session:
+    """
+    :param endpoint_uri: the JSON-RPC endpoint
+    :return: a keep-alive session shared by every request sent to this endpoint
+    """
+    with _sessions_lock:
+        session = _sessions.get(endpoint_uri)
+        if session is None:
+            session = requests.Session()
+            _sessions[endpoint_uri] = session
+        return session
+
+
+def post_batch(endpoint_uri: str, calls: Sequence[RpcCall], timeout: float = 30) -> List[Dict[str, Any]]:
+    """
+    POST all the calls to the endpoint as a single JSON-RPC batch.
+
+    :param endpoint_uri: the JSON-RPC endpoint
+    :param calls: the (method, params) tuples to send
+    :param timeout: the HTTP request timeout in seconds
+    :return: the JSON-RPC responses, in the same order as the calls
+    """
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": method, "params": list(params)}
+        for i, (method, params) in enumerate(calls)
+    ]
+    response = get_session(endpoint_uri).post(endpoint_uri, json=payload, timeout=timeout)
+    response.raise_for_status()
+    body = response.json()
+    if isinstance(body, dict):
+        # some nodes answer a whole failed batch with a single error object
+        return [body for _ in calls]
+    responses = {item.get("id"): item for item in body}
+    return [
+        responses.get(i, {"error": {"code": -32603, "message": "Missing response in batch"}})
+        for i in range(len(calls))
+    ]
+
+
+class BatchingHTTPProvider(HTTPProvider):
+    """
+    HTTP provider sending the JSON-RPC calls of concurrent callers as batches, over a pooled keep-alive session.
+    A call made while no request is in flight is sent right away, alone. The calls made while a request is
+    in flight are queued and sent together as one batch POST when it completes, so a single threaded caller
+    sees no extra latency and many threads share the round trips.
+    Inside a batching() scope, the queue is also held for a short window before each POST, to collect the calls
+    of a fan-out (ex: a thread pool quoting a whole basket) into one batch.
+
+    It is a drop-in replacement of Web3.HTTPProvider: Web3(BatchingHTTPProvider(url)).
+    """
+    def __init__(
+            self,
+            endpoint_uri: Optional[str] = None,
+            request_kwargs: Optional[Any] = None,
+            max_batch_size: int = 100) -> None:
+        """
+        :param max_batch_size: calls sent in one POST at most, most providers reject larger batches
+        """
+        super().__init__(endpoint_uri, request_kwargs, session=get_session(str(endpoint_uri)))
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._queue: List[Tuple[bytes, Future]] = []
+        self._sending = False
+        self._scopes = 0
+        self._window = 0.0
+        self.batches_sent = 0
+        self.calls_sent = 0
+
+    @contextmanager
+    def batching(self, window: float = 0.005) -> Iterator["BatchingHTTPProvider"]:
+        """
+        Hold each batch for window seconds while the scope is open, so concurrent calls join it.
+        """
+        with self._lock:
+            self._scopes += 1
+            self._window = max(self._window, window)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._scopes -= 1
+                if not self._scopes:
+                    self._window = 0.0
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        future: Future = Future()
+        with self._lock:
+            self._queue.append((self.encode_rpc_request(method, params), future))
+            leader = not self._sending
+            self._sending = True
+        if leader:
+            self._drain()
+        return future.result()
+
+    def _drain(self) -> None:
+        """Send the queued calls until the queue is empty. Only one thread drains at a time."""
+        while True:
+            with self._lock:
+                window = self._window
+            if window:
+                time.sleep(window)
+            with self._lock:
+                batch = self._queue[:self.max_batch_size]
+                del self._queue[:self.max_batch_size]
+                if not batch:
+                    self._sending = False
+                    return
+            try:
+                self._send(batch)
+            except Exception as e:
+                for _request, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _send(self, batch: List[Tuple[bytes, Future]]) -> None:
+        self.batches_sent += 1
+        self.calls_sent += len(batch)
+        payload = b"[" + b",".join(request for request, _future in batch) + b"]" if len(batch) > 1 else batch[0][0]
+        request_kwargs = {"timeout": 30, **self.get_request_kwargs()}
+        response = get_session(str(self.endpoint_uri)).post(self.endpoint_uri, data=payload, **request_kwargs)
+        response.raise_for_status()
+        body = self.decode_rpc_response(response.content)
+        if len(batch) == 1:
+            batch[0][1].set_result(body)
+            return
+        # some nodes answer a whole failed batch with a single error object
+        responses = {item.get("id"): item for item in body} if isinstance(body, list) else {}
+        for request, future in batch:
+            request_id = json.loads(request)["id"]
+            error = body.get("error") if isinstance(body, dict) else None
+            future.set_result(responses.get(request_id) or {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": error or {"code": -32603, "message": "Missing response in batch"},
+            })
+
+
+# sent to every healthy endpoint at once, so the transaction reaches the mempool by the fastest path
+_broadcast_methods = {"eth_sendRawTransaction"}
+
+
+class _Endpoint:
+    def __init__(self, uri: str, max_samples: int) -> None:
+        self.uri = uri
+        self.provider = BatchingHTTPProvider(uri)
+        self.latencies: Deque[float] = deque(maxlen=max_samples)
+        self.failures = 0
+        self.sick_until = 0.0
+        self.head: Optional[int] = None
+
+    def percentile(self, percent: float, default: float) -> float:
+        samples = sorted(self.latencies)
+        if len(samples) < 10:
+            return default
+        return samples[int(percent / 100 * (len(samples) - 1))]
+
+
+def _is_answer(response: Union[Dict[str, Any], List[Dict[str, Any]]]) -> bool:
+    """
+    :return: True if the response is a valid answer of the node, even an error one (ex: a revert),
+        False for the errors of the endpoint itself (rate limit, missing state, internal error...)
+    """
+    if isinstance(response, list):
+        return all(_is_answer(item) for item in response)
+    error = response.get("error")
+    if not error:
+        return True
+    message = str(error.get("message", "")).lower()
+    return error.get("code") == 3 or "data" in error or "revert" in message or "nonce" in message \
+        or "already known" in message or "underpriced" in message or "insufficient funds" in message
+
+
+class HedgedMultiProvider(BaseProvider):
+    """
+    Provider spreading the requests over several RPC endpoints.
+    Reads go to the fastest healthy endpoint. If it has not answered after its own p95 latency, or if it fails,
+    the same request is sent to the next endpoint and the first valid answer wins. Raw transactions are sent to
+    every healthy endpoint at once.
+    An endpoint failing max_failures times in a row, or whose head lags more than max_block_lag blocks behind
+    the others, is left out for cooldown seconds.
+
+    Use it as a drop-in provider: Web3(HedgedMultiProvider([url_1, url_2])), or through make_provider.
+    """
+    def __init__(
+            self,
+            endpoint_uris: Sequence[str],
+            default_hedge_delay: float = 0.3,
+            min_hedge_delay: float = 0.05,
+            timeout: float = 30,
+            max_failures: int = 3,
+            cooldown: float = 30.0,
+            max_block_lag: int = 3,
+            max_samples: int = 200) -> None:
+        """
+        :param default_hedge_delay: hedge delay in seconds until an endpoint has enough latency samples
+        :param min_hedge_delay: lower bound of the hedge delay, so fast endpoints are not hedged on jitter
+        :param timeout: seconds to wait for any endpoint to answer
+        """
+        super().__init__()
+        if not endpoint_uris:
+            raise ValueError("At least one endpoint is required")
+        self.endpoints = [_Endpoint(uri, max_samples) for uri in endpoint_uris]
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_block_lag = max_block_lag
+        self.hedges_sent = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=8 * len(self.endpoints), thread_name_prefix="rpc-hedge")
+
+    def healthy_endpoints(self) -> List[_Endpoint]:
+        """:return: the endpoints to use, fastest first. Every endpoint if none is healthy."""
+        now = time.monotonic()
+        with self._lock:
+            heads = [endpoint.head for endpoint in self.endpoints if endpoint.head is not None]
+            best_head = max(heads) if heads else None
+            healthy = [
+                endpoint for endpoint in self.endpoints
+                if endpoint.sick_until <= now
+                and (best_head is None or endpoint.head is None or best_head - endpoint.head <= self.max_block_lag)
+            ]
+        healthy = healthy or list(self.endpoints)
+        return sorted(healthy, key=lambda endpoint: endpoint.percentile(50, self.default_hedge_delay))
+
+    def _record(self, endpoint: _Endpoint, started: float, response: Any) -> None:
+        with self._lock:
+            if response is not None and _is_answer(response):
+                endpoint.latencies.append(time.monotonic() - started)
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.max_failures:
+                endpoint.sick_until = time.monotonic() + self.cooldown
+                endpoint.failures = 0
+                print(f"RPC endpoint {endpoint.uri} is failing, left out for {self.cooldown}s")
+
+    def _observe_head(self, endpoint: _Endpoint, method: str, response: Dict[str, Any]) -> None:
+        if method == "eth_blockNumber" and isinstance(response.get("result"), str):
+            with self._lock:
+                endpoint.head = int(response["result"], 16)
+
+    def _call(self, endpoint: _Endpoint, request: Callable[[_Endpoint], Any]) -> Any:
+        started = time.monotonic()
+        try:
+            response = request(endpoint)
+        except Exception:
+            self._record(endpoint, started, None)
+            raise
+        self._record(endpoint, started, response)
+        return response
+
+    def _hedged(self, request: Callable[[_Endpoint], Any]) -> Any:
+        """
+        Send the request to the endpoints one after another, each one after the hedge delay of the previous one
+        or as soon as it fails, and return the first valid answer.
+        """
+        endpoints = self.healthy_endpoints()
+        deadline = time.monotonic() + self.timeout
+        in_flight: Dict[Future, _Endpoint] = {}
+        last_response: Any = None
+        last_error: Optional[Exception] = None
+        next_index = 0
+        hedge_at = 0.0
+        while True:
+            if next_index < len(endpoints) and (not in_flight or time.monotonic() >= hedge_at):
+                endpoint = endpoints[next_index]
+                if in_flight:
+                    self.hedges_sent += 1
+                in_flight[self._executor.submit(self._call, endpoint, request)] = endpoint
+                hedge_at = time.monotonic() + max(
+                    self.min_hedge_delay, endpoint.percentile(95, self.default_hedge_delay))
+                next_index += 1
+            if not in_flight:
+                break
+            wait_until = hedge_at if next_index < len(endpoints) else deadline
+            done, _pending = wait(in_flight, timeout=max(0.0, min(wait_until, deadline) - time.monotonic()),
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if _is_answer(response):
+                    return response
+                last_response = response
+            if done and next_index < len(endpoints):
+                # an endpoint failed: hedge right away
+                hedge_at = time.monotonic()
+            if time.monotonic() >= deadline:
+                break
+        if last_response is not None:
+            return last_response
+        raise last_error or TimeoutError("No RPC endpoint answered")
+
+    def _broadcast(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        endpoints = self.healthy_endpoints()
+        futures = [
+            self._executor.submit(self._call, endpoint, lambda e: e.provider.make_request(method, params))
+            for endpoint in endpoints
+        ]
+        last_response: Any = None
+        last_error: Optional[Exception] = None
+        try:
+            # the first endpoint to accept the transaction answers, a slow or hung one doesn't hold the send
+            for future in as_completed(futures, timeout=self.timeout):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if "error" not in response:
+                    return response
+                last_response = last_response or response
+        except TimeoutError as e:
+            last_error = last_error or e
+        if last_response is not None:
+            return last_response
+        raise last_error or TimeoutError("No RPC endpoint answered")
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if method in _broadcast_methods:
+            return self._broadcast(method, params)
+
+        def request(endpoint: _Endpoint) -> RPCResponse:
+            response = endpoint.provider.make_request(method, params)
+            self._observe_head(endpoint, method, response)
+            return response
+        return self._hedged(request)
+
+    def make_batch_request(self, calls: Sequence[RpcCall]) -> List[Dict[str, Any]]:
+        """Send a JSON-RPC batch with the same hedging as single requests"""
+        return self._hedged(lambda endpoint: post_batch(endpoint.uri, calls, self.timeout))
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return any(endpoint.provider.is_connected() for endpoint in self.healthy_endpoints())
+
+
+def make_provider(endpoint_uris: Optional[str]) -> BaseProvider:
+    """
+    :param endpoint_uris: one RPC endpoint, or several separated by commas, None for the default endpoint
+        of Web3.HTTPProvider
+    :return: a batching provider for one endpoint, a hedged provider over all of them otherwise
+    """
+    uris = [uri.strip() for uri in (endpoint_uris or "").split(",") if uri.strip()]
+    if len(uris) <= 1:
+        return BatchingHTTPProvider(uris[0] if uris else None)
+    return HedgedMultiProvider(uris)
+
+
+# results that never change once known
+_immutable_methods = {"eth_chainId", "net_version", "eth_getBlockByHash"}
+# results that only change when a new block is mined, for a "latest" block parameter
+_block_scoped_methods = {
+    "eth_getBlockByNumber", "eth_maxPriorityFeePerGas", "eth_gasPrice", "eth_feeHistory", "eth_call",
+    "eth_getBalance", "eth_getCode", "eth_getStorageAt", "eth_getTransactionCount", "eth_estimateGas",
+}
+# methods that change the state seen by the next block-scoped calls
+_state_changing_methods = {"eth_sendRawTransaction", "eth_sendTransaction"}
+
+
+class BlockCache:
+    """
+    Web3 middleware caching the JSON-RPC responses within a block.
+    chain id and other immutable results are cached forever, as are the reads at an explicit block number.
+    Reads at the latest block (blocks, fees, balances, calls...) are cached until the next block, and at most
+    block_time seconds, so they don't go stale while no new block number is seen.
+    A transaction is only cached once it is mined. Pending state (ex: the pending nonce) is never cached.
+
+    The current block number is itself cached for block_time seconds, and moved forward as soon as a newer
+    block or receipt is seen, so a read made after waiting for a receipt never sees the state before it.
+
+    Install it with install_block_cache(w3).
+    """
+    def __init__(self, block_time: float = 1.0) -> None:
+        """
+        :param block_time: how long the block number and the reads at the latest block are trusted, in seconds.
+            Keep it below the chain block time.
+        """
+        self.block_time = block_time
+        self._lock = threading.Lock()
+        self._immutable: Dict[Tuple[str, str], RPCResponse] = {}
+        # the responses at the latest block, with the time they were received
+        self._block_scoped: Dict[Tuple[str, str], Tuple[float, RPCResponse]] = {}
+        self._block_number: Optional[int] = None
+        self._block_number_at = 0.0
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        """:return: the (hits, misses) of each method"""
+        with self._lock:
+            methods = set(self.hits) | set(self.misses)
+            return {method: (self.hits.get(method, 0), self.misses.get(method, 0)) for method in sorted(methods)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._immutable = {}
+            self._block_scoped = {}
+            self._block_number = None
+
+    def _observe_block(self, block_number: Optional[int]) -> None:
+        """Move to a newer block, dropping the block-scoped responses. The lock must be held."""
+        if block_number is None:
+            return
+        if self._block_number is None or block_number > self._block_number:
+            if self._block_number is not None:
+                self._block_scoped = {}
+            self._block_number = block_number
+            self._block_number_at = time.monotonic()
+        elif block_number == self._block_number:
+            self._block_number_at = time.monotonic()
+
+    @staticmethod
+    def _scope(method: str, params: Sequence[Any]) -> Optional[str]:
+        """:return: 'immutable', 'block' or None if the response must not be cached"""
+        if method in _immutable_methods:
+            return "immutable"
+        if method == "eth_blockNumber":
+            return "block_number"
+        if method == "eth_getTransactionReceipt":
+            return "receipt"
+        if method == "eth_getTransactionByHash":
+            return "transaction"
+        if method not in _block_scoped_methods:
+            return None
+        if method in ("eth_maxPriorityFeePerGas", "eth_gasPrice", "eth_feeHistory"):
+            return "block"
+        block = params[0] if method == "eth_getBlockByNumber" else (params[1] if len(params) > 1 else "latest")
+        if method == "eth_getStorageAt":
+            block = params[2] if len(params) > 2 else "latest"
+        if block == "latest":
+            return "block"
+        if isinstance(block, int) or (isinstance(block, str) and block.startswith("0x")):
+            return "immutable"
+        # pending, safe, finalized...
+        return None
+
+    def _count(self, counters: Dict[str, int], method: str) -> None:
+        counters[method] = counters.get(method, 0) + 1
+
+    def __call__(self, make_request: Callable[[RPCEndpoint, Any], RPCResponse], w3: Web3) -> Callable[[RPCEndpoint, Any], RPCResponse]:
+        def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+            scope = self._scope(method, params)
+            if scope is None:
+                if method in _state_changing_methods:
+                    with self._lock:
+                        self._block_scoped = {}
+                return make_request(method, params)
+
+            if scope == "block_number":
+                with self._lock:
+                    if self._block_number is not None and time.monotonic() - self._block_number_at < self.block_time:
+                        self._count(self.hits, method)
+                        return {"jsonrpc": "2.0", "id": 0, "result": hex(self._block_number)}
+                    self._count(self.misses, method)
+                response = make_request(method, params)
+                if "result" in response:
+                    with self._lock:
+                        self._observe_block(int(response["result"], 16) if isinstance(response["result"], str)
+                                            else response["result"])
+                return response
+
+            try:
+                key = (method, json.dumps(params, cls=Web3JsonEncoder, sort_keys=True))
+            except TypeError:
+                return make_request(method, params)
+            with self._lock:
+                if scope == "block":
+                    received_at, cached = self._block_scoped.get(key, (0.0, None))
+                    if cached is not None and time.monotonic() - received_at >= self.block_time:
+                        cached = None
+                else:
+                    cached = self._immutable.get(key)
+                if cached is not None:
+                    self._count(self.hits, method)
+                    return cached
+                self._count(self.misses, method)
+
+            response = make_request(method, params)
+            if "error" in response or response.get("result") is None:
+                return response
+            result = response["result"]
+            with self._lock:
+                if scope == "receipt":
+                    # a mined transaction is final, and proves its block exists
+                    self._immutable[key] = response
+                    block_number = result.get("blockNumber")
+                    self._observe_block(int(block_number, 16) if isinstance(block_number, str) else block_number)
+                elif scope == "block":
+                    if method == "eth_getBlockByNumber":
+                        block_number = result.get("number")
+                        self._observe_block(int(block_number, 16) if isinstance(block_number, str) else block_number)
+                    self._block_scoped[key] = (time.monotonic(), response)
+                elif scope == "transaction":
+                    # a pending transaction still gets its block, or is replaced
+                    if result.get("blockHash"):
+                        self._immutable[key] = response
+                else:
+                    self._immutable[key] = response
+            return response
+        return middleware
+
+
+def install_block_cache(w3: Web3, block_time: float = 1.0) -> BlockCache:
+    """
+    Add a BlockCache to the innermost middleware layer of w3, once.
+
+    :return: the installed cache, to read its counters
+    """
+    if "block_cache" in w3.middleware_onion:
+        return w3.middleware_onion.get("block_cache")
+    cache = BlockCache(block_time)
+    w3.middleware_onion.inject(cache, name="block_cache", layer=0)
+    return cache
+
+
+def batch_responses(w3: Web3, calls: Sequence[RpcCall]) -> List[Dict[str, Any]]:
+    """
+    Send many JSON-RPC calls in one round trip when the provider is an HTTP endpoint,
+    one request per call otherwise.
+
+    :param w3: valid Web3 instance
+    :param calls: the (method, params) tuples to send. Params must be JSON serializable.
+    :return: the raw JSON-RPC responses, errors included, in the same order as the calls
+    """
+    if not calls:
+        return []
+    make_batch_request = getattr(w3.provider, "make_batch_request", None)
+    if make_batch_request:
+        return make_batch_request(calls)
+    endpoint_uri = getattr(w3.provider, "endpoint_uri", None)
+    if endpoint_uri:
+        return post_batch(str(endpoint_uri), calls)
+    return [w3.provider.make_request(method, list(params)) for method, params in calls]
+
+
+def batch_request(w3: Web3, calls: Sequence[RpcCall]) -> List[Any]:
+    """
+    Same as batch_responses, but only keep the results.
+
+    :return: the raw results, in the same order as the calls. A result is None if its call failed.
+    """
+    responses = batch_responses(w3, calls)
+    return [response.get("result") if "error" not in response else None for response in responses]